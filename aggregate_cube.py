@@ -0,0 +1,215 @@
+import os
+import numpy as np
+import pandas as pd
+from dataset import movie_years
+from genre_index import ensure_genre_index, genre_membership, genre_vocabulary
+from file_handling import source_fingerprint
+from exceptions import FileHandlingError
+from instrumentation import instrumented
+
+# ratings are stored with one decimal, so a rating histogram bin is the rating times ten
+RATING_BINS = 101
+
+# bin width of the runtime histogram in minutes, one minute keeps the histograms exact
+RUNTIME_BIN_MINUTES = 1
+
+# per year and genre sums, plus an extra genre slot at the end that counts every movie once
+# a movie with several genres is counted in each of them, like the charts always did
+class AggregateCube:
+    def __init__(self, years, genres, year_order, counts, rating_sums, raters_sums, runtime_sums, rating_hist, runtime_hist):
+        self.years = years # sorted year values, the first axis
+        self.genres = genres # sorted genre names, the second axis without the all movies slot
+        self.year_order = year_order # years in the order they first show up, summaries use it to break ties
+        self.counts = counts # (years, genres + 1) arrays
+        self.rating_sums = rating_sums
+        self.raters_sums = raters_sums
+        self.runtime_sums = runtime_sums
+        self.rating_hist = rating_hist # sparse histograms, (year, slot, bin) -> count as four parallel arrays
+        self.runtime_hist = runtime_hist
+
+    @property
+    def all_slot(self):
+        return len(self.genres)
+
+    @classmethod
+    def empty(cls):
+        zeros = np.zeros((0, 1))
+        no_hist = tuple(np.empty(0, dtype=np.int64) for _ in range(4))
+        return cls(np.empty(0, dtype=np.int64), [], [], zeros.astype(np.int64), zeros, zeros, zeros, no_hist, no_hist)
+
+    @classmethod
+    def from_frame(cls, df):
+        # one pass of bincounts per genre over the rows, everything after this is O(years x genres)
+        if df.empty:
+            return cls.empty()
+        df = ensure_genre_index(df)
+        genres = genre_vocabulary(df)
+        year_column = movie_years(df).to_numpy()
+        years, codes = np.unique(year_column, return_inverse=True)
+        year_order = pd.unique(year_column).tolist()
+
+        ratings = df['rating'].to_numpy(dtype=float)
+        raters = df['num_raters'].to_numpy(dtype=float)
+        runtimes = df['run_length'].to_numpy(dtype=float)
+        rating_bins = np.rint(ratings * 10).astype(np.int64)
+        runtime_bins = (runtimes // RUNTIME_BIN_MINUTES).astype(np.int64)
+        runtime_bin_count = int(runtime_bins.max()) + 1
+
+        membership = genre_membership(df)
+        shape = (len(years), len(genres) + 1)
+        counts = np.zeros(shape, dtype=np.int64)
+        rating_sums = np.zeros(shape)
+        raters_sums = np.zeros(shape)
+        runtime_sums = np.zeros(shape)
+        rating_parts = []
+        runtime_parts = []
+        for slot in range(len(genres) + 1):
+            rows = slice(None) if slot == len(genres) else membership[:, slot]
+            slot_codes = codes[rows]
+            counts[:, slot] = np.bincount(slot_codes, minlength=len(years))
+            rating_sums[:, slot] = np.bincount(slot_codes, weights=ratings[rows], minlength=len(years))
+            raters_sums[:, slot] = np.bincount(slot_codes, weights=raters[rows], minlength=len(years))
+            runtime_sums[:, slot] = np.bincount(slot_codes, weights=runtimes[rows], minlength=len(years))
+            rating_parts.append(_slot_hist(slot_codes, rating_bins[rows], RATING_BINS, slot, years))
+            runtime_parts.append(_slot_hist(slot_codes, runtime_bins[rows], runtime_bin_count, slot, years))
+
+        return cls(years, genres, year_order, counts, rating_sums, raters_sums, runtime_sums,
+                   _concat_hists(rating_parts), _concat_hists(runtime_parts))
+
+    def merge(self, other):
+        # self is treated as coming before other, which decides the order years first show up in
+        years = np.union1d(self.years, other.years)
+        genres = sorted(set(self.genres) | set(other.genres))
+        seen_years = set(self.year_order)
+        year_order = self.year_order + [year for year in other.year_order if year not in seen_years]
+
+        merged = [np.zeros((len(years), len(genres) + 1), dtype=array.dtype) for array in
+                  (self.counts, self.rating_sums, self.raters_sums, self.runtime_sums)]
+        hists = ([], [])
+        for cube in (self, other):
+            rows = np.searchsorted(years, cube.years)
+            slots = cube.slot_positions(genres)
+            for target, source in zip(merged, (cube.counts, cube.rating_sums, cube.raters_sums, cube.runtime_sums)):
+                target[np.ix_(rows, slots)] += source
+            for target, (hist_years, hist_slots, bins, counts) in zip(hists, (cube.rating_hist, cube.runtime_hist)):
+                target.append((hist_years, slots[hist_slots], bins, counts))
+
+        return AggregateCube(years, genres, year_order, *merged, *(_concat_hists(parts) for parts in hists))
+
+    def slot_positions(self, genres):
+        # where every genre slot of this cube goes in a cube with the given genres
+        return np.array([genres.index(genre) for genre in self.genres] + [len(genres)], dtype=np.int64)
+
+    def genre_year_counts(self, year_column='year'):
+        # number of movies for each year and genre, same long format and order as genre_index.genre_year_counts
+        table = pd.DataFrame(self.counts[:, :self.all_slot], index=pd.Index(self.years, name=year_column),
+                             columns=pd.Index(self.genres, name='genres'))
+        long = table.stack().reset_index(name='count')
+        return long[long['count'] > 0].reset_index(drop=True)
+
+    def genre_counts(self):
+        # number of movies per genre, most common first like value_counts
+        counts = pd.Series(self.counts[:, :self.all_slot].sum(axis=0), index=self.genres, name='count')
+        return counts.sort_values(ascending=False, kind='stable')
+
+    def genre_means(self, column):
+        # mean of rating or num_raters per genre, for the genres that have movies
+        sums = self.sums(column)
+        counts = self.counts[:, :self.all_slot].sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums[:, :self.all_slot].sum(axis=0) / counts
+        return pd.Series(means, index=self.genres, name=column)[counts > 0]
+
+    def year_counts(self):
+        # movies per year, in the order the years first show up
+        counts = pd.Series(self.counts[:, self.all_slot], index=self.years)
+        return counts[counts > 0].reindex(self.year_order)
+
+    def decade_counts(self):
+        counts = pd.Series(self.counts[:, self.all_slot], index=(self.years // 10) * 10)
+        return counts.groupby(level=0).sum().loc[lambda counts: counts > 0]
+
+    def total_movies(self):
+        return int(self.counts[:, self.all_slot].sum())
+
+    def total(self, column):
+        return float(self.sums(column)[:, self.all_slot].sum())
+
+    def sums(self, column):
+        return {'rating': self.rating_sums, 'num_raters': self.raters_sums, 'run_length': self.runtime_sums}[column]
+
+    def histogram(self, column):
+        # (value, number of movies) for every distinct rating or runtime bin over all movies
+        hist_years, slots, bins, counts = self.rating_hist if column == 'rating' else self.runtime_hist
+        keep = slots == self.all_slot
+        totals = np.bincount(bins[keep], weights=counts[keep])
+        values = np.flatnonzero(totals)
+        scale = 0.1 if column == 'rating' else RUNTIME_BIN_MINUTES
+        return values * scale, totals[values]
+
+    def save(self, path, fingerprint):
+        # writing to a temp file first so a reader never sees half a cube
+        try:
+            tmp_path = path + '.tmp.npz'
+            np.savez_compressed(
+                tmp_path, fingerprint=np.array(fingerprint), years=self.years, genres=np.array(self.genres, dtype=str),
+                year_order=np.array(self.year_order), counts=self.counts, rating_sums=self.rating_sums,
+                raters_sums=self.raters_sums, runtime_sums=self.runtime_sums,
+                rating_hist=np.stack(self.rating_hist), runtime_hist=np.stack(self.runtime_hist),
+            )
+            os.replace(tmp_path, path)
+        except Exception as e:
+            raise FileHandlingError(f"Error saving aggregate cube to {path}: {e}")
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        # returns None when there is no cube or it was built from another version of the clean file
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if str(data['fingerprint']) != fingerprint:
+                    return None
+                return cls(data['years'], data['genres'].tolist(), data['year_order'].tolist(), data['counts'],
+                           data['rating_sums'], data['raters_sums'], data['runtime_sums'],
+                           tuple(data['rating_hist']), tuple(data['runtime_hist']))
+        except Exception: # a broken cube is just rebuilt
+            return None
+
+def as_cube(data):
+    # the charts take either the cube or a frame to build one from
+    return data if isinstance(data, AggregateCube) else AggregateCube.from_frame(data)
+
+def cube_path_for(filename): # the cube lives right next to the clean csv
+    return os.path.splitext(filename)[0] + '.cube.npz'
+
+def save_cube(cube, filename):
+    cube.save(cube_path_for(filename), source_fingerprint(filename))
+
+@instrumented
+def load_cube(filename="clean_movie_data.csv", df=None):
+    # the cube saved when filename was cleaned, rebuilt from df (or the file) when it is missing or out of date
+    fingerprint = source_fingerprint(filename)
+    cube = AggregateCube.load(cube_path_for(filename), fingerprint)
+    if cube is None:
+        if df is None:
+            from dataset import load_dataset
+            df = load_dataset(filename)
+        cube = AggregateCube.from_frame(df)
+        cube.save(cube_path_for(filename), fingerprint)
+    return cube
+
+def _slot_hist(codes, bins, bin_count, slot, years):
+    # the non zero cells of one genre slot's year x bin histogram
+    counts = np.bincount(codes * bin_count + bins, minlength=len(years) * bin_count)
+    cells = np.flatnonzero(counts)
+    return (years[cells // bin_count].astype(np.int64), np.full(len(cells), slot, dtype=np.int64),
+            (cells % bin_count).astype(np.int64), counts[cells].astype(np.int64))
+
+def _concat_hists(parts):
+    # glues sparse histograms together, adding up cells that show up more than once
+    years, slots, bins, counts = (np.concatenate(column) for column in zip(*parts))
+    cells = np.stack([years, slots, bins], axis=1)
+    unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+    totals = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(unique)).astype(np.int64)
+    return unique[:, 0], unique[:, 1], unique[:, 2], totals
@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from render_cache import RenderCache, FigureRenderer, DEFAULT_RENDER_TIMEOUT
+import plotting
+from dataset import get_dataset, dataset_version
+from aggregate_cube import load_cube
+from rank_index import load_ranks
+from summary_stats import SummaryStats, summary_lines
+from partition_store import query_movies, load_partitions
+from summarize import json_value
+from exceptions import FileHandlingError, PlottingError
+from instrumentation import stage
+
+# the analysis the streamlit app shows, served over http for dashboards and batch jobs. one asyncio loop takes the
+# connections, the summaries and searches run on a few threads and the charts are drawn by a pool of worker processes,
+# so a slow chart never holds up the loop. identical requests in flight share one answer and every answer is cached
+# under the version of the clean file, a new clean file is picked up by the next request
+#   GET /health                         the dataset version, the charts and the cache counters
+#   GET /summary[?format=txt]           the numbers of movie_summary.txt, as json or as the same text
+#   GET /search                         the movies of some genres and years, a page at a time
+#   GET /charts                         the names of the charts
+#   GET /charts/<name>.png              one chart of the analysis page
+# /summary, /search and the charts all take genres=Horror,Comedy (or genres repeated), match=any|all, year_min,
+# year_max and year, which sets both. /search also takes limit and offset, the scatter charts take aggregate and log_raters
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = int(os.environ.get('MOVIES_API_PORT', 8000))
+
+# how much memory the cached responses may use, the least recently used ones go first like in the render cache
+DEFAULT_CACHE_MB = int(os.environ.get('MOVIES_API_CACHE_MB', 128))
+
+# chart drawing processes. at least one even with a single cpu, drawing in the server process would stop the loop
+_cpus = os.cpu_count() or 1
+DEFAULT_API_WORKERS = int(os.environ.get('MOVIES_API_WORKERS', min(8, _cpus)))
+
+# threads for the summaries and searches, pandas and pyarrow spend most of their time without the gil
+DEFAULT_API_THREADS = int(os.environ.get('MOVIES_API_THREADS', min(8, 2 * _cpus)))
+
+SEARCH_COLUMNS = ['name', 'genres', 'year']
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 10_000
+
+# name in the url -> plotting function, what it draws from and the options it takes
+CHARTS = {
+    'movies_by_genre_over_time': (plotting.plot_movies_by_genre_over_time, 'cube', ()),
+    'genre_ratings_bar': (plotting.plot_genre_ratings_bar, 'cube', ()),
+    'ratings_vs_raters': (plotting.plot_ratings_vs_raters, 'frame', ('aggregate', 'log_raters')),
+    'runtime_vs_year': (plotting.plot_runtime_vs_year, 'frame', ('aggregate',)),
+    'ratings_distribution': (plotting.plot_ratings_distribution, 'cube', ()),
+    'runtime_distribution': (plotting.plot_runtime_distribution, 'cube', ()),
+    'movies_by_decade': (plotting.plot_movies_by_decade, 'cube', ()),
+    'raters_by_genre_bar': (plotting.plot_raters_by_genre_bar, 'cube', ()),
+}
+
+# a request the server cannot answer, with the status to answer it with
+class ApiError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+        super().__init__(self.message)
+
+def query_filters(query):
+    # the genre and year filters of a query string, in the form partition_store.query_movies takes them
+    # the genres are sorted so the same filters in another order share a cached response
+    genres = sorted({genre.strip() for value in query.get('genres', []) for genre in value.split(',') if genre.strip()})
+    match = _last(query, 'match', 'any')
+    if match not in ('any', 'all'):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"match must be 'any' or 'all', not {match}")
+    year = _int(query, 'year')
+    year_min = _int(query, 'year_min', year)
+    year_max = _int(query, 'year_max', year)
+    filters = {'genres': genres, 'match': match, 'year_min': year_min, 'year_max': year_max}
+    if not genres and year_min is None and year_max is None:
+        return None
+    return filters
+
+def _last(query, name, default=None):
+    values = query.get(name)
+    return values[-1] if values else default
+
+def _int(query, name, default=None):
+    value = _last(query, name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be a whole number, not {value}")
+
+def _bool(query, name):
+    value = _last(query, name)
+    if value is None:
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ApiError(HTTPStatus.BAD_REQUEST, f"{name} must be true or false, not {value}")
+
+def json_body(value):
+    return json.dumps(value, default=json_value).encode()
+
+class AnalyticsServer:
+    def __init__(self, filename="clean_movie_data.csv", workers=DEFAULT_API_WORKERS, threads=DEFAULT_API_THREADS,
+                 cache_mb=DEFAULT_CACHE_MB):
+        self.filename = os.path.abspath(filename)
+        self.cache = RenderCache(cache_mb * 1024 * 1024)
+        # the responses are cached here, so the renderer keeps none of its own
+        self.renderer = FigureRenderer(self.filename, workers=workers, cache=RenderCache(0))
+        self.threads = ThreadPoolExecutor(threads)
+        self.inflight = {} # key -> task of a response being worked out, requests for the same one wait on it
+        self.counts = {'requests': 0, 'hits': 0, 'coalesced': 0, 'computed': 0, 'errors': 0}
+        self._stat = None
+        self._version = None
+
+    def version(self):
+        # the dataset fingerprint, hashed again only when the file's size or modification time changed
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            raise FileHandlingError(f"File {self.filename} not found.")
+        if (stat.st_size, stat.st_mtime_ns) != self._stat:
+            self._version = dataset_version(self.filename)
+            self._stat = (stat.st_size, stat.st_mtime_ns)
+        return self._version
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        # the workers start loading the dataset while the server process writes the partitions it searches
+        self.renderer.start()
+        await asyncio.get_running_loop().run_in_executor(self.threads, load_partitions, self.filename)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        self.renderer.shutdown()
+        self.threads.shutdown(cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        # http/1.1 with keep alive, only as much of it as GET requests from scripts and dashboards need
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get('content-length'):
+                    await reader.readexactly(int(headers['content-length'])) # a GET has no use for a body
+
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    status, content_type, body, extra = self.error(ApiError(HTTPStatus.BAD_REQUEST, "Malformed request line"))
+                    keep_alive = False
+                else:
+                    method, target, http_version = parts
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' if http_version == 'HTTP/1.0' else connection != 'close'
+                    status, content_type, body, extra = await self.respond(method, target)
+
+                head = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}",
+                        f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                head += [f"{name}: {value}" for name, value in extra.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+                if parts[:1] != ['HEAD']:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError): # gone, cut short or a line over the limit
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target):
+        # (status, content type, body, extra headers) for one request, errors included
+        self.counts['requests'] += 1
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise ApiError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not supported, only GET")
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            path = url.path.rstrip('/') or '/'
+            version = self.version()
+            with stage('api_server.respond'):
+                if path in ('/', '/health'):
+                    return HTTPStatus.OK, 'application/json', json_body(self.health(version)), {'X-Dataset-Version': version}
+                if path == '/summary':
+                    fmt = _last(query, 'format', 'json')
+                    if fmt not in ('json', 'txt'):
+                        raise ApiError(HTTPStatus.BAD_REQUEST, f"format must be json or txt, not {fmt}")
+                    filters = query_filters(query)
+                    key = (version, 'summary', fmt, repr(filters))
+                    compute = lambda: self.in_thread(self.summary_body, fmt, filters)
+                    content_type = 'application/json' if fmt == 'json' else 'text/plain; charset=utf-8'
+                elif path == '/search':
+                    filters = query_filters(query)
+                    offset = _int(query, 'offset', 0)
+                    limit = _int(query, 'limit', DEFAULT_PAGE_SIZE)
+                    if offset < 0 or not 0 <= limit <= MAX_PAGE_SIZE:
+                        raise ApiError(HTTPStatus.BAD_REQUEST, f"offset must be positive and limit between 0 and {MAX_PAGE_SIZE}")
+                    key = (version, 'search', repr(filters), offset, limit)
+                    compute = lambda: self.in_thread(self.search_body, filters, offset, limit)
+                    content_type = 'application/json'
+                elif path == '/charts':
+                    return HTTPStatus.OK, 'application/json', json_body(sorted(CHARTS)), {'X-Dataset-Version': version}
+                elif path.startswith('/charts/') and path.endswith('.png'):
+                    name = path[len('/charts/'):-len('.png')]
+                    if name not in CHARTS:
+                        raise ApiError(HTTPStatus.NOT_FOUND, f"No chart named {name}, see /charts")
+                    plot_function, source, options = CHARTS[name]
+                    filters = query_filters(query)
+                    params = {option: _bool(query, option) for option in options if _last(query, option) is not None}
+                    key = (version, 'chart', name, repr(filters), tuple(sorted(params.items())))
+                    compute = lambda: self.draw(plot_function, version, source, filters, params)
+                    content_type = 'image/png'
+                else:
+                    raise ApiError(HTTPStatus.NOT_FOUND, f"Nothing at {path}")
+                body, cache_status = await self.cached(key, compute)
+            return HTTPStatus.OK, content_type, body, {'X-Dataset-Version': version, 'X-Cache': cache_status}
+        except Exception as e:
+            self.counts['errors'] += 1
+            return self.error(e)
+
+    def error(self, e):
+        if isinstance(e, ApiError):
+            status = e.status
+        elif isinstance(e, (FileHandlingError, PlottingError)):
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+        else:
+            status, e = HTTPStatus.INTERNAL_SERVER_ERROR, f"An error occurred while answering the request : {e}"
+        return status, 'application/json', json_body({'error': str(e)}), {}
+
+    async def cached(self, key, compute):
+        # the cached body of key, the one already being worked out for another request, or a new one
+        body = self.cache.get(key)
+        if body is not None:
+            self.counts['hits'] += 1
+            return body, 'hit'
+        task = self.inflight.get(key)
+        if task is not None:
+            self.counts['coalesced'] += 1
+            return await asyncio.shield(task), 'coalesced'
+
+        async def work():
+            try:
+                body = await compute()
+                self.cache.put(key, body)
+                return body
+            finally:
+                self.inflight.pop(key, None)
+
+        # shielded, a client hanging up does not cancel the answer the others are waiting for
+        task = asyncio.ensure_future(work())
+        self.inflight[key] = task
+        self.counts['computed'] += 1
+        return await asyncio.shield(task), 'miss'
+
+    def in_thread(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.threads, func, *args)
+
+    async def draw(self, plot_function, version, source, filters, params):
+        if filters is not None: # a 404 for genres and years without movies, instead of a chart that failed to draw
+            await self.in_thread(self.movies, filters, ['year'])
+        submit = lambda: self.renderer.submit(plot_function, version, source, 'png', filters, **params)
+        if self.renderer.workers <= 0: # drawn in this process, on a thread so the loop keeps going
+            return await self.in_thread(lambda: submit().result())
+        future = submit()
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), DEFAULT_RENDER_TIMEOUT)
+        except (TimeoutError, PlottingError):
+            # a worker that hangs or a pool given up on, image() then draws it on a thread here (or raises the plot's own error)
+            return await self.in_thread(self.renderer.image, future, 0)
+
+    def movies(self, filters, columns=None):
+        df = query_movies(self.filename, columns=columns, **filters)
+        if df.empty:
+            raise ApiError(HTTPStatus.NOT_FOUND, "No movies match these genres and years.")
+        return df
+
+    def summary_body(self, fmt, filters):
+        if filters is None:
+            # every movie, with the cube and rank index like summarize.py
+            df = get_dataset(self.filename)
+            result = SummaryStats.from_frame(df, load_cube(self.filename, df), load_ranks(self.filename, df)).result()
+        else:
+            result = SummaryStats.from_frame(self.movies(filters)).result()
+        if fmt == 'txt':
+            return ''.join(summary_lines(result)).encode()
+        return json_body(result)
+
+    def search_body(self, filters, offset, limit):
+        if filters is None:
+            df = get_dataset(self.filename)[SEARCH_COLUMNS]
+        else:
+            df = query_movies(self.filename, columns=SEARCH_COLUMNS, **filters)
+        page = df.iloc[offset:offset + limit]
+        movies = [{'name': name, 'genres': genres, 'year': int(year)}
+                  for name, genres, year in zip(page['name'].tolist(), page['genres'].astype(str).tolist(), page['year'].tolist())]
+        return json_body({'total': len(df), 'offset': offset, 'limit': limit, 'movies': movies})
+
+    def health(self, version):
+        return {'status': 'ok', 'dataset_version': version, 'charts': sorted(CHARTS), 'render_workers': self.renderer.workers,
+                'counts': self.counts, 'cache': self.cache.stats(), 'in_flight': len(self.inflight)}
+
+async def serve(filename="clean_movie_data.csv", host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_API_WORKERS,
+                threads=DEFAULT_API_THREADS, cache_mb=DEFAULT_CACHE_MB):
+    app = AnalyticsServer(filename, workers, threads, cache_mb)
+    try:
+        server = await app.start(host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"Serving {filename} on http://{host}:{port}", flush=True) # benchmarks.py reads the port from this line
+        async with server:
+            await server.serve_forever()
+    finally:
+        app.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the movie summary, search and charts over http")
+    parser.add_argument('filename', nargs='?', default='clean_movie_data.csv')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="0 picks a free port")
+    parser.add_argument('--workers', type=int, default=DEFAULT_API_WORKERS, help="chart drawing processes")
+    parser.add_argument('--threads', type=int, default=DEFAULT_API_THREADS, help="threads for the summaries and searches")
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_CACHE_MB, help="memory for the cached responses")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.filename, args.host, args.port, args.workers, args.threads, args.cache_mb))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,802 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, deque
+from urllib.parse import urlsplit
+import numpy as np
+import pandas as pd
+import plotting
+from data_cleaning import parse_run_length, parse_release_date, clean_data, clean_data_streaming
+from file_handling import load_clean_data, save_clean_data, memory_report, apply_clean_dtypes
+from dataset import prepare_dataset, load_dataset, dataset_version
+from movie_query import MovieIndex
+from combine import combine
+from generate_data import generate
+from summarize import create_summary_txt, generate_reports, partition_rows, DIMENSIONS, DEFAULT_REPORT_WORKERS
+from render_cache import RenderCache, FigureRenderer, render_figure, draw_figure, encode_figure, DEFAULT_RENDER_WORKERS
+from aggregate_cube import load_cube
+from rank_index import RankIndex, RANK_COLUMNS
+from genre_index import has_genre
+from partition_store import load_partitions, filter_dataset
+from instrumentation import peak_rss_mb, current_rss_mb
+from api_server import CHARTS, DEFAULT_API_WORKERS
+
+# every plotting function the app shows, the suite draws and encodes each one
+PLOT_FUNCTIONS = [
+    plotting.plot_movies_by_genre_over_time,
+    plotting.plot_genre_ratings_bar,
+    plotting.plot_ratings_vs_raters,
+    plotting.plot_runtime_vs_year,
+    plotting.plot_ratings_distribution,
+    plotting.plot_runtime_distribution,
+    plotting.plot_movies_by_decade,
+    plotting.plot_raters_by_genre_bar,
+]
+
+# the charts the app draws from the aggregate cube instead of the rows
+CUBE_PLOTS = {
+    plotting.plot_movies_by_genre_over_time,
+    plotting.plot_genre_ratings_bar,
+    plotting.plot_ratings_distribution,
+    plotting.plot_runtime_distribution,
+    plotting.plot_movies_by_decade,
+    plotting.plot_raters_by_genre_bar,
+}
+
+# the old row by row conversions from clean_data, kept here so we can compare against them
+def legacy_convert_runtime_to_minutes(runtime_str):
+    if isinstance(runtime_str, str):
+        try:
+            hours, minutes = runtime_str.split('h ')
+            hours = int(hours)
+            minutes = int(minutes.replace('min', ''))
+            return hours * 60 + minutes
+        except ValueError:
+            return pd.NA
+    else:
+        return pd.NA
+
+def legacy_convert_release_date(date_str):
+    if isinstance(date_str, str):
+        date_part = date_str.split('(')[0].strip()
+        return pd.to_datetime(date_part, format='%d %B %Y', errors='coerce')
+    else:
+        return pd.NaT
+
+# building a big frame by resampling the real raw values so the distinct strings look like the real data
+def make_raw_columns(rows, source="combined.csv", seed=0):
+    raw = pd.read_csv(source, usecols=['run_length', 'release_date'])
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(raw), size=rows)
+    return raw.iloc[picks].reset_index(drop=True)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def bench_parsing(rows, legacy_rows=100_000):
+    df = make_raw_columns(rows)
+
+    # the legacy version takes far too long at 10M rows, so we time it on a slice and scale it up
+    legacy_rows = min(legacy_rows, rows)
+    legacy = df.iloc[:legacy_rows]
+    _, legacy_runtime = timed(legacy['run_length'].apply, legacy_convert_runtime_to_minutes)
+    _, legacy_date = timed(legacy['release_date'].apply, legacy_convert_release_date)
+    scale = rows / legacy_rows
+
+    _, new_runtime = timed(parse_run_length, df['run_length'])
+    _, new_date = timed(parse_release_date, df['release_date'])
+
+    return {
+        'rows': rows,
+        'legacy_rows_timed': legacy_rows,
+        'legacy_run_length_s': legacy_runtime * scale,
+        'legacy_release_date_s': legacy_date * scale,
+        'vectorized_run_length_s': new_runtime,
+        'vectorized_release_date_s': new_date,
+        'speedup_run_length': legacy_runtime * scale / new_runtime,
+        'speedup_release_date': legacy_date * scale / new_date,
+    }
+
+def make_clean_file(rows, directory, source="clean_movie_data.csv", seed=0):
+    clean = pd.read_csv(source)
+    rng = np.random.default_rng(seed)
+    big = clean.iloc[rng.integers(0, len(clean), size=rows)].reset_index(drop=True)
+    path = os.path.join(directory, 'clean_movie_data.csv')
+    save_clean_data(big, path, verbose=False)
+    return path
+
+def legacy_load(path):
+    # what every consumer used to do, read the text and parse the dates again
+    df = pd.read_csv(path)
+    df['rel_date'] = pd.to_datetime(df['rel_date'], errors='coerce')
+    return df
+
+def bench_load(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_clean_file(rows, directory)
+        _, csv_time = timed(legacy_load, path)
+        _, cold_time = timed(load_clean_data, path) # parses the csv and writes the typed cache
+        _, warm_time = timed(load_clean_data, path)
+        _, projected_time = timed(load_clean_data, path, ['rating'])
+
+    return {
+        'rows': rows,
+        'csv_parse_s': csv_time,
+        'cache_build_s': cold_time,
+        'cache_load_s': warm_time,
+        'cache_load_rating_only_s': projected_time,
+        'speedup_cache_load': csv_time / warm_time,
+    }
+
+def bench_memory(rows):
+    # the frame the app used to hold (csv types plus a float year) against the declared schema
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_clean_file(rows, directory)
+        legacy = legacy_load(path)
+        legacy['year'] = legacy['rel_date'].dt.year.astype(float)
+        compact = load_dataset(path)
+        legacy_report = memory_report(legacy)
+        compact_report = memory_report(compact)
+
+    return {
+        'rows': rows,
+        'legacy_bytes': int(legacy_report.loc['total', 'bytes']),
+        'schema_bytes': int(compact_report.loc['total', 'bytes']),
+        'reduction': legacy_report.loc['total', 'bytes'] / compact_report.loc['total', 'bytes'],
+        'legacy_columns': legacy_report.drop('total').to_dict(orient='index'),
+        'schema_columns': compact_report.drop('total').to_dict(orient='index'),
+    }
+
+# runs in a fresh interpreter so the first run really is a cold start, only streamlit's test runner is imported before it
+APP_TIMER = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+page, reruns = sys.argv[1], int(sys.argv[2])
+app = AppTest.from_file('sample.py', default_timeout=600)
+app.session_state['page'] = page
+start = time.perf_counter()
+app.run()
+cold = time.perf_counter() - start
+warm = []
+for _ in range(reruns):
+    start = time.perf_counter()
+    app.run()
+    warm.append(time.perf_counter() - start)
+if app.exception:
+    raise SystemExit(str(app.exception))
+print(json.dumps({'cold_s': cold, 'rerun_s': sorted(warm)[len(warm) // 2], 'modules': len(sys.modules)}))
+"""
+
+APP_PAGES = ['Movie Dataset Analysis', 'Search For Movies']
+
+def bench_app(reruns=5):
+    # cold start and median rerun time of every page of sample.py, each page in its own new process
+    results = {'reruns': reruns, 'pages': {}}
+    for page in APP_PAGES:
+        output = subprocess.run([sys.executable, '-c', APP_TIMER, page, str(reruns)], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        results['pages'][page] = json.loads(output.stdout.strip().splitlines()[-1])
+    return results
+
+def bench_render(filename="clean_movie_data.csv", workers=DEFAULT_RENDER_WORKERS, repeats=3):
+    # every chart of the analysis page drawn one after another, and all at once through the worker pool
+    # the caches have no room so every figure is really drawn, and the pool is started before it is timed
+    # with enough cpus a page drawn by the workers should take about as long as its slowest chart
+    version = dataset_version(filename)
+    df = load_dataset(filename)
+    cube = load_cube(filename, df)
+    figures = {}
+    for plot_function in PLOT_FUNCTIONS:
+        start = time.perf_counter()
+        render_figure(plot_function, cube if plot_function in CUBE_PLOTS else df, version, cache=RenderCache(0))
+        figures[plot_function.__name__] = time.perf_counter() - start
+
+    renderer = FigureRenderer(filename, workers=workers, cache=RenderCache(0)).start()
+    pages = []
+    try:
+        for plot_function in PLOT_FUNCTIONS: # once so every worker has loaded the dataset and imported matplotlib
+            renderer.image(renderer.submit(plot_function, version, 'cube' if plot_function in CUBE_PLOTS else 'frame'))
+        for _ in range(repeats):
+            start = time.perf_counter()
+            futures = [renderer.submit(plot_function, version, 'cube' if plot_function in CUBE_PLOTS else 'frame') for plot_function in PLOT_FUNCTIONS]
+            for future in futures:
+                renderer.image(future)
+            pages.append(time.perf_counter() - start)
+    finally:
+        renderer.shutdown()
+
+    return {
+        'rows': len(df),
+        'workers': workers,
+        'cpus': os.cpu_count(),
+        'figures_s': figures,
+        'serial_s': sum(figures.values()),
+        'slowest_figure_s': max(figures.values()),
+        'parallel_s': min(pages),
+        'parallel_vs_slowest': min(pages) / max(figures.values()),
+    }
+
+def bench_reports(filename="clean_movie_data.csv", workers=DEFAULT_REPORT_WORKERS, sampled=5):
+    # every genre, decade and year report of the clean file: loading the file again for every report (timed on a few
+    # and scaled), one batch run in this process, one with the worker pool, and a run where nothing changed
+    df = load_dataset(filename)
+    partitions = [(dimension, key) for dimension in DIMENSIONS for key in partition_rows(df, dimension)]
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        for dimension, key in partitions[:sampled]:
+            frame = load_dataset(filename)
+            rows = partition_rows(frame, dimension)[key]
+            create_summary_txt(frame.iloc[rows], os.path.join(output_dir, 'one.txt'))
+        per_report = (time.perf_counter() - start) / min(sampled, len(partitions))
+
+        _, serial = timed(lambda: generate_reports(filename, DIMENSIONS, output_dir, workers=0, force=True))
+        _, parallel = timed(lambda: generate_reports(filename, DIMENSIONS, output_dir, workers=workers, force=True))
+        _, unchanged = timed(lambda: generate_reports(filename, DIMENSIONS, output_dir, workers=workers))
+    return {
+        'rows': len(df),
+        'reports': len(partitions),
+        'workers': workers,
+        'one_by_one_s': per_report * len(partitions),
+        'batch_serial_s': serial,
+        'batch_parallel_s': parallel,
+        'unchanged_s': unchanged,
+    }
+
+def rss_slope_mb(rss):
+    # how fast the rss grows, in MB per 1000 pages, from a straight line through the rss after every page
+    if len(rss) < 2:
+        return 0.0
+    return float(np.polyfit(np.arange(len(rss)), rss, 1)[0]) * 1000
+
+def bench_soak(filename="clean_movie_data.csv", pages=2000, release=True, warmup=5):
+    # every chart of the analysis page drawn again and again without a cache, with the rss after every page
+    # release=False leaves every figure to the garbage collector like the app did before the figures were released
+    # a leak shows as a slope that stays up in the second half, while warming up only tilts the first one
+    df = load_dataset(filename)
+    cube = load_cube(filename, df)
+    rss = []
+    start = time.perf_counter()
+    for _ in range(pages):
+        for plot_function in PLOT_FUNCTIONS:
+            data = cube if plot_function in CUBE_PLOTS else df
+            if release:
+                draw_figure(plot_function, data)
+            else:
+                encode_figure(plot_function(data))
+        rss.append(current_rss_mb())
+    settled = rss[min(warmup, pages - 1):]
+    half = len(settled) // 2
+    return {
+        'rows': len(df),
+        'pages': pages,
+        'released': release,
+        'page_s': (time.perf_counter() - start) / pages,
+        'rss_mb': rss,
+        'rss_after_warmup_mb': settled[0],
+        'rss_max_first_half_mb': max(settled[:half] or settled),
+        'rss_max_second_half_mb': max(settled[half:]),
+        'rss_slope_first_half_mb_per_1000_pages': rss_slope_mb(settled[:half]),
+        'rss_slope_second_half_mb_per_1000_pages': rss_slope_mb(settled[half:]),
+        'rss_min_mb': min(settled),
+        'rss_max_mb': max(settled),
+    }
+
+# runs in every process of the shared dataset benchmark: loads the dataset, reads every column like the pages do,
+# says it is ready and holds on to it until the benchmark has measured its memory
+SHARED_WORKER = """
+import sys, time
+start = time.perf_counter()
+from dataset import load_dataset
+df = load_dataset(sys.argv[1], shared=sys.argv[2] == '1')
+loaded = time.perf_counter() - start
+for column in df.columns:
+    values = df[column]
+    values.str.len().sum() if column == 'name' else values.cat.codes.max() if column == 'genres' else values.max()
+print('ready', loaded, flush=True)
+sys.stdin.read()
+"""
+
+def process_memory_mb(pid):
+    # resident and proportional set size, pss splits every shared page between the processes mapping it
+    # so the pss of all the processes adds up to what they really take from the host
+    memory = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                memory[key.lower() + '_mb'] = int(value.split()[0]) / 1024
+    return memory
+
+def bench_shared(rows, processes=4):
+    # the memory of several server processes that each load their own copy of the dataset, against the same
+    # processes mapping the one published copy. linux only, the proportional set sizes come from /proc
+    results = {'rows': rows, 'processes': processes}
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_clean_file(rows, directory)
+        # unique titles like the real scrape has, the resampled ones would repeat enough to be interned
+        clean = pd.read_csv(path)
+        clean['name'] = clean['name'] + ' #' + clean.index.astype(str)
+        save_clean_data(clean, path, verbose=False)
+        load_dataset(path, shared=False) # the typed cache, so every run below loads the same way
+        _, results['publish_s'] = timed(lambda: subprocess.run([sys.executable, 'shared_dataset.py', path], cwd=here, check=True, capture_output=True))
+        for label, shared in (('private', '0'), ('shared', '1')):
+            workers = [subprocess.Popen([sys.executable, '-c', SHARED_WORKER, path, shared], cwd=here, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, text=True) for _ in range(processes)]
+            try:
+                load_times = []
+                for worker in workers:
+                    reply = worker.stdout.readline().split()
+                    if not reply or reply[0] != 'ready':
+                        raise RuntimeError("a benchmark process failed to load the dataset")
+                    load_times.append(float(reply[1]))
+                memory = [process_memory_mb(worker.pid) for worker in workers]
+            finally:
+                for worker in workers:
+                    worker.communicate('')
+            results[label] = {
+                'load_s': max(load_times),
+                'rss_mb_each': [m['rss_mb'] for m in memory],
+                'pss_mb_each': [m['pss_mb'] for m in memory],
+                'pss_mb_total': sum(m['pss_mb'] for m in memory),
+            }
+    return results
+
+SUMMARY_WORKER = """
+import json, sys, time
+import pandas as pd
+from instrumentation import peak_rss_mb
+def high_water_mb():
+    # VmHWM starts again at exec, ru_maxrss would still count the benchmark process this one was forked from
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) / 1024 for line in f if line.startswith('VmHWM'))
+    except (OSError, StopIteration):
+        return peak_rss_mb()
+path, output, mode, chunksize = sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4])
+start = time.perf_counter()
+if mode == 'streaming':
+    from summarize import create_streaming_summary
+    result = create_streaming_summary(path, output, chunksize)
+    estimates = {key: result[key] for key in ('distinct_titles', 'rating_quantiles', 'run_length_quantiles')}
+else:
+    from file_handling import apply_clean_dtypes
+    from dataset import prepare_dataset
+    from summarize import create_summary_txt
+    df = prepare_dataset(apply_clean_dtypes(pd.read_csv(path)))
+    create_summary_txt(df, output)
+    estimates = {'distinct_titles': int(df['name'].nunique())}
+print(json.dumps({'seconds': time.perf_counter() - start, 'rss_peak_mb': high_water_mb(), **estimates}))
+"""
+
+def quantile_rank_error(values, q, estimate):
+    # how far the share of values at or below the estimate is from q, zero when the estimate sits inside a run of equal values
+    low = np.count_nonzero(values < estimate) / len(values)
+    high = np.count_nonzero(values <= estimate) / len(values)
+    return max(low - q, q - high, 0.0)
+
+def bench_streaming(rows, chunksize=None):
+    # summarize.py on the whole frame and in one streaming pass, each in its own process so the peaks are their own
+    # at rows / 4 and rows, the whole frame grows with the file while the stream should stay flat
+    from summary_sketch import DEFAULT_CHUNK_ROWS, QUANTILES, quantile_name
+    chunksize = chunksize or DEFAULT_CHUNK_ROWS
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {'chunksize': chunksize, 'sizes': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (rows // 4, rows):
+            path = make_clean_file(size, directory)
+            clean = pd.read_csv(path)
+            clean['name'] = clean['name'] + ' #' + (clean.index % (size // 2)).astype(str) # every title twice
+            save_clean_data(clean, path, verbose=False)
+            del clean
+            runs = {}
+            for mode in ('full', 'streaming'):
+                output = os.path.join(directory, f'{mode}.txt')
+                reply = subprocess.run([sys.executable, '-c', SUMMARY_WORKER, path, output, mode, str(chunksize)], cwd=here,
+                                       check=True, capture_output=True, text=True).stdout.splitlines()[-1]
+                runs[mode] = json.loads(reply)
+                with open(output) as f:
+                    runs[mode]['text'] = f.read()
+            values = apply_clean_dtypes(pd.read_csv(path, usecols=['rating', 'run_length'])) # float32 ratings like the stream reads
+            values = {column: values[column].to_numpy(dtype=float) for column in values.columns}
+            streaming = runs['streaming']
+            results['sizes'][size] = {
+                'full_s': runs['full']['seconds'], 'full_rss_mb': runs['full']['rss_peak_mb'],
+                'streaming_s': streaming['seconds'], 'streaming_rss_mb': streaming['rss_peak_mb'],
+                'same_text': runs['full']['text'] == streaming['text'],
+                'distinct_titles': runs['full']['distinct_titles'], 'distinct_titles_estimate': streaming['distinct_titles'],
+                'quantile_rank_error': {column: max(quantile_rank_error(values[column], q, streaming[f'{column}_quantiles'][quantile_name(q)])
+                                                    for q in QUANTILES) for column in ('rating', 'run_length')},
+            }
+    return results
+
+# what the dashboards ask the api for, every chart and a few summaries and searches
+API_REQUESTS = [
+    '/summary',
+    '/summary?genres=Horror',
+    '/summary?year_min=1990&year_max=1999&format=txt',
+    '/search?genres=Comedy&year=1995',
+    '/search?genres=Drama,Crime&match=all',
+    '/search?year=2007&limit=50',
+    *[f'/charts/{name}.png' for name in CHARTS],
+    '/charts/ratings_vs_raters.png?log_raters=true',
+    '/charts/movies_by_decade.png?genres=Horror',
+]
+
+async def api_fetch(reader, writer, path):
+    # one GET on a keep alive connection, (status, X-Cache header)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers.get('x-cache')
+
+async def api_load(host, port, paths, concurrency):
+    # concurrency clients on their own connection, each sending the next path as soon as its last one is answered
+    queue = deque(paths)
+    latencies = []
+    statuses = Counter()
+    cache = Counter()
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while queue:
+                path = queue.popleft()
+                start = time.perf_counter()
+                status, cache_status = await api_fetch(reader, writer, path)
+                latencies.append((path.split('?')[0].split('/')[1], time.perf_counter() - start))
+                statuses[status] += 1
+                cache[cache_status] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    def percentiles(times):
+        return {'requests': len(times), 'p50_ms': float(np.percentile(times, 50)) * 1000, 'p99_ms': float(np.percentile(times, 99)) * 1000}
+
+    endpoints = {}
+    for endpoint, elapsed in latencies:
+        endpoints.setdefault(endpoint, []).append(elapsed)
+    return {**percentiles([elapsed for _, elapsed in latencies]), 'seconds': seconds, 'throughput_rps': len(latencies) / seconds,
+            'errors': sum(count for status, count in statuses.items() if status >= 400), 'cache': dict(cache),
+            'endpoints': {endpoint: percentiles(times) for endpoint, times in endpoints.items()}}
+
+def bench_api(filename="clean_movie_data.csv", requests=2000, concurrency=16, workers=DEFAULT_API_WORKERS, url=None, seed=0):
+    # load test of api_server.py, started here with a free port unless url points at one already running
+    # cold: every request of the mix sent by all the clients at once on an empty cache, so the identical ones coalesce
+    # warm: the mix in random order, answered from the response cache
+    server = None
+    if url is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        server = subprocess.Popen([sys.executable, 'api_server.py', filename, '--port', '0', '--workers', str(workers)],
+                                  cwd=here, stdout=subprocess.PIPE, text=True)
+        line = server.stdout.readline()
+        if not line.startswith('Serving'):
+            server.kill()
+            raise RuntimeError("the api server failed to start")
+        url = line.split()[-1]
+    address = urlsplit(url)
+    rng = np.random.default_rng(seed)
+    try:
+        cold = [path for path in API_REQUESTS for _ in range(concurrency)]
+        warm = [API_REQUESTS[i] for i in rng.integers(0, len(API_REQUESTS), size=requests)]
+        results = {'url': url, 'concurrency': concurrency, 'workers': None if server is None else workers}
+        results['cold'] = asyncio.run(api_load(address.hostname, address.port, cold, concurrency))
+        results['warm'] = asyncio.run(api_load(address.hostname, address.port, warm, concurrency))
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT) # shuts the chart workers down too
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    return results
+
+def make_clean_frame(rows, source="clean_movie_data.csv", seed=0):
+    clean = load_clean_data(source)
+    rng = np.random.default_rng(seed)
+    return clean.iloc[rng.integers(0, len(clean), size=rows)].reset_index(drop=True)
+
+# a mix of what the search page asks for, from one genre to several filters at once
+QUERIES = {
+    'one genre, first page by rating': dict(genres=['Horror'], sort_by='rating', ascending=False),
+    'genre and year': dict(genres=['Horror'], year_min=2008, year_max=2008),
+    'two genres all, year range': dict(genres=['Action', 'Comedy'], match='all', year_min=2000, year_max=2005, sort_by='num_raters', ascending=False),
+    'three genres any, one year': dict(genres=['War', 'Western', 'Sport'], year_min=1999, year_max=1999),
+    'rating range, top raters': dict(rating_min=8.8, rating_max=9.0, sort_by='num_raters', ascending=False),
+    'raters range and genre': dict(genres=['Drama'], raters_min=2_000_000),
+    'everything by rating, page 3': dict(sort_by='rating', ascending=False, page=3),
+}
+
+# genre and year queries of the search page and summarize.py, against the partitions and against the whole file
+PARTITION_QUERIES = {
+    'one genre': {'genres': ['Horror']},
+    'two genres, any': {'genres': ['Horror', 'Sci-Fi']},
+    'two genres, all, one decade': {'genres': ['Comedy', 'Romance'], 'match': 'all', 'year_min': 1990, 'year_max': 1999},
+    'common genre, one decade': {'genres': ['Drama'], 'year_min': 2000, 'year_max': 2009},
+}
+
+def bench_partitions(rows, repeats=3, by_year=False):
+    # what a query costs a fresh process: loading the whole dataset and filtering it, or reading just the partitions
+    # the planner picks. both read typed files, the csv is parsed once up front for either
+    results = {'rows': rows, 'by_year': by_year, 'queries': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_clean_file(rows, directory)
+        df = load_dataset(path, shared=False)
+        store, results['write_s'] = timed(load_partitions, path, df, by_year)
+        del df
+        for name, query in PARTITION_QUERIES.items():
+            full_times, part_times = [], []
+            for _ in range(repeats):
+                full, elapsed = timed(lambda: filter_dataset(load_dataset(path, shared=False), **query))
+                full_times.append(elapsed)
+                part, elapsed = timed(lambda: store.query(**query))
+                part_times.append(elapsed)
+            plan = store.plan(**query)
+            results['queries'][name] = {'matches': len(part), 'same_rows': bool(np.array_equal(full.index, part.index)),
+                                        'partitions_read': len(plan.partitions), 'partitions': len(store.partitions),
+                                        'full_s': float(np.median(full_times)), 'partitions_s': float(np.median(part_times))}
+    return results
+
+def bench_query(rows, repeats=20):
+    df = prepare_dataset(make_clean_frame(rows))
+    index, build_time = timed(MovieIndex, df)
+    results = {'rows': rows, 'index_build_s': build_time, 'queries': {}}
+    for name, params in QUERIES.items():
+        times = []
+        for _ in range(repeats):
+            (total, _), elapsed = timed(lambda: index.query(page_size=50, **params))
+            times.append(elapsed)
+        results['queries'][name] = {'matches': total, 'median_ms': float(np.median(times)) * 1000}
+    return results
+
+def summary_extremes(df):
+    # what the summary read off the rows before the rank index: six argmax and argmin scans and two nlargest passes
+    extremes = [(df[column].to_numpy().argmax(), df[column].to_numpy().argmin()) for column in RANK_COLUMNS]
+    return extremes, [df.nlargest(5, column) for column in ('run_length', 'rating')]
+
+def ranked_extremes(ranks):
+    extremes = [(ranks.top(column, 1)[0], ranks.bottom(column, 1)[0]) for column in RANK_COLUMNS]
+    return extremes, [ranks.top(column, 5) for column in ('run_length', 'rating')]
+
+def bench_rank(rows, repeats=5):
+    # the top and bottom lists of the app and the summary, with a full sort or scan and with the presorted rank index
+    df = prepare_dataset(make_clean_frame(rows))
+    ranks, build_time = timed(RankIndex.from_frame, df)
+    cases = {
+        'top 10 by rating': (lambda: df.sort_values('rating', ascending=False).head(10), lambda: ranks.top('rating', 10)),
+        'bottom 10 by rating': (lambda: df.sort_values('rating').head(10), lambda: ranks.bottom('rating', 10)),
+        'summary extremes and top 5s': (lambda: summary_extremes(df), lambda: ranked_extremes(ranks)),
+        'top 10 Horror 2000-2010 by raters': (lambda: df[has_genre(df, 'Horror') & df['year'].between(2000, 2010)].nlargest(10, 'num_raters'),
+                                              lambda: ranks.top('num_raters', 10, genres=['Horror'], year_min=2000, year_max=2010)),
+        'bottom 10 Drama by rating': (lambda: df[has_genre(df, 'Drama')].nsmallest(10, 'rating'),
+                                      lambda: ranks.bottom('rating', 10, genres=['Drama'])),
+        'rank and percentile of one movie': (lambda: df['rating'].rank(method='min', ascending=False).iloc[rows // 2],
+                                             lambda: ranks.movie_ranks(rows // 2)),
+    }
+    results = {'rows': rows, 'index_build_s': build_time, 'cases': {}}
+    for name, (full, indexed) in cases.items():
+        times = {}
+        for label, func in (('full_ms', full), ('index_ms', indexed)):
+            times[label] = float(np.median([timed(func)[1] for _ in range(repeats)])) * 1000
+        results['cases'][name] = times
+    return results
+
+def profiled(func, *args, trace_memory=True, **kwargs):
+    # wall time, the peak python heap while func ran (numpy and pandas buffers included) and the process peak rss after it
+    # tracemalloc slows everything down a lot, so the time comes from a plain run and the heap peak from a second traced one
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    profile = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            profile['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    return result, profile
+
+# the genre searches the app used before the indexes, kept so we can compare against them
+def legacy_genre_search(df, genre):
+    return df[df['genres'].apply(lambda genres: genre in genres)]
+
+def legacy_genre_year_search(df, genre, year):
+    return df[(df['genres'].apply(lambda genres: genre in genres)) & (df['year'] == year)]
+
+def bench_suite(rows, work_dir, seed=0, trace_memory=True):
+    # the whole pipeline on synthetic data: generate, combine, clean, summarize, plot and search
+    steps = {}
+    def step(name, func, *args, **kwargs):
+        result, profile = profiled(func, *args, trace_memory=trace_memory, **kwargs)
+        steps[name] = profile
+        heap = f", heap peak {profile['peak_traced_mb']:8.1f} MB" if trace_memory else ""
+        rss = f", rss peak {profile['peak_rss_mb']:8.1f} MB" if profile['peak_rss_mb'] is not None else ""
+        print(f"{name:<45}: {profile['seconds']:8.2f}s{heap}{rss}")
+        return result
+
+    genre_dir = os.path.join(work_dir, '1_movies_per_genre')
+    combined = os.path.join(work_dir, 'combined.csv')
+    clean = os.path.join(work_dir, 'clean_movie_data.csv')
+
+    raw_rows = step('generate', generate, rows, genre_dir, seed=seed)
+    step('combine', combine, genre_dir, combined, force=True)
+    step('clean_data', clean_data, combined, clean)
+    step('clean_data_streaming', clean_data_streaming, combined, os.path.join(work_dir, 'clean_streamed.csv'))
+    step('load_clean_data (csv)', load_clean_data, clean, use_cache=False)
+    load_clean_data(clean) # writes the typed cache
+    df = step('load_dataset (cache)', load_dataset, clean)
+    cube = step('load_cube', load_cube, clean)
+    step('create_summary_txt', create_summary_txt, df, os.path.join(work_dir, 'movie_summary.txt'), cube)
+
+    # a cache with no room in it, so every call really draws and encodes
+    no_cache = RenderCache(0)
+    version = dataset_version(clean)
+    for plot_function in PLOT_FUNCTIONS:
+        data = cube if plot_function in CUBE_PLOTS else df
+        step(plot_function.__name__, render_figure, plot_function, data, version, cache=no_cache)
+
+    genre, year = 'Horror', 2008
+    step('search genre (legacy apply)', legacy_genre_search, df, genre)
+    step('search genre and year (legacy apply)', legacy_genre_year_search, df, genre, year)
+    index = step('MovieIndex build', MovieIndex, df)
+    step('search genre (index)', index.query, genres=[genre], page_size=None)
+    step('search genre and year (index)', index.query, genres=[genre], year_min=year, year_max=year, page_size=None)
+
+    return {
+        'rows_requested': rows,
+        'raw_rows': raw_rows,
+        'clean_rows': len(df),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'steps': steps,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the cleaning and loading steps")
+    parser.add_argument('--bench', choices=['parsing', 'load', 'query', 'rank', 'memory', 'app', 'render', 'reports', 'soak', 'shared', 'partitions', 'api', 'streaming', 'suite'], default='parsing')
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--legacy-rows', type=int, default=100_000)
+    parser.add_argument('--work-dir', default=None, help="where the suite writes its synthetic files, a temporary directory by default")
+    parser.add_argument('--output', default=None, help="write the results as json to this file")
+    parser.add_argument('--input', default='clean_movie_data.csv', help="clean file the render and soak benchmarks draw from")
+    parser.add_argument('--workers', type=int, default=DEFAULT_RENDER_WORKERS, help="figure drawing processes for the render benchmark")
+    parser.add_argument('--report-workers', type=int, default=DEFAULT_REPORT_WORKERS, help="report writing processes for the reports benchmark")
+    parser.add_argument('--processes', type=int, default=4, help="server processes for the shared dataset benchmark")
+    parser.add_argument('--pages', type=int, default=2000, help="analysis pages drawn by the soak benchmark")
+    parser.add_argument('--no-release', action='store_true', help="soak without releasing the figures, the way the app used to")
+    parser.add_argument('--requests', type=int, default=2000, help="requests of the warm api load test")
+    parser.add_argument('--concurrency', type=int, default=16, help="clients of the api load test")
+    parser.add_argument('--api-workers', type=int, default=DEFAULT_API_WORKERS, help="chart drawing processes of the api server")
+    parser.add_argument('--api-url', default=None, help="load test the api server running at this url instead of starting one")
+    parser.add_argument('--chunksize', type=int, default=None, help="rows read at a time by the streaming summary benchmark")
+    parser.add_argument('--by-year', action='store_true', help="split the partitions of the partitions benchmark by decade too")
+    parser.add_argument('--no-trace', action='store_true', help="skip the second tracemalloc run of every suite step")
+    args = parser.parse_args()
+
+    if args.bench == 'parsing':
+        results = bench_parsing(args.rows, args.legacy_rows)
+        print(f"Parsing benchmark at {results['rows']} rows (legacy timed on {results['legacy_rows_timed']} rows and scaled)")
+        print(f"run_length   : legacy {results['legacy_run_length_s']:.2f}s, vectorized {results['vectorized_run_length_s']:.2f}s, {results['speedup_run_length']:.0f}x faster")
+        print(f"release_date : legacy {results['legacy_release_date_s']:.2f}s, vectorized {results['vectorized_release_date_s']:.2f}s, {results['speedup_release_date']:.0f}x faster")
+    elif args.bench == 'load':
+        results = bench_load(args.rows)
+        print(f"Load benchmark at {results['rows']} rows")
+        print(f"csv + to_datetime : {results['csv_parse_s']:.2f}s")
+        print(f"typed cache build : {results['cache_build_s']:.2f}s")
+        print(f"typed cache load  : {results['cache_load_s']:.2f}s ({results['speedup_cache_load']:.0f}x faster)")
+        print(f"rating column only: {results['cache_load_rating_only_s']:.2f}s")
+    elif args.bench == 'query':
+        results = bench_query(args.rows)
+        print(f"Query benchmark at {results['rows']} rows, index built in {results['index_build_s']:.2f}s")
+        for name, query in results['queries'].items():
+            print(f"{name:<35}: {query['median_ms']:.3f} ms ({query['matches']} matches)")
+    elif args.bench == 'rank':
+        results = bench_rank(args.rows)
+        print(f"Rank benchmark at {results['rows']} rows, index built in {results['index_build_s']:.2f}s")
+        for name, times in results['cases'].items():
+            print(f"{name:<35}: full sort or scan {times['full_ms']:9.3f} ms, rank index {times['index_ms']:7.3f} ms")
+    elif args.bench == 'memory':
+        results = bench_memory(args.rows)
+        print(f"Memory benchmark at {results['rows']} rows")
+        for name, columns in (('csv types', results['legacy_columns']), ('schema', results['schema_columns'])):
+            print(f"{name}:")
+            for column, usage in columns.items():
+                print(f"  {column:<12} {usage['dtype']:<16} {usage['bytes_per_row']:6.1f} bytes per row")
+        print(f"total: {results['legacy_bytes'] / 2**20:.1f} MB with csv types, {results['schema_bytes'] / 2**20:.1f} MB with the schema ({results['reduction']:.1f}x smaller)")
+    elif args.bench == 'app':
+        results = bench_app()
+        print(f"sample.py latency (rerun is the median of {results['reruns']} reruns)")
+        for page, timing in results['pages'].items():
+            print(f"{page:<25}: cold start {timing['cold_s']:.2f}s, rerun {timing['rerun_s'] * 1000:.0f} ms, {timing['modules']} modules loaded")
+    elif args.bench == 'render':
+        results = bench_render(args.input, workers=args.workers)
+        print(f"Drawing the analysis page charts for {results['rows']} movies")
+        for name, seconds in results['figures_s'].items():
+            print(f"  {name:<32}: {seconds:.2f}s")
+        print(f"one after another : {results['serial_s']:.2f}s (slowest chart {results['slowest_figure_s']:.2f}s)")
+        print(f"{results['workers']} worker processes: {results['parallel_s']:.2f}s, {results['parallel_vs_slowest']:.1f}x the slowest chart "
+              f"({results['cpus']} cpus)")
+    elif args.bench == 'reports':
+        results = bench_reports(workers=args.report_workers)
+        print(f"Writing {results['reports']} genre, decade and year reports for {results['rows']} movies")
+        print(f"loading the file for every report : {results['one_by_one_s']:.2f}s (scaled from a few)")
+        print(f"batch, one process                : {results['batch_serial_s']:.2f}s")
+        print(f"batch, {results['workers']} worker processes        : {results['batch_parallel_s']:.2f}s")
+        print(f"batch, nothing changed            : {results['unchanged_s']:.2f}s")
+    elif args.bench == 'soak':
+        results = bench_soak(args.input, pages=args.pages, release=not args.no_release)
+        print(f"Drawing the analysis page {results['pages']} times for {results['rows']} movies, {results['page_s']:.2f}s a page, "
+              f"figures {'released' if results['released'] else 'left to the garbage collector'}")
+        print(f"rss after warming up  : {results['rss_after_warmup_mb']:.0f} MB")
+        print(f"rss range after that  : {results['rss_min_mb']:.0f} - {results['rss_max_mb']:.0f} MB")
+        print(f"highest rss per half  : {results['rss_max_first_half_mb']:.0f} MB then {results['rss_max_second_half_mb']:.0f} MB")
+        print(f"rss slope per half    : {results['rss_slope_first_half_mb_per_1000_pages']:+.1f} then "
+              f"{results['rss_slope_second_half_mb_per_1000_pages']:+.1f} MB per 1000 pages")
+    elif args.bench == 'shared':
+        results = bench_shared(args.rows, args.processes)
+        print(f"{results['processes']} processes holding {results['rows']} movies, published once in {results['publish_s']:.2f}s")
+        for label in ('private', 'shared'):
+            memory = results[label]
+            print(f"{label:<8}: {memory['pss_mb_total']:8.1f} MB for the host, rss {max(memory['rss_mb_each']):7.1f} MB "
+                  f"and pss {max(memory['pss_mb_each']):7.1f} MB per process, loaded in {memory['load_s']:.2f}s")
+    elif args.bench == 'partitions':
+        results = bench_partitions(args.rows, by_year=args.by_year)
+        print(f"Genre and year queries on {results['rows']} movies, partitions written in {results['write_s']:.2f}s")
+        for name, query in results['queries'].items():
+            print(f"{name:<30}: whole dataset {query['full_s']:.3f}s, {query['partitions_read']} of {query['partitions']} partitions "
+                  f"{query['partitions_s']:.3f}s ({query['matches']} matches{'' if query['same_rows'] else ', DIFFERENT ROWS'})")
+    elif args.bench == 'api':
+        results = bench_api(requests=args.requests, concurrency=args.concurrency, workers=args.api_workers, url=args.api_url)
+        print(f"Load test of {results['url']} with {results['concurrency']} clients")
+        for phase in ('cold', 'warm'):
+            load = results[phase]
+            cache = ', '.join(f"{count} {status}" for status, count in load['cache'].items())
+            print(f"{phase}: {load['requests']} requests in {load['seconds']:.2f}s, {load['throughput_rps']:.0f} requests/s, "
+                  f"p50 {load['p50_ms']:.1f} ms, p99 {load['p99_ms']:.1f} ms, {load['errors']} errors ({cache})")
+            for endpoint, times in load['endpoints'].items():
+                print(f"  /{endpoint:<8}: p50 {times['p50_ms']:8.1f} ms, p99 {times['p99_ms']:8.1f} ms over {times['requests']} requests")
+    elif args.bench == 'streaming':
+        results = bench_streaming(args.rows, args.chunksize)
+        print(f"movie_summary.txt from the whole frame and streamed in chunks of {results['chunksize']} rows")
+        for size, run in results['sizes'].items():
+            titles_error = run['distinct_titles_estimate'] / run['distinct_titles'] - 1
+            print(f"{size:>10} movies: whole frame {run['full_s']:6.2f}s {run['full_rss_mb']:7.0f} MB, "
+                  f"streaming {run['streaming_s']:6.2f}s {run['streaming_rss_mb']:7.0f} MB, {'same' if run['same_text'] else 'DIFFERENT'} text")
+            print(f"{'':>18}distinct titles {run['distinct_titles_estimate']} for {run['distinct_titles']} ({titles_error:+.2%}), "
+                  f"worst quantile rank error {run['quantile_rank_error']['rating']:.2%} rating, {run['quantile_rank_error']['run_length']:.2%} runtime")
+    elif args.bench == 'suite':
+        print(f"Pipeline benchmark on {args.rows} synthetic rows")
+        if args.work_dir is None:
+            with tempfile.TemporaryDirectory() as work_dir:
+                results = bench_suite(args.rows, work_dir, trace_memory=not args.no_trace)
+        else:
+            results = bench_suite(args.rows, args.work_dir, trace_memory=not args.no_trace)
+
+    if args.output:
+        results['bench'] = args.bench
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
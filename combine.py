@@ -1,10 +1,192 @@
-import pandas as pd
+import argparse
+import csv
 import glob
+import hashlib
+import json
 import os
-directory = 'C:/Users/mstut/desktop/Python/Movies Dataset/dataset/1_movies_per_genre'
-file_pattern = os.path.join(directory, '*.csv')
-csv_files = glob.glob(file_pattern)
-df = pd.concat((pd.read_csv(file) for file in csv_files), ignore_index = True)
-output_file = 'C:/Users/mstut/desktop/Python/Movies Dataset/combined.csv'
-df.to_csv(output_file, index = False)
-print(f"Combined {len(csv_files)} CSV files into {output_file}")
\ No newline at end of file
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from exceptions import FileHandlingError
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+directory = os.path.join(BASE_DIR, 'dataset', '1_movies_per_genre')
+output_file = os.path.join(BASE_DIR, 'combined.csv')
+
+# the columns every genre file is scraped with, in the order combined.csv keeps them
+RAW_COLUMNS = [
+    "name", "year", "movie_rated", "run_length", "genres",
+    "release_date", "rating", "num_raters", "num_reviews", "review_url"
+]
+
+# bytes copied at a time from a genre file into its part file, and from the part files into the combined file
+COPY_BLOCK = 1024 * 1024
+
+def manifest_path_for(output):
+    return output + '.manifest.json'
+
+def cache_dir_for(output):
+    # every genre file's rows (without header) are kept here so unchanged files never have to be read again
+    return output + '.parts'
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        raise FileHandlingError(f"Error reading combine manifest {path}: {e}")
+
+def save_manifest(manifest, path):
+    try:
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    except Exception as e:
+        raise FileHandlingError(f"Error writing combine manifest {path}: {e}")
+
+def file_is_unchanged(path, entry, cache_dir):
+    # size and mtime are enough to skip a file, the hash is only there to notice files that were touched but not changed
+    if entry is None or not os.path.exists(os.path.join(cache_dir, entry['part'])):
+        return False
+    stat = os.stat(path)
+    return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+class PartWriter:
+    # where shutil.copyfileobj writes the rows of a genre file: hashes the bytes as they go by, turns CRLF line ends
+    # into the LF of the combined header and counts the rows, so the file is only read once and never held in memory
+    def __init__(self, out, digest):
+        self.out = out
+        self.digest = digest
+        self.rows = 0
+        self.carried_cr = False # a block that ends between the CR and the LF of a line end
+        self.last_byte = b'\n'
+
+    def write(self, block):
+        self.digest.update(block)
+        if self.carried_cr:
+            block = b'\r' + block
+        self.carried_cr = block.endswith(b'\r')
+        if self.carried_cr:
+            block = block[:-1]
+        self._write(block.replace(b'\r\n', b'\n'))
+
+    def _write(self, block):
+        if block:
+            self.out.write(block)
+            self.rows += block.count(b'\n')
+            self.last_byte = block[-1:]
+
+    def close(self):
+        if self.carried_cr:
+            self._write(b'\n') # a file ending in a lone CR
+        elif self.last_byte != b'\n':
+            self._write(b'\n') # the last row had no line end, the next file's rows would run into it
+
+def process_genre_file(path, cache_dir):
+    # runs in a worker process, turns one genre file into a header-less part file and returns its manifest entry
+    try:
+        # before reading, a file that changes while it is read then looks changed on the next run too
+        stat = os.stat(path)
+        part = os.path.basename(path)
+        digest = hashlib.sha256()
+
+        with open(path, 'rb') as f, open(os.path.join(cache_dir, part), 'wb') as out:
+            header_line = f.readline()
+            header = next(csv.reader([header_line.decode('utf-8-sig')]), [])
+
+            if header == RAW_COLUMNS:
+                # same columns in the same order so the rows are copied through, only their line ends change
+                digest.update(header_line)
+                writer = PartWriter(out, digest)
+                shutil.copyfileobj(f, writer, COPY_BLOCK)
+                writer.close()
+                rows = writer.rows
+                mode = 'passthrough'
+            else:
+                # different layout, going through pandas to line the columns up with the others
+                f.seek(0)
+                digest = hashlib.file_digest(f, 'sha256')
+                f.seek(0)
+                df = pd.read_csv(f).reindex(columns=RAW_COLUMNS)
+                df.to_csv(out, index=False, header=False, lineterminator='\n')
+                rows = len(df)
+                mode = 'reindexed'
+
+        return path, {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': digest.hexdigest(),
+            'part': part,
+            'rows': rows, # lets the cleaning step tell which genre file a row of the combined file came from
+            'mode': mode,
+        }
+    except Exception as e:
+        raise FileHandlingError(f"Error combining {path}: {e}")
+
+def combine(input_dir=directory, output=output_file, workers=None, force=False):
+    csv_files = sorted(glob.glob(os.path.join(input_dir, '*.csv')))
+    if not csv_files:
+        raise FileHandlingError(f"No CSV files found in {input_dir}")
+
+    manifest_path = manifest_path_for(output)
+    cache_dir = cache_dir_for(output)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    manifest = {} if force else load_manifest(manifest_path)
+    files = manifest.get('files', {})
+
+    # only new or changed genre files are read again
+    changed = [path for path in csv_files if not file_is_unchanged(path, files.get(os.path.relpath(path, input_dir)), cache_dir)]
+
+    content_changed = False
+    if changed:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path, entry in pool.map(process_genre_file, changed, [cache_dir] * len(changed)):
+                key = os.path.relpath(path, input_dir)
+                old = files.get(key)
+                if old is not None and old['sha256'] == entry['sha256']:
+                    print(f"{key} was touched but its contents did not change")
+                else:
+                    content_changed = True
+                files[key] = entry
+
+    # forgetting genre files that were deleted
+    current = {os.path.relpath(path, input_dir) for path in csv_files}
+    for key in list(files):
+        if key not in current:
+            stale_part = os.path.join(cache_dir, files.pop(key)['part'])
+            if os.path.exists(stale_part):
+                os.remove(stale_part)
+
+    if not content_changed and os.path.exists(output) and manifest.get('files_in_output') == sorted(current):
+        save_manifest({'files': files, 'files_in_output': sorted(current)}, manifest_path)
+        print(f"{os.path.basename(output)} is up to date, none of the {len(csv_files)} CSV files changed")
+        return
+
+    # stitching the part files together, this is a plain byte copy
+    try:
+        with open(output, 'wb') as out:
+            out.write((','.join(RAW_COLUMNS) + '\n').encode())
+            for key in sorted(current):
+                with open(os.path.join(cache_dir, files[key]['part']), 'rb') as part:
+                    while block := part.read(COPY_BLOCK):
+                        out.write(block)
+    except Exception as e:
+        raise FileHandlingError(f"Error writing {output}: {e}")
+
+    save_manifest({'files': files, 'files_in_output': sorted(current)}, manifest_path)
+    print(f"Combined {len(csv_files)} CSV files into {output} ({len(changed)} read again)")
+
+def main():
+    parser = argparse.ArgumentParser(description="combine the per genre CSV files into combined.csv")
+    parser.add_argument('--input-dir', default=directory)
+    parser.add_argument('--output', default=output_file)
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes, defaults to the number of cores")
+    parser.add_argument('--force', action='store_true', help="ignore the manifest and read every file again")
+    args = parser.parse_args()
+
+    combine(args.input_dir, args.output, args.workers, args.force)
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,387 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
 import pandas as pd
 from exceptions import DataCleaningError, MissingColumnError, FileHandlingError
-from file_handling import load_clean_data, save_clean_data
+from file_handling import (load_clean_data, save_clean_data, load_raw_chunks, source_fingerprint,
+                           cache_path_for, read_cache, write_cache, apply_clean_dtypes)
+from combine import directory as GENRE_DIR, RAW_COLUMNS
+from aggregate_cube import AggregateCube, cube_path_for, save_cube
+from rank_index import RankIndex, save_ranks
+import instrumentation
+from instrumentation import instrumented, stage
+from dedup import DEDUP_POLICIES, RowHashSet, dedup_state_bytes, MovieWinners, DropCounter, movie_keys, policy_scores, is_winner, dedup_movies, print_dedup_report
 
-def clean_data():
-    def clean_genre_data(genre_list):
-        # removing any empty strings and strip whitespaces from genres
-        cleaned_genres = [genre.strip() for genre in genre_list if genre.strip()]
-        return ', '.join(cleaned_genres)
+# imdb runtimes look like "2h 32min", "2h" or "45min"
+RUNTIME_PATTERN = r'^\s*(?:(?P<hours>\d+)h)?\s*(?:(?P<minutes>\d+)min)?\s*$'
 
+# imdb release dates look like "18 July 2008 (USA)", we only want the part before the bracket
+RELEASE_DATE_FORMAT = '%d %B %Y'
+
+def parse_unique(series, parser):
+    # factorizing so every distinct string is parsed only once, then mapping the results back to the rows
+    codes, uniques = pd.factorize(series)
+    if len(uniques) == 0:
+        # every value is missing, there is nothing to take from but the parser still picks the dtype
+        return parser(pd.Series([None] * len(series), index=series.index, dtype=object))
+    parsed = parser(pd.Series(uniques, dtype=object))
+    result = parsed.take(codes.clip(min=0)).reset_index(drop=True)
+    result[codes == -1] = None # missing values stay missing
+    result.index = series.index
+    return result
+
+def _parse_run_length_values(values):
+    is_str = values.map(lambda value: isinstance(value, str)).astype(bool)
+    parts = values.where(is_str).astype('string').str.extract(RUNTIME_PATTERN)
+    hours = pd.to_numeric(parts['hours']).astype('Int64')
+    minutes = pd.to_numeric(parts['minutes']).astype('Int64')
+    # a runtime needs at least the hours or the minutes part
+    matched = hours.notna() | minutes.notna()
+    total_minutes = hours.fillna(0) * 60 + minutes.fillna(0)
+    return total_minutes.where(matched, pd.NA)
+
+def _parse_release_date_values(values):
+    is_str = values.map(lambda value: isinstance(value, str)).astype(bool)
+    date_part = values.where(is_str).astype('string').str.split('(').str[0].str.strip()
+    return pd.to_datetime(date_part, format=RELEASE_DATE_FORMAT, errors='coerce')
+
+# vectorized replacement for the old row by row runtime conversion, returns nullable integer minutes
+def parse_run_length(series):
+    return parse_unique(series, _parse_run_length_values)
+
+# vectorized replacement for the old row by row pd.to_datetime calls
+def parse_release_date(series):
+    return parse_unique(series, _parse_release_date_values)
+
+REQUIRED_COLUMNS = [
+    "name", "year", "movie_rated", "run_length", "genres", 
+    "release_date", "rating", "num_raters", "num_reviews"
+]
+
+CLEAN_COLUMNS = ['name', 'rel_date', 'genres', 'rating', 'run_length', 'num_raters']
+
+# rough number of copies of a chunk that are alive at once while it is being cleaned
+CHUNK_COPY_FACTOR = 4
+
+# how many bytes before the last processed offset of a genre file we remember, to notice files that were rewritten
+SIGNATURE_BLOCK = 4096
+
+# raw rows read at a time in incremental mode
+INCREMENTAL_CHUNK_ROWS = 100_000
+
+def clean_genre_data(genre_list):
+    # removing any empty strings and strip whitespaces from genres
+    cleaned_genres = [genre.strip() for genre in genre_list if genre.strip()]
+    return ', '.join(cleaned_genres)
+
+def check_required_columns(df):
+    # check for missing required columns and raising exception
+    for col in REQUIRED_COLUMNS:
+        if col not in df.columns:
+            raise MissingColumnError(f"Missing required column: {col}")
+
+def clean_frame(df):
+    # dropping unnecessary columns, the index is kept so the rows can be matched to their movie keys afterwards
+    df = df.drop(['review_url', 'num_reviews', 'movie_rated', 'year'], axis=1, errors='ignore')
+
+    # converting run_length to minutes and release_date to datetime in bulk
+    with stage('clean_frame.run_length', len(df)):
+        df['run_length'] = parse_run_length(df['run_length'])
+    with stage('clean_frame.release_date', len(df)):
+        df['rel_date'] = parse_release_date(df['release_date'])
+    
+    # dropping the original release_date column
+    df.drop(['release_date'], axis=1, inplace=True)
+    
+    # cleaning genres column 
+    with stage('clean_frame.genres', len(df)):
+        df['genres'] = df['genres'].str.split(';').apply(clean_genre_data)
+
+    with stage('clean_frame.dropna') as current:
+        df.dropna(inplace=True)
+        current.rows = len(df)
+    
+    # reordering columns
+    return df.reindex(columns=CLEAN_COLUMNS)
+
+def clean_with_keys(chunk):
+    # cleans a raw chunk and returns the movie key of every row that survived, duplicates are only dropped
+    # after cleaning so a broken copy of a movie never wins over a good one
+    with stage('clean_with_keys.movie_keys', len(chunk)):
+        keys = movie_keys(chunk)
+    clean_chunk = clean_frame(chunk)
+    return clean_chunk, keys[chunk.index.get_indexer(clean_chunk.index)]
+
+def read_typed_chunks(source, chunksize):
+    # every column is read as text, the two numeric ones the policies and plots need are converted right away
+    for chunk in load_raw_chunks(source, chunksize):
+        chunk['rating'] = pd.to_numeric(chunk['rating'], errors='coerce')
+        chunk['num_raters'] = pd.to_numeric(chunk['num_raters'], errors='coerce')
+        yield chunk
+
+def chunk_rows_for_budget(filename, memory_budget_mb, policy='first', sample_rows=1000):
+    # measuring how big a parsed row is on a small sample and sizing chunks so a chunk and its copies fit in the budget,
+    # next to the keys kept to find duplicates, which grow with the file and are sized for one movie per row
+    sample = pd.read_csv(filename, nrows=sample_rows, dtype=str)
+    if sample.empty:
+        raise DataCleaningError("Data is empty.")
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+
+    with open(filename, 'rb') as f:
+        sample_lines = [len(line) for _, line in zip(range(sample_rows + 1), f)]
+    estimated_rows = int(os.path.getsize(filename) / (sum(sample_lines) / len(sample_lines)))
+    state_bytes = dedup_state_bytes(policy, estimated_rows)
+
+    chunk_rows = int((memory_budget_mb * 1024 * 1024 - state_bytes) / (bytes_per_row * CHUNK_COPY_FACTOR))
+    if chunk_rows < 1:
+        raise DataCleaningError(f"A memory budget of {memory_budget_mb} MB is too small for {filename}, finding the duplicates "
+                                f"among its {estimated_rows} rows alone can take {state_bytes / 1024 / 1024:.0f} MB")
+    return chunk_rows
+
+@instrumented(name='data_cleaning.clean_data_streaming')
+def clean_data_streaming(source="combined.csv", output="clean_movie_data.csv", memory_budget_mb=256, chunksize=None, policy='first'):
+    try:
+        if policy not in DEDUP_POLICIES:
+            raise DataCleaningError(f"Unknown dedup policy {policy}, choose one of {DEDUP_POLICIES}")
+        if chunksize is None:
+            chunksize = chunk_rows_for_budget(source, memory_budget_mb, policy)
+        print(f"Cleaning {source} in chunks of {chunksize} rows")
+
+        # the first copy can be picked as the rows go by, any other policy needs a first pass to find the winners
+        # the chunks keep counting their index from the top of the file, so the index is the row position in the file
+        winners = None
+        if policy != 'first':
+            candidates = MovieWinners()
+            for chunk in read_typed_chunks(source, chunksize):
+                clean_chunk, keys = clean_with_keys(chunk)
+                candidates.add(keys, *policy_scores(clean_chunk, policy, clean_chunk.index), clean_chunk.index)
+            winners = candidates.winning_positions()
+
+        seen = RowHashSet()
+        dropped = DropCounter(source)
+        cube = AggregateCube.empty()
+        total_rows = 0
+        written_rows = 0
+        for i, chunk in enumerate(read_typed_chunks(source, chunksize)):
+            if i == 0:
+                check_required_columns(chunk)
+            total_rows += len(chunk)
+
+            clean_chunk, keys = clean_with_keys(chunk)
+            with stage('clean_data_streaming.dedup', len(clean_chunk)):
+                keep = seen.filter_new(keys) if winners is None else is_winner(clean_chunk.index, winners)
+                dropped.add(clean_chunk.index[~keep])
+                clean_chunk = clean_chunk[keep]
+
+            save_clean_data(clean_chunk, output, append=i > 0, verbose=False)
+            written_rows += len(clean_chunk)
+            with stage('clean_data_streaming.cube', len(clean_chunk)):
+                cube = cube.merge(AggregateCube.from_frame(clean_chunk))
+
+        if total_rows == 0:
+            raise DataCleaningError("Data is empty.")
+
+        save_cube(cube, output)
+        print_dedup_report(dropped.result(total_rows), policy)
+        print(f"Cleaned {total_rows} rows into {written_rows} rows, saved to {output}")
+
+    except FileNotFoundError as e:
+        raise FileHandlingError(f"An error occurred : File not found - {e}")
+
+    except Exception as e:
+        raise FileHandlingError(f"An error occurred : {e}")
+
+def state_path_for(output):
+    return output + '.state.json'
+
+def keys_path_for(output):
+    return output + '.keys.npy'
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        raise FileHandlingError(f"Error reading cleaning state {path}: {e}")
+
+def save_state(state, path):
+    try:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        raise FileHandlingError(f"Error writing cleaning state {path}: {e}")
+
+def signature_before(f, offset):
+    # hash of the bytes just before offset, if they changed the file was rewritten and not just appended to
+    f.seek(max(0, offset - SIGNATURE_BLOCK))
+    return hashlib.blake2b(f.read(offset - max(0, offset - SIGNATURE_BLOCK)), digest_size=16).hexdigest()
+
+def complete_rows_end(f, size):
+    # offset just after the last newline, a row that is still being written is left for the next run
+    position = size
+    while position > 0:
+        start = max(0, position - SIGNATURE_BLOCK)
+        f.seek(start)
+        block = f.read(position - start)
+        newline = block.rfind(b'\n')
+        if newline != -1:
+            return start + newline + 1
+        position = start
+    return 0
+
+class ByteRange:
+    # file-like view of bytes [start, end) of an open file, so pandas parses only the new rows
+    def __init__(self, f, start, end):
+        f.seek(start)
+        self.f = f
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+def read_new_rows(path, entry, chunksize=INCREMENTAL_CHUNK_ROWS):
+    # yields the rows of a genre file that were not processed yet as text chunks, then the new state entry for the file
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = 0
+        if entry is not None and entry['offset'] <= size and signature_before(f, entry['offset']) == entry['signature']:
+            start = entry['offset']
+        elif entry is not None:
+            print(f"{os.path.basename(path)} was rewritten, reading all of it again")
+
+        end = complete_rows_end(f, size)
+        columns = entry['columns'] if start > 0 else None
+        if end > start:
+            # the header is only part of the range when the file is read from the top
+            reader = pd.read_csv(ByteRange(f, start, end), chunksize=chunksize, dtype=str,
+                                 header=None if columns else 'infer', names=columns)
+            for chunk in reader:
+                columns = [str(col).lstrip('\ufeff') for col in chunk.columns]
+                chunk.columns = columns
+                yield chunk
+
+        yield {'offset': max(start, end), 'signature': signature_before(f, max(start, end)), 'columns': columns}
+
+@instrumented(name='data_cleaning.clean_data_incremental')
+def clean_data_incremental(input_dir=GENRE_DIR, output="clean_movie_data.csv", full=False, chunksize=INCREMENTAL_CHUNK_ROWS, policy='first'):
+    # cleans only the rows appended to the genre files since the last run and appends them to the clean file
+    # rows that were removed from a genre file stay in the clean file until a run with full=True
+    try:
+        # rows already in the clean file are never rewritten, so only the first copy of a movie can win
+        if policy != 'first':
+            raise DataCleaningError(f"Incremental cleaning only supports the 'first' dedup policy, not {policy}")
+
+        csv_files = sorted(glob.glob(os.path.join(input_dir, '*.csv')))
+        if not csv_files:
+            raise FileHandlingError(f"No CSV files found in {input_dir}")
+
+        state_path = state_path_for(output)
+        keys_path = keys_path_for(output)
+        state = {} if full else load_state(state_path)
+
+        # the state only holds for the clean file it was saved with, anything else means starting over
+        if not os.path.exists(output) or state.get('output_fingerprint') != source_fingerprint(output) or state.get('dedup') != 'movie_key':
+            print(f"No cleaning state for {output}, cleaning everything")
+            state = {'files': {}, 'dedup': 'movie_key'}
+            seen = RowHashSet()
+            save_clean_data(pd.DataFrame(columns=CLEAN_COLUMNS), output, verbose=False)
+        else:
+            seen = RowHashSet.load(keys_path)
+
+        files = state['files']
+
+        # the typed cache and the aggregate cube of the clean file are extended with the new rows instead of being rebuilt
+        cache_path = cache_path_for(output)
+        cached = read_cache(cache_path, source_fingerprint(output))
+        cube = AggregateCube.load(cube_path_for(output), source_fingerprint(output))
+        if cube is None and not files:
+            cube = AggregateCube.empty() # starting over, the clean file is empty
+        new_frames = []
+
+        new_rows = 0
+        added_rows = 0
+        dropped = {}
+        for path in csv_files:
+            key = os.path.relpath(path, input_dir)
+            for item in read_new_rows(path, files.get(key), chunksize):
+                if isinstance(item, dict):
+                    files[key] = item
+                    continue
+                check_required_columns(item) # before the reindex, which would fill a missing column with NaN
+                chunk = item.reindex(columns=RAW_COLUMNS)
+                new_rows += len(chunk)
+
+                chunk['rating'] = pd.to_numeric(chunk['rating'], errors='coerce')
+                chunk['num_raters'] = pd.to_numeric(chunk['num_raters'], errors='coerce')
+                clean_chunk, keys = clean_with_keys(chunk)
+                with stage('clean_data_incremental.dedup', len(clean_chunk)):
+                    keep = seen.filter_new(keys)
+                    dropped[key] = dropped.get(key, 0) + int((~keep).sum())
+                    clean_chunk = clean_chunk[keep]
+                if clean_chunk.empty:
+                    continue
+                save_clean_data(clean_chunk, output, append=True, verbose=False)
+                added_rows += len(clean_chunk)
+                if cached is not None:
+                    new_frames.append(clean_chunk)
+                if cube is not None:
+                    with stage('clean_data_incremental.cube', len(clean_chunk)):
+                        cube = cube.merge(AggregateCube.from_frame(clean_chunk))
+
+        if cached is not None and new_frames:
+            write_cache(apply_clean_dtypes(pd.concat([cached, *new_frames], ignore_index=True)), cache_path, source_fingerprint(output))
+        if cube is not None:
+            save_cube(cube, output)
+
+        seen.save(keys_path)
+        state['output_fingerprint'] = source_fingerprint(output)
+        save_state(state, state_path)
+        print_dedup_report(dropped, policy)
+        print(f"Cleaned {new_rows} new rows from {len(csv_files)} genre files, added {added_rows} rows to {output}")
+        return added_rows
+
+    except FileNotFoundError as e:
+        raise FileHandlingError(f"An error occurred : File not found - {e}")
+
+    except FileHandlingError:
+        raise
+
+    except Exception as e:
+        raise FileHandlingError(f"An error occurred : {e}")
+
+@instrumented(name='data_cleaning.clean_data')
+def clean_data(source="combined.csv", output="clean_movie_data.csv", policy='first'):
     try:
         # loading raw data
-        df = load_clean_data("combined.csv")
+        df = load_clean_data(source, use_cache=False)
         print("Data loaded successfully!")
 
         # raising custom exception if data is empty
         if df.empty:
             raise DataCleaningError("Data is empty.")
+        total_rows = len(df)
 
-        # list of required columns in raw data so we can check it
-        required_columns = [
-            "name", "year", "movie_rated", "run_length", "genres", 
-            "release_date", "rating", "num_raters", "num_reviews"
-        ]
-        
-        # check for missing required columns and raising exception
-        for col in required_columns:
-            if col not in df.columns:
-                raise MissingColumnError(f"Missing required column: {col}")
-        
-        # dropping duplicate rows
-        df.drop_duplicates(inplace=True)
-        
-        # dropping unnecessary columns
-        df.drop(['review_url', 'num_reviews', 'movie_rated', 'year'], axis=1, inplace=True, errors='ignore')
-        
-        # function to convert run_length to minutes
-        def convert_runtime_to_minutes(runtime_str):
-            if isinstance(runtime_str, str):
-                try:
-                    hours, minutes = runtime_str.split('h ')
-                    hours = int(hours)
-                    minutes = int(minutes.replace('min', ''))
-                    total_minutes = hours * 60 + minutes
-                    return total_minutes
-                except ValueError:
-                    return pd.NA
-            else:
-                return pd.NA
-        
-        df['run_length'] = df['run_length'].apply(convert_runtime_to_minutes)
-        
-        # function to convert release_date to datetime
-        def convert_release_date(date_str):
-            if isinstance(date_str, str):
-                date_part = date_str.split('(')[0].strip()
-                return pd.to_datetime(date_part, format='%d %B %Y', errors='coerce')
-            else:
-                return pd.NaT
-        
-        # calling the date conversion function
-        df['rel_date'] = df['release_date'].apply(convert_release_date)
-
-        df['rel_date'] = pd.to_datetime(df['rel_date'], errors='coerce') 
-        
-        # dropping the original release_date column
-        df.drop(['release_date'], axis=1, inplace=True)
-        
-        # cleaning genres column 
-        df['genres'] = df['genres'].str.split(';').apply(clean_genre_data)
+        check_required_columns(df)
 
-        df.dropna(inplace=True)
-        
-        # reordering columns
-        new_columns_order = ['name', 'rel_date', 'genres', 'rating', 'run_length', 'num_raters']
-        df = df.reindex(columns=new_columns_order)
+        # one row per movie, keyed on the imdb title id so copies from different genre files or scrapes are caught too
+        df, keys = clean_with_keys(df)
+        with stage('clean_data.dedup', len(df)) as current:
+            keep = dedup_movies(df, keys, policy)
+            dropped = DropCounter(source)
+            dropped.add(df.index[~keep])
+            print_dedup_report(dropped.result(total_rows), policy)
+            df = df[keep]
+            current.rows = len(df)
         
         # display the first few rows of the cleaned DataFrame
         print(df.head())
@@ -82,13 +390,43 @@ def clean_data():
         print("Data cleaned successfully!")
 
         # saving clean files now
-        save_clean_data(df, "clean_movie_data.csv")
+        save_clean_data(df, output)
         print("Cleaned data saved successfully !")
 
+        # the per year and genre counts and sums the charts and summary read, kept next to the clean file
+        with stage('clean_data.cube', len(df)):
+            save_cube(AggregateCube.from_frame(df), output)
+        # and the presorted orders for the top and bottom movies, the streaming and incremental modes leave it to load_ranks
+        with stage('clean_data.ranks', len(df)):
+            save_ranks(RankIndex.from_frame(df), output)
+
     except FileNotFoundError as e:
         raise FileHandlingError(f"An error occurred : File not found - {e}")
 
     except Exception as e:
         raise FileHandlingError(f"An error occurred : {e}")
 
-clean_data()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="clean combined.csv into clean_movie_data.csv")
+    parser.add_argument('--stream', action='store_true', help="clean the raw file in chunks instead of loading it all at once")
+    parser.add_argument('--memory-budget-mb', type=int, default=256, help="memory budget used to size the chunks in streaming mode")
+    parser.add_argument('--incremental', action='store_true', help="clean only the rows added to the genre files since the last incremental run")
+    parser.add_argument('--full', action='store_true', help="with --incremental, forget the saved state and clean everything again")
+    parser.add_argument('--dedup-policy', choices=DEDUP_POLICIES, default='first',
+                        help="which copy of a movie found more than once is kept (incremental mode only supports first)")
+    parser.add_argument('--profile', metavar='TRACE_JSON', default=None, help="time every stage and write the trace to this file")
+    parser.add_argument('--profile-memory', action='store_true', help="with --profile, also measure the peak heap of every stage (slower)")
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable(memory=args.profile_memory, trace_path=args.profile)
+
+    if args.incremental:
+        clean_data_incremental(full=args.full, policy=args.dedup_policy)
+    elif args.stream:
+        clean_data_streaming(memory_budget_mb=args.memory_budget_mb, policy=args.dedup_policy)
+    else:
+        clean_data(policy=args.dedup_policy)
+
+    if instrumentation.enabled():
+        instrumentation.print_summary()
@@ -0,0 +1,67 @@
+import os
+import threading
+import pandas as pd
+from file_handling import load_clean_data, source_fingerprint
+from genre_index import add_genre_index
+from shared_dataset import load_shared, shared_available
+from exceptions import FileHandlingError
+from instrumentation import instrumented
+
+# the columns of the clean file, without the ones we derive when loading
+CLEAN_COLUMNS = ['name', 'rel_date', 'genres', 'rating', 'run_length', 'num_raters']
+
+# release years fit in 16 bits and stay plain integers so decades and year ranges are simple arithmetic
+YEAR_DTYPE = 'int16'
+
+# one prepared dataset per file for the whole process, keyed by path and remembered with the fingerprint it was built from
+_datasets = {}
+_lock = threading.Lock()
+
+def _new_lock():
+    # a forked figure worker starts with a free lock, another thread may have been loading when it was forked
+    global _lock
+    _lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_new_lock)
+
+def movie_years(df):
+    # using the year column when the dataset already has one, otherwise working it out from rel_date without touching df
+    if 'year' in df.columns:
+        return df['year']
+    # making sure rel_date is datetime type because for some reason it does not like staying that way even after doing it in data cleaning
+    return pd.to_datetime(df['rel_date'], errors='coerce').dt.year
+
+def prepare_dataset(df):
+    # deriving everything the app needs once, after this the frame is only ever read
+    df['year'] = df['rel_date'].dt.year.astype(YEAR_DTYPE)
+    return add_genre_index(df)
+
+@instrumented
+def load_dataset(filename="clean_movie_data.csv", shared=None):
+    # the prepared dataset, mapped from the copy published for every process of the host when the shared dataset is
+    # on (the default when pyarrow is there). a mapped frame is read only, which the app and the workers never mind
+    if shared is None:
+        shared = shared_available()
+    if not shared:
+        return prepare_dataset(load_clean_data(filename))
+    return load_shared(filename, dataset_version(filename), lambda: prepare_dataset(load_clean_data(filename)))
+
+def dataset_version(filename="clean_movie_data.csv"):
+    try:
+        return source_fingerprint(filename)
+    except FileNotFoundError as e:
+        raise FileHandlingError(f"File {filename} not found: {str(e)}")
+
+def get_dataset(filename="clean_movie_data.csv"):
+    # returns the shared read-only dataset, loading it again only when the file changed
+    # callers must not modify the frame they get back, the plotting functions only read it
+    path = os.path.abspath(filename)
+    version = dataset_version(path)
+    with _lock:
+        cached = _datasets.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        df = load_dataset(path)
+        _datasets[path] = (version, df)
+        return df
@@ -0,0 +1,213 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# the imdb title id inside review_url, "https://www.imdb.com/title/tt0468569/reviews/..." -> 468569
+TITLE_ID_PATTERN = r'/title/tt(\d+)'
+
+# which copy of a movie is kept: the first one in the input, the last one or the one with the most raters
+# first and last go by file order, combine.py puts the genre files in order of their names so the last copy is the
+# one in the genre file whose name sorts last (or further down the same file), not the most recent scrape
+DEDUP_POLICIES = ['first', 'last', 'most_raters']
+
+# keys made from name and year have the top bit set so they can never be mistaken for a title id
+FALLBACK_BIT = np.uint64(1 << 63)
+
+# pending candidates are folded into the winners once there are this many, so memory follows the number of movies
+COMPACT_ROWS = 1_000_000
+
+# the most memory the dedup state of the streaming mode takes per movie, measured while it merges its sorted arrays:
+# the 8 byte keys and one copy of them for the first policy, the 32 bytes of a winner and the copies made while
+# compacting for the others
+ROW_HASH_PEAK_BYTES = 24
+WINNER_PEAK_BYTES = 128
+
+def movie_keys(df):
+    # one 64 bit key per row: the imdb title id, or a hash of the normalized name and year when there is no id
+    urls = df['review_url'].astype('string') if 'review_url' in df.columns else pd.Series(pd.NA, index=df.index, dtype='string')
+    ids = pd.to_numeric(urls.str.extract(TITLE_ID_PATTERN, expand=False), errors='coerce')
+    has_id = ids.notna().to_numpy()
+
+    keys = np.empty(len(df), dtype=np.uint64)
+    keys[has_id] = ids[has_id].to_numpy().astype(np.uint64)
+    if not has_id.all():
+        missing = df[~has_id]
+        name_year = pd.DataFrame({
+            'name': missing['name'].astype('string').str.strip().str.casefold(),
+            'year': missing['year'].astype('string').str.strip(),
+        })
+        keys[~has_id] = pd.util.hash_pandas_object(name_year, index=False).to_numpy() | FALLBACK_BIT
+    return keys
+
+def dedup_state_bytes(policy, movies):
+    # how much memory keeping track of this many movies can take at most, so a memory budget can leave room for it
+    return movies * (ROW_HASH_PEAK_BYTES if policy == 'first' else WINNER_PEAK_BYTES)
+
+def policy_scores(df, policy, positions):
+    # (score, tiebreak) for every row, the copy with the highest score wins and the tiebreak decides between equal scores
+    if policy not in DEDUP_POLICIES:
+        raise ValueError(f"Unknown dedup policy {policy}, choose one of {DEDUP_POLICIES}")
+    positions = np.asarray(positions, dtype=np.int64)
+    if policy == 'first':
+        return np.zeros(len(positions)), -positions
+    if policy == 'last':
+        return np.zeros(len(positions)), positions
+    raters = pd.to_numeric(df['num_raters'], errors='coerce').fillna(-1).to_numpy(dtype=float)
+    return raters, -positions # most raters, and the earlier copy on a tie
+
+# keeps the 64 bit keys of every movie seen so far as a few sorted numpy arrays instead of a python set,
+# so each movie only costs 8 bytes no matter how wide its rows are. the runs never share a key, so merging them is a
+# concatenation sorted in place and takes one extra copy of the keys at its peak (ROW_HASH_PEAK_BYTES per movie)
+class RowHashSet:
+    def __init__(self, max_runs=8):
+        self.runs = []
+        self.max_runs = max_runs
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            positions = np.searchsorted(run, hashes).clip(max=len(run) - 1)
+            found |= run[positions] == hashes
+        return found
+
+    def add(self, hashes):
+        hashes = np.unique(np.asarray(hashes, dtype=np.uint64))
+        self._add_run(hashes[~self.contains(hashes)])
+
+    def _add_run(self, run):
+        # run is sorted and holds no key the set already has
+        if len(run) == 0:
+            return # an empty run would break the lookups, there is no last key to clip to
+        self.runs.append(run)
+        # merging the sorted runs once there are too many so lookups stay cheap
+        if len(self.runs) > self.max_runs:
+            self._merge()
+
+    def _merge(self):
+        if len(self.runs) > 1:
+            merged = np.concatenate(self.runs)
+            self.runs = [] # the old runs can go as soon as they are copied
+            merged.sort()
+            self.runs = [merged]
+
+    def save(self, path):
+        # one merged sorted array, 8 bytes per key ever seen
+        self._merge()
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, self.runs[0] if self.runs else np.empty(0, dtype=np.uint64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        hashes = cls()
+        if os.path.exists(path):
+            run = np.load(path)
+            if len(run):
+                hashes.runs = [run]
+        return hashes
+
+    def filter_new(self, hashes):
+        # returns a mask of hashes that were never seen before (also dropping repeats inside the batch) and remembers them
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        _, first = np.unique(hashes, return_index=True)
+        is_new = np.zeros(len(hashes), dtype=bool)
+        is_new[first] = True
+        is_new &= ~self.contains(hashes)
+        self._add_run(np.sort(hashes[is_new]))
+        return is_new
+
+# the winning copy of every movie seen so far, as parallel numpy arrays sorted by key (about 32 bytes per movie)
+# candidates are added chunk by chunk, so a policy like most_raters works on inputs that never fit in memory
+class MovieWinners:
+    def __init__(self, compact_rows=COMPACT_ROWS):
+        self.compact_rows = compact_rows
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.scores = np.empty(0, dtype=float)
+        self.tiebreaks = np.empty(0, dtype=np.int64)
+        self.positions = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.pending_rows = 0
+
+    def __len__(self):
+        self.compact()
+        return len(self.keys)
+
+    def add(self, keys, scores, tiebreaks, positions):
+        self.pending.append((np.asarray(keys, dtype=np.uint64), np.asarray(scores, dtype=float),
+                             np.asarray(tiebreaks, dtype=np.int64), np.asarray(positions, dtype=np.int64)))
+        self.pending_rows += len(keys)
+        if self.pending_rows >= self.compact_rows:
+            self.compact()
+
+    def compact(self):
+        if not self.pending:
+            return
+        keys, scores, tiebreaks, positions = (np.concatenate([current, *parts]) for current, *parts in
+                                              zip((self.keys, self.scores, self.tiebreaks, self.positions), *self.pending))
+        # sorted by key, then score, then tiebreak, so the last row of every key is its winner
+        order = np.lexsort((tiebreaks, scores, keys))
+        keys = keys[order]
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        self.keys = keys[last]
+        self.scores = scores[order][last]
+        self.tiebreaks = tiebreaks[order][last]
+        self.positions = positions[order][last]
+        self.pending = []
+        self.pending_rows = 0
+
+    def winning_positions(self):
+        # sorted positions of every row that won, ready for is_winner
+        self.compact()
+        return np.sort(self.positions)
+
+def is_winner(positions, winners):
+    # mask of positions found in the sorted winning positions
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(winners) == 0:
+        return np.zeros(len(positions), dtype=bool)
+    found = np.searchsorted(winners, positions).clip(max=len(winners) - 1)
+    return winners[found] == positions
+
+def dedup_movies(df, keys, policy='first'):
+    # keeps one row per movie key in a frame that fits in memory, in the order the rows came in
+    positions = np.arange(len(df))
+    winners = MovieWinners()
+    winners.add(keys, *policy_scores(df, policy, positions), positions)
+    return is_winner(positions, winners.winning_positions())
+
+# counts dropped rows per genre file of a combined file, using the row counts in the manifest combine.py writes next to it
+class DropCounter:
+    def __init__(self, source):
+        self.source = source
+        self.names, self.boundaries = None, None
+        try:
+            with open(source + '.manifest.json') as f:
+                manifest = json.load(f)
+            names = manifest['files_in_output']
+            self.boundaries = np.cumsum([manifest['files'][name]['rows'] for name in names])
+            self.names = names
+        except (OSError, KeyError, ValueError):
+            pass # no manifest or one from before it had row counts
+        self.counts = np.zeros(1 if self.names is None else len(self.names), dtype=np.int64)
+
+    def add(self, positions):
+        if self.names is None:
+            self.counts[0] += len(positions)
+        else:
+            self.counts += np.bincount(np.searchsorted(self.boundaries, positions, side='right'), minlength=len(self.names))[:len(self.names)]
+
+    def result(self, total_rows):
+        # {file name: dropped rows}, everything goes under the combined file when the manifest is not for this file
+        if not self.names or self.boundaries[-1] != total_rows:
+            return {os.path.basename(self.source): int(self.counts.sum())}
+        return {name: int(count) for name, count in zip(self.names, self.counts)}
+
+def print_dedup_report(dropped, policy):
+    print(f"Dropped {sum(dropped.values())} duplicate movies, keeping the copy picked by the '{policy}' policy")
+    for name, count in sorted(dropped.items()):
+        print(f"  {name}: {count}")
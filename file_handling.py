@@ -1,21 +1,165 @@
 # importing pandas and necessary exceptions
+import hashlib
+import os
+import numpy as np
 import pandas as pd
 from exceptions import FileHandlingError
+from instrumentation import instrumented, instrumented_iter
 
-def save_clean_data(data, filename="clean_movie_data.csv"): # function to save cleaned data in another clean_covid_data.csv file 
+# pyarrow is only needed for the typed cache, without it we just keep reading the csv
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# the schema of the clean dataset, applied every time it is loaded. the csv loses these so we put them back after reading it
+# imdb ratings have one decimal, runtimes are under 65535 minutes and rater counts under 2 billion
+CLEAN_DTYPES = {
+    'genres': 'category',
+    'rating': 'float32',
+    'run_length': 'uint16',
+    'num_raters': 'int32',
+}
+DATE_COLUMNS = ['rel_date']
+
+# titles are kept as one pool of distinct strings plus a small code per row when enough of them repeat,
+# otherwise the codes would cost more than they save
+TITLE_COLUMNS = ['name']
+TITLE_INTERN_RATIO = 0.5
+
+FINGERPRINT_KEY = b'source_fingerprint'
+FINGERPRINT_BLOCK = 64 * 1024
+
+@instrumented
+def save_clean_data(data, filename="clean_movie_data.csv", append=False, verbose=True): # function to save cleaned data in another clean_covid_data.csv file
     try:
-        data.to_csv(filename, index=False) # writing the data without index rows
-        print(f"Saved cleaned data to {filename}")
+        if append: # appending a chunk to a file that already has the header
+            data.to_csv(filename, index=False, mode='a', header=False)
+        else:
+            data.to_csv(filename, index=False) # writing the data without index rows
+        if verbose:
+            print(f"Saved cleaned data to {filename}")
     except Exception as e: # exception handling
         raise FileHandlingError(f"Error saving data to {filename}: {str(e)}")
 
-def load_clean_data(filename="clean_movie_data.csv"): # function to load the clean data file that may have been saved by the function above for further analysis
+def cache_path_for(filename): # the typed cache lives right next to the csv
+    return os.path.splitext(filename)[0] + '.parquet'
+
+@instrumented
+def source_fingerprint(filename): # size, modification time and a hash of the first and last blocks, cheap even for huge files
+    stat = os.stat(filename)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(filename, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_BLOCK))
+        if stat.st_size > FINGERPRINT_BLOCK:
+            f.seek(max(FINGERPRINT_BLOCK, stat.st_size - FINGERPRINT_BLOCK))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def checked_astype(series, dtype): # astype wraps around silently for integers that do not fit, this refuses instead
+    dtype = np.dtype(dtype) if dtype != 'category' else dtype
+    if dtype != 'category' and dtype.kind in 'iu' and len(series) and series.dtype != dtype:
+        info = np.iinfo(dtype)
+        if series.min() < info.min or series.max() > info.max:
+            raise ValueError(f"Column {series.name} has values outside the range of {dtype}")
+    return series.astype(dtype)
+
+def intern_titles(series): # one pool of distinct titles and a code per row, only when titles repeat enough to pay for the codes
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    if series.nunique() <= len(series) * TITLE_INTERN_RATIO:
+        return series.astype('category')
+    return series.astype('str')
+
+def apply_clean_dtypes(df): # putting back the dtypes of whichever clean columns are in the frame
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    for col, dtype in CLEAN_DTYPES.items():
+        if col in df.columns:
+            df[col] = checked_astype(df[col], dtype)
+    for col in TITLE_COLUMNS:
+        if col in df.columns:
+            df[col] = intern_titles(df[col])
+    return df
+
+def memory_report(df): # bytes used by every column, biggest first, with the total as the last row
+    usage = df.memory_usage(deep=True, index=False)
+    report = pd.DataFrame({
+        'dtype': df.dtypes.astype(str),
+        'bytes': usage,
+        'bytes_per_row': usage / max(len(df), 1),
+        'share': usage / max(usage.sum(), 1),
+    }).sort_values('bytes', ascending=False)
+    report.loc['total'] = ['', usage.sum(), usage.sum() / max(len(df), 1), 1.0]
+    return report
+
+@instrumented
+def read_cache(cache_path, fingerprint, columns=None): # returns None when there is no cache or it was built from another version of the csv
+    if pq is None or not os.path.exists(cache_path):
+        return None
     try:
-        df = pd.read_csv(filename)
+        metadata = pq.read_schema(cache_path).metadata or {}
+        if metadata.get(FINGERPRINT_KEY, b'').decode() != fingerprint:
+            return None
+        return pd.read_parquet(cache_path, columns=columns)
+    except Exception: # a broken cache is just rebuilt
+        return None
+
+@instrumented
+def write_cache(df, cache_path, fingerprint): # writing to a temp file first so a reader never sees half a cache
+    if pa is None:
+        return
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), FINGERPRINT_KEY: fingerprint.encode()})
+        tmp_path = cache_path + '.tmp'
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"Could not write typed cache {cache_path}: {e}")
+
+@instrumented
+def load_clean_data(filename="clean_movie_data.csv", columns=None, use_cache=True): # function to load the clean data file that may have been saved by the function above for further analysis
+    try:
+        if not use_cache: # used for the raw file, which is read as is
+            df = pd.read_csv(filename, usecols=columns)
+        else:
+            fingerprint = source_fingerprint(filename)
+            cache_path = cache_path_for(filename)
+            df = read_cache(cache_path, fingerprint, columns)
+            if df is not None:
+                df = apply_clean_dtypes(df) # a cache written before the schema changed is brought up to date
+            else:
+                # cold load, parsing the csv once and keeping the typed columns for next time
+                df = apply_clean_dtypes(pd.read_csv(filename))
+                write_cache(df, cache_path, fingerprint)
+                if columns is not None:
+                    df = df[columns]
         if df.empty:
             raise ValueError("The .csv file is empty.") # exception handling
         return df # returning the dataset
     except FileNotFoundError as e: # even more exception handling
         raise FileHandlingError(f"File {filename} not found: {str(e)}")
     except Exception as e:
-        raise FileHandlingError(f"Error loading data from {filename}: {str(e)}")
\ No newline at end of file
+        raise FileHandlingError(f"Error loading data from {filename}: {str(e)}")
+
+def load_raw_chunks(filename="combined.csv", chunksize=100000): # function to read a big raw file piece by piece, every column as text
+    try:
+        yield from instrumented_iter('file_handling.load_raw_chunks', pd.read_csv(filename, chunksize=chunksize, dtype=str))
+    except FileNotFoundError as e:
+        raise FileHandlingError(f"File {filename} not found: {str(e)}")
+    except pd.errors.EmptyDataError as e:
+        raise FileHandlingError(f"The file {filename} is empty: {str(e)}")
+
+def load_clean_chunks(filename="clean_movie_data.csv", chunksize=100000, columns=None): # function to read a clean file too big to load whole piece by piece, with the schema put back on every piece
+    try:
+        for chunk in instrumented_iter('file_handling.load_clean_chunks', pd.read_csv(filename, chunksize=chunksize, usecols=columns)):
+            yield apply_clean_dtypes(chunk)
+    except FileNotFoundError as e:
+        raise FileHandlingError(f"File {filename} not found: {str(e)}")
+    except pd.errors.EmptyDataError as e:
+        raise FileHandlingError(f"The file {filename} is empty: {str(e)}")
@@ -0,0 +1,138 @@
+import argparse
+import csv
+import os
+import numpy as np
+import pandas as pd
+from combine import RAW_COLUMNS
+from exceptions import FileHandlingError
+
+# the real scrape we take the distributions from
+SOURCE_FILE = "combined.csv"
+
+# the genres that have their own file in the real dataset
+GENRE_DIR = os.path.join('dataset', '1_movies_per_genre')
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+
+REVIEW_URL = "https://www.imdb.com/title/tt{}/reviews/_ajax?ref_=undefined&paginationKey="
+
+# everything we sample from, learned once from the real data
+def learn_distributions(source=SOURCE_FILE):
+    try:
+        raw = pd.read_csv(source)
+    except FileNotFoundError as e:
+        raise FileHandlingError(f"File {source} not found: {str(e)}")
+
+    # one row per real movie, the genre files repeat movies
+    movies = raw.drop_duplicates(subset=['review_url'])
+    minutes = movies['run_length'].str.extract(r'(?:(\d+)h)?\s*(?:(\d+)min)?').astype(float).fillna(0)
+    countries = movies['release_date'].str.extract(r'\((.*)\)')[0].dropna()
+    words = pd.Series(' '.join(movies['name']).split())
+
+    return {
+        'genres': movies['genres'].to_numpy(),
+        'years': movies['year'].to_numpy(),
+        'minutes': (minutes[0] * 60 + minutes[1]).to_numpy(),
+        'ratings': movies['rating'].to_numpy(),
+        'log_raters_mean': np.log(movies['num_raters']).mean(),
+        'log_raters_std': np.log(movies['num_raters']).std(),
+        'review_ratio': (movies['num_reviews'] / movies['num_raters']).to_numpy(),
+        'movie_rated': movies['movie_rated'].value_counts(normalize=True),
+        'countries': countries.value_counts(normalize=True),
+        'words': words.to_numpy(),
+    }
+
+def format_runtime(minutes):
+    # the three formats imdb uses: "2h 32min", "2h" and "45min"
+    hours = (minutes // 60).astype(str)
+    mins = (minutes % 60).astype(str)
+    return pd.Series(np.where(minutes % 60 == 0, hours + 'h',
+                     np.where(minutes < 60, mins + 'min', hours + 'h ' + mins + 'min')))
+
+def make_movies(count, first_id, dist, rng):
+    # one batch of fake movies, every column built with vectorized string operations
+    picks = rng.integers(0, len(dist['years']), size=count)
+
+    years = np.clip(dist['years'][picks] + rng.integers(-2, 3, size=count), 1915, 2020)
+    minutes = np.clip(dist['minutes'][picks] + rng.integers(-10, 11, size=count), 40, 320).astype(int)
+    ratings = np.clip(np.round(dist['ratings'][picks] + rng.normal(0, 0.3, size=count), 1), 1.0, 10.0)
+    raters = np.exp(rng.normal(dist['log_raters_mean'], dist['log_raters_std'], size=count)).astype(np.int64)
+    reviews = np.maximum(1, (raters * dist['review_ratio'][rng.integers(0, len(dist['review_ratio']), size=count)]).astype(np.int64))
+
+    word_count = rng.integers(1, 5, size=count)
+    words = dist['words'][rng.integers(0, len(dist['words']), size=(count, 4))]
+    names = [' '.join(row[:n]) for row, n in zip(words, word_count)]
+
+    days = rng.integers(1, 29, size=count).astype(str)
+    months = np.array(MONTHS)[rng.integers(0, 12, size=count)]
+    countries = rng.choice(dist['countries'].index.to_numpy(), p=dist['countries'].to_numpy(), size=count)
+    release_dates = pd.Series(days) + ' ' + months + ' ' + years.astype(str) + ' (' + countries + ')'
+
+    ids = pd.Series(np.arange(first_id, first_id + count)).astype(str).str.zfill(7)
+
+    return pd.DataFrame({
+        'name': names,
+        'year': years,
+        'movie_rated': rng.choice(dist['movie_rated'].index.to_numpy(), p=dist['movie_rated'].to_numpy(), size=count),
+        'run_length': format_runtime(minutes),
+        'genres': dist['genres'][picks],
+        'release_date': release_dates,
+        'rating': ratings,
+        'num_raters': raters,
+        'num_reviews': reviews,
+        'review_url': ids.map(REVIEW_URL.format),
+    })
+
+def generate(rows, output_dir, genres=None, batch_rows=1_000_000, drift=0.05, seed=0, source=SOURCE_FILE):
+    # writes about `rows` rows spread over one csv per genre, in the same layout as dataset/1_movies_per_genre
+    # a movie is written to the file of every genre it has, and `drift` of those copies get a slightly different
+    # num_raters as if the genre pages had been scraped on different days
+    rng = np.random.default_rng(seed)
+    dist = learn_distributions(source)
+    if genres is None:
+        genres = sorted(os.path.splitext(name)[0] for name in os.listdir(GENRE_DIR) if name.endswith('.csv'))
+
+    # how many genre files an average movie ends up in, to know how many movies make up `rows`
+    rows_per_movie = np.mean([sum(f"{genre};" in value for genre in genres) for value in dist['genres']])
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {genre: os.path.join(output_dir, f"{genre}.csv") for genre in genres}
+    for path in paths.values():
+        with open(path, 'w', newline='') as f:
+            csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\r\n').writerow(RAW_COLUMNS)
+
+    written = 0
+    next_id = 1
+    while written < rows:
+        count = max(1, int(min(batch_rows, rows - written) / rows_per_movie))
+        movies = make_movies(count, next_id, dist, rng)
+        next_id += count
+
+        for genre, path in paths.items():
+            in_genre = movies['genres'].str.contains(f"{genre};", regex=False)
+            part = movies[in_genre]
+            if part.empty:
+                continue
+            drifted = rng.random(len(part)) < drift
+            if drifted.any():
+                part = part.copy()
+                part.loc[drifted, 'num_raters'] += rng.integers(1, 5000, size=drifted.sum())
+            part.to_csv(path, mode='a', header=False, index=False, quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+            written += len(part)
+
+    print(f"Generated {written} rows for {next_id - 1} movies in {len(paths)} genre files under {output_dir}")
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="generate fake per genre movie files with the real data's schema and distributions")
+    parser.add_argument('--rows', type=int, default=1_000_000, help="roughly how many rows to write over all genre files")
+    parser.add_argument('--output-dir', default=os.path.join('synthetic', '1_movies_per_genre'))
+    parser.add_argument('--drift', type=float, default=0.05, help="share of repeated movies with a changed num_raters")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.rows, args.output_dir, drift=args.drift, seed=args.seed)
+
+if __name__ == "__main__":
+    main()
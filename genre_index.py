@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+# genres in the clean data are stored like "Action, Crime, Drama"
+GENRE_SEPARATOR = ', '
+
+# every genre gets one bit of a 64 bit integer, the dataset has 17 so there is plenty of room
+MAX_GENRES = 64
+
+MASK_COLUMN = 'genre_mask'
+
+def split_genres(genres_str):
+    if not isinstance(genres_str, str):
+        return []
+    return [genre.strip() for genre in genres_str.split(GENRE_SEPARATOR.strip()) if genre.strip()]
+
+def mask_dtype(genre_count):
+    # the smallest unsigned integer with a bit for every genre, 32 bits for the real data
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if genre_count <= np.iinfo(dtype).bits:
+            return dtype
+    return np.uint64
+
+def build_genre_index(genres):
+    # parsing every distinct genres string only once and giving each row a bitmask of its genres
+    codes, uniques = pd.factorize(genres)
+    split_uniques = [split_genres(value) for value in uniques]
+
+    vocabulary = sorted({genre for genre_list in split_uniques for genre in genre_list})
+    if len(vocabulary) > MAX_GENRES:
+        raise ValueError(f"Too many genres for the genre index: {len(vocabulary)} (max {MAX_GENRES})")
+    bit_of = {genre: np.uint64(1) << np.uint64(i) for i, genre in enumerate(vocabulary)}
+
+    unique_masks = np.zeros(len(uniques) + 1, dtype=np.uint64) # the extra slot at the end is for missing values
+    for i, genre_list in enumerate(split_uniques):
+        for genre in genre_list:
+            unique_masks[i] |= bit_of[genre]
+    unique_masks = unique_masks.astype(mask_dtype(len(vocabulary)))
+
+    masks = pd.Series(unique_masks[codes], index=genres.index, name=MASK_COLUMN)
+    return masks, vocabulary
+
+def add_genre_index(df):
+    # adding the bitmask column and keeping the vocabulary on the frame so filters know which bit is which
+    masks, vocabulary = build_genre_index(df['genres'])
+    df[MASK_COLUMN] = masks
+    df.attrs['genre_vocabulary'] = vocabulary
+    return df
+
+def ensure_genre_index(df):
+    # building the index only when the caller did not do it already, returns a new frame so the caller's frame is left alone
+    if MASK_COLUMN in df.columns and 'genre_vocabulary' in df.attrs:
+        return df
+    return add_genre_index(df.copy(deep=False))
+
+def genre_vocabulary(df):
+    return df.attrs['genre_vocabulary']
+
+def genre_bits(df, genres):
+    # unknown genres get no bit, so they just match nothing
+    vocabulary = genre_vocabulary(df)
+    mask = np.uint64(0)
+    for genre in genres:
+        if genre in vocabulary:
+            mask |= np.uint64(1) << np.uint64(vocabulary.index(genre))
+    return mask
+
+def has_genre(df, genre):
+    # exact genre match, "Music" no longer matches "Musical"
+    return has_any_genre(df, [genre])
+
+def has_any_genre(df, genres):
+    return pd.Series((df[MASK_COLUMN].to_numpy() & genre_bits(df, genres)) != 0, index=df.index)
+
+def has_all_genres(df, genres):
+    # a genre we have never seen can't be matched, so nothing has all of them
+    if any(genre not in genre_vocabulary(df) for genre in genres):
+        return pd.Series(False, index=df.index)
+    bits = genre_bits(df, genres)
+    return pd.Series((df[MASK_COLUMN].to_numpy() & bits) == bits, index=df.index)
+
+def genre_membership(df):
+    # boolean matrix with one row per movie and one column per genre
+    masks = df[MASK_COLUMN].to_numpy()
+    vocabulary = genre_vocabulary(df)
+    shifts = np.arange(len(vocabulary), dtype=np.uint64)
+    return ((masks[:, None] >> shifts) & np.uint64(1)).astype(bool)
+
+def genre_counts(df):
+    # number of movies per genre, most common first like value_counts
+    counts = pd.Series(genre_membership(df).sum(axis=0), index=genre_vocabulary(df), name='count')
+    return counts.sort_values(ascending=False, kind='stable')
+
+def genre_means(df, column):
+    # mean of a column per genre, one matrix product instead of an explode and groupby
+    membership = genre_membership(df)
+    values = df[column].to_numpy(dtype=float)
+    counts = membership.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (values @ membership) / counts
+    return pd.Series(means, index=genre_vocabulary(df), name=column)[counts > 0]
+
+def genre_year_counts(df, years=None, year_column='year'):
+    # number of movies for each year and genre in the same long format as the old explode + groupby
+    membership = genre_membership(df)
+    years = (df[year_column] if years is None else years).to_numpy()
+    year_codes, year_values = pd.factorize(years, sort=True)
+    known = year_codes >= 0 # movies without a year are left out like groupby does
+    counts = np.zeros((len(year_values), membership.shape[1]), dtype=np.int64)
+    np.add.at(counts, year_codes[known], membership[known])
+    table = pd.DataFrame(counts, index=pd.Index(year_values, name=year_column), columns=pd.Index(genre_vocabulary(df), name='genres'))
+    long = table.stack().reset_index(name='count')
+    return long[long['count'] > 0].reset_index(drop=True)
@@ -0,0 +1,243 @@
+import atexit
+import functools
+import itertools
+import json
+import os
+import platform
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+# resource only exists on unix, elsewhere there are no rss readings and the stages only get their times
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# MOVIES_PROFILE=1 turns the instrumentation on for every entry point, MOVIES_PROFILE_MEMORY=1 also follows the python heap
+# with tracemalloc (which makes everything a few times slower) and MOVIES_PROFILE_TRACE=path writes the trace there on exit
+PROFILE_ENV = 'MOVIES_PROFILE'
+PROFILE_MEMORY_ENV = 'MOVIES_PROFILE_MEMORY'
+PROFILE_TRACE_ENV = 'MOVIES_PROFILE_TRACE'
+
+# only the most recent stages are kept, the app keeps adding to them for as long as it runs
+MAX_RECORDS = 100_000
+
+MB = 1024 * 1024
+
+# switched off by default, a stage is then one global lookup and a shared object that does nothing
+_enabled = False
+_trace_memory = False
+_trace_paths = set()
+_records = deque(maxlen=MAX_RECORDS)
+_sequence = itertools.count()
+_local = threading.local() # the stages open in each thread, innermost last
+_started = time.perf_counter() # trace timestamps count from here
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macos, None without the resource module
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MB if platform.system() == 'Darwin' else peak / 1024
+
+def current_rss_mb():
+    # what the process holds right now, from /proc on linux. elsewhere there is only the peak, which still shows growth
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / MB
+    except OSError:
+        return peak_rss_mb()
+
+def enable(memory=False, trace_path=None):
+    # memory=True starts tracemalloc so every stage also gets the peak heap it allocated on top of what was there
+    global _enabled, _trace_memory
+    _enabled = True
+    if memory:
+        _trace_memory = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    if trace_path and trace_path not in _trace_paths:
+        _trace_paths.add(trace_path)
+        atexit.register(write_trace, trace_path)
+
+def disable():
+    global _enabled, _trace_memory
+    _enabled = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory = False
+
+def enabled():
+    return _enabled
+
+def reset():
+    _records.clear()
+
+# one timed stage, use it with `with`. the rows can be set on it once the stage knows how many it handled
+class Stage:
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        self.memory = _trace_memory and tracemalloc.is_tracing()
+        if self.memory:
+            # tracemalloc has one peak for the whole process, so the open stages take it before it is reset for this one
+            current, peak = tracemalloc.get_traced_memory()
+            for open_stage in stack:
+                open_stage.peak = max(open_stage.peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = self.peak = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter()
+        stack = _local.stack
+        stack.pop()
+        record = {
+            'seq': next(_sequence),
+            'name': self.name,
+            'parent': self.parent,
+            'depth': self.depth,
+            'pid': os.getpid(),
+            'thread': threading.get_ident(),
+            'start_s': self.start - _started,
+            'seconds': end - self.start,
+            'rows': self.rows,
+            'rss_peak_mb': peak_rss_mb(),
+            'error': exc_type.__name__ if exc_type is not None else None,
+        }
+        if self.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record['heap_peak_mb'] = (self.peak - self.start_memory) / MB
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        _records.append(record) # appending to a deque is thread safe
+        return False
+
+class _NullStage:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass # rows set on the shared object are just dropped
+
+_NULL_STAGE = _NullStage()
+
+def stage(name, rows=None):
+    return Stage(name, rows) if _enabled else _NULL_STAGE
+
+def rows_of(value):
+    # number of rows of a frame, series or array, None for anything else
+    shape = getattr(value, 'shape', None)
+    return int(shape[0]) if shape else None
+
+def instrumented(func=None, *, name=None):
+    # a stage around every call, named module.function unless a name is given. the rows are the ones of the result
+    # when it is a frame or an array, otherwise the ones of the first argument, so loads and saves both get theirs
+    def decorate(func):
+        stage_name = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Stage(stage_name, rows_of(args[0]) if args else None) as current:
+                result = func(*args, **kwargs)
+                current.rows = rows_of(result) or current.rows
+            return result
+        return wrapper
+    return decorate if func is None else decorate(func)
+
+def instrumented_iter(name, iterable):
+    # one stage per item handed out, for the readers that return chunks
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as current:
+            item = next(iterator, _END)
+            current.rows = rows_of(item)
+        if item is _END:
+            return
+        yield item
+
+_END = object()
+
+def mark():
+    # every stage that ends after this call has a bigger seq, the app uses it to show just the current rerun
+    return next(_sequence)
+
+def records(since=None, thread=None):
+    return [record for record in list(_records)
+            if (since is None or record['seq'] > since) and (thread is None or record['thread'] == thread)]
+
+def summary(stage_records=None):
+    # calls, total and slowest time, rows and peaks per stage name, in the order the stages first finished
+    stages = {}
+    for record in records() if stage_records is None else stage_records:
+        totals = stages.setdefault(record['name'], {'name': record['name'], 'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                    'rows': None, 'heap_peak_mb': None, 'rss_peak_mb': None, 'errors': 0})
+        totals['calls'] += 1
+        totals['seconds'] += record['seconds']
+        totals['max_seconds'] = max(totals['max_seconds'], record['seconds'])
+        if record['rows'] is not None:
+            totals['rows'] = (totals['rows'] or 0) + record['rows']
+        if record.get('heap_peak_mb') is not None:
+            totals['heap_peak_mb'] = max(totals['heap_peak_mb'] or 0.0, record['heap_peak_mb'])
+        if record.get('rss_peak_mb') is not None:
+            totals['rss_peak_mb'] = max(totals['rss_peak_mb'] or 0.0, record['rss_peak_mb'])
+        totals['errors'] += record['error'] is not None
+    return list(stages.values())
+
+def trace_events(stage_records):
+    # the chrome trace event format, the file opens in chrome://tracing or ui.perfetto.dev with stages nested by time
+    return [{
+        'name': record['name'],
+        'cat': 'movies',
+        'ph': 'X',
+        'ts': record['start_s'] * 1e6,
+        'dur': record['seconds'] * 1e6,
+        'pid': record['pid'],
+        'tid': record['thread'],
+        'args': {key: record[key] for key in ('rows', 'heap_peak_mb', 'rss_peak_mb', 'error') if record.get(key) is not None},
+    } for record in stage_records]
+
+def write_trace(path, stage_records=None):
+    # per stage totals and every single stage, written to a temp file first so a reader never sees half a trace
+    stage_records = records() if stage_records is None else stage_records
+    trace = {
+        'python': platform.python_version(),
+        'memory_traced': _trace_memory,
+        'stages': summary(stage_records),
+        'traceEvents': trace_events(stage_records),
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(trace, f, indent=1)
+    os.replace(tmp_path, path)
+
+def print_summary(stage_records=None):
+    for totals in summary(stage_records):
+        rows = '' if totals['rows'] is None else f", {totals['rows']} rows"
+        heap = '' if totals['heap_peak_mb'] is None else f", heap peak {totals['heap_peak_mb']:.1f} MB"
+        print(f"{totals['name']:<45}: {totals['seconds']:8.3f}s in {totals['calls']} calls{rows}{heap}")
+
+def env_flag(name):
+    # MOVIES_PROFILE=0 (or false, no, off) leaves it switched off like not setting it at all
+    return os.environ.get(name, '').strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+if env_flag(PROFILE_ENV) or os.environ.get(PROFILE_TRACE_ENV):
+    enable(memory=env_flag(PROFILE_MEMORY_ENV), trace_path=os.environ.get(PROFILE_TRACE_ENV))
@@ -0,0 +1,231 @@
+import numpy as np
+from dataset import movie_years
+from genre_index import ensure_genre_index, genre_vocabulary, genre_bits, MASK_COLUMN
+
+# columns a result can be sorted by, None keeps the order of the clean file
+SORT_COLUMNS = ['rating', 'num_raters', 'run_length', 'year']
+
+# a page is read by walking the sort order once there are this many matches for every row on the page
+SCAN_RATIO = 64
+
+# columns with a sorted copy so range filters are two binary searches
+RANGE_COLUMNS = ['rating', 'num_raters']
+
+# the rows are kept sorted by year so every year range is one contiguous range of row ids
+# genre -> sorted row ids, and sorted copies of rating and num_raters, make the other filters cheap too
+class MovieIndex:
+    def __init__(self, df):
+        df = ensure_genre_index(df)
+        years = movie_years(df)
+
+        # stable sort so movies from the same year keep the order of the clean file
+        order = np.argsort(years.to_numpy(), kind='stable')
+        self.frame = df.iloc[order].reset_index(drop=True)
+        self.frame['year'] = years.to_numpy()[order]
+        self.row_count = len(self.frame)
+        self.id_dtype = _id_dtype(self.row_count)
+
+        self.years = self.frame['year'].to_numpy()
+        self.year_values = np.unique(self.years) # every year in the data, for the year picker
+        self.masks = self.frame[MASK_COLUMN].to_numpy()
+        self.vocabulary = genre_vocabulary(df)
+        self.frame.attrs['genre_vocabulary'] = self.vocabulary
+
+        # genre -> sorted row ids of every movie with that genre
+        self.genre_rows = {}
+        for genre in self.vocabulary:
+            self.genre_rows[genre] = np.flatnonzero(self.masks & genre_bits(self.frame, [genre])).astype(self.id_dtype)
+
+        self.values = {column: self.frame[column].to_numpy() for column in SORT_COLUMNS}
+
+        # row ids in sorted order for every sort column, None is the order of the clean file
+        self.orders = {column: np.argsort(self.values[column], kind='stable').astype(self.id_dtype) for column in SORT_COLUMNS}
+        self.orders[None] = _inverse(order.astype(self.id_dtype))
+
+        # sorted copies of the range columns so a range is two binary searches into them
+        self.sorted_values = {column: self.values[column][self.orders[column]] for column in RANGE_COLUMNS}
+
+        # the rank of every row for every sort column, sorting a result is then sorting small integers
+        self.ranks = {column: _inverse(rows) for column, rows in self.orders.items()}
+
+    def year_range(self, year_min=None, year_max=None):
+        # row ids [start, end) of every movie released between year_min and year_max, both included
+        start = 0 if year_min is None else _search(self.years, year_min, 'left')
+        end = self.row_count if year_max is None else _search(self.years, year_max, 'right')
+        return start, max(start, end)
+
+    def value_range(self, column, low=None, high=None):
+        # positions [lo, hi) in the sorted copy of column for low <= value <= high
+        values = self.sorted_values[column]
+        lo = 0 if low is None else _search(values, low, 'left')
+        hi = len(values) if high is None else _search(values, high, 'right')
+        return lo, max(lo, hi)
+
+    def genre_slices(self, genres, start, end):
+        # row ids of every genre, cut down to the year range with binary searches since the lists are sorted
+        slices = []
+        for genre in genres:
+            rows = self.genre_rows.get(genre, np.empty(0, dtype=self.id_dtype))
+            slices.append(rows[_search(rows, start, 'left'):_search(rows, end, 'left')])
+        return slices
+
+    def matches(self, rows, genres, match, start, end, ranges, skip=()):
+        # checks every filter on just the given row ids, skip names the filters the rows are already known to pass
+        keep = np.ones(len(rows), dtype=bool)
+        if 'year' not in skip and (start, end) != (0, self.row_count):
+            keep &= (rows >= start) & (rows < end)
+        if genres and 'genres' not in skip:
+            row_masks = self.masks[rows]
+            bits = genre_bits(self.frame, genres)
+            if match == 'all':
+                if any(genre not in self.vocabulary for genre in genres):
+                    keep[:] = False
+                keep &= (row_masks & bits) == bits
+            else:
+                keep &= (row_masks & bits) != 0
+        for column, (low, high) in ranges.items():
+            if column in skip:
+                continue
+            values = self.values[column][rows]
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+        return keep
+
+    def query(self, genres=None, match='any', year_min=None, year_max=None, rating_min=None, rating_max=None,
+              raters_min=None, raters_max=None, sort_by=None, ascending=True, page=0, page_size=50, columns=None):
+        # returns (total number of matches, one page of matching movies)
+        if match not in ('any', 'all'):
+            raise ValueError(f"match must be 'any' or 'all', not {match}")
+        if sort_by not in self.ranks:
+            raise ValueError(f"Cannot sort by {sort_by}, choose one of {SORT_COLUMNS}")
+        genres = list(genres or [])
+
+        start, end = self.year_range(year_min, year_max)
+        ranges = {
+            'rating': (rating_min, rating_max),
+            'num_raters': (raters_min, raters_max),
+        }
+        ranges = {column: bounds for column, bounds in ranges.items() if bounds != (None, None)}
+
+        # nothing to filter on, a page can be read straight off the sort order
+        if not genres and not ranges and (start, end) == (0, self.row_count):
+            return self.row_count, self._page_of_everything(sort_by, ascending, page, page_size, columns)
+
+        # sizing every index lookup with binary searches only, then starting from the smallest one
+        sizes = {'year': end - start}
+        if genres:
+            slices = self.genre_slices(genres, start, end)
+            sizes['genres'] = min(len(rows) for rows in slices) if match == 'all' else sum(len(rows) for rows in slices)
+        for column, (low, high) in ranges.items():
+            lo, hi = self.value_range(column, low, high)
+            sizes[column] = hi - lo
+        driver = min(sizes, key=sizes.get)
+
+        if driver == 'year':
+            rows = np.arange(start, end, dtype=self.id_dtype)
+        elif driver == 'genres' and match == 'all':
+            rows = min(slices, key=len) # the other genres are checked with the bitmask
+        elif driver == 'genres':
+            rows = _union_sorted(slices)
+        else:
+            lo, hi = self.value_range(driver, *ranges[driver])
+            rows = self.orders[driver][lo:hi]
+
+        # the other filters are only checked on the rows the driver gave us
+        skip = {driver}
+        if driver == 'genres':
+            skip.add('year') # the genre lists were already cut to the year range
+            if match == 'all' and len(genres) > 1:
+                skip.discard('genres') # only one of the genres came from the index
+        if skip != {'year', 'genres'} or ranges:
+            rows = rows[self.matches(rows, genres, match, start, end, ranges, skip)]
+        total = len(rows)
+
+        if page_size is not None and total > SCAN_RATIO * (page + 1) * page_size:
+            # lots of matches for a small page, walking the presorted order until the page is full beats sorting them all
+            return total, self._page_by_scan(total, genres, match, start, end, ranges, sort_by, ascending, page, page_size, columns)
+        return total, self._page(rows, sort_by, ascending, page, page_size, columns)
+
+    def _page_of_everything(self, sort_by, ascending, page, page_size, columns):
+        order = self.orders[sort_by]
+        if not ascending:
+            order = order[::-1]
+        if page_size is None:
+            return self._rows(order, columns)
+        return self._rows(order[page * page_size:(page + 1) * page_size], columns)
+
+    def _page_by_scan(self, total, genres, match, start, end, ranges, sort_by, ascending, page, page_size, columns):
+        order = self.orders[sort_by]
+        if not ascending:
+            order = order[::-1]
+        needed = (page + 1) * page_size
+
+        # about one in row_count / total sorted rows matches, so the first block is sized to usually be enough
+        block = max(1024, 2 * needed * self.row_count // max(total, 1))
+        found = []
+        found_count = 0
+        position = 0
+        while found_count < needed and position < self.row_count:
+            ids = order[position:position + block]
+            hits = ids[self.matches(ids, genres, match, start, end, ranges)]
+            found.append(hits)
+            found_count += len(hits)
+            position += block
+            block *= 2
+        rows = np.concatenate(found) if found else order[:0]
+        return self._rows(rows[page * page_size:needed], columns)
+
+    def _page(self, rows, sort_by, ascending, page, page_size, columns):
+        keys = self.ranks[sort_by][rows]
+        if not ascending:
+            keys = -keys
+        if page_size is None:
+            return self._rows(rows[np.argsort(keys, kind='stable')], columns)
+
+        # only the rows up to the end of the requested page have to be put in order
+        needed = min(len(rows), (page + 1) * page_size)
+        if needed == 0:
+            return self._rows(rows[:0], columns)
+        if needed < len(rows):
+            first = np.argpartition(keys, needed - 1)[:needed]
+        else:
+            first = np.arange(len(rows))
+        first = first[np.argsort(keys[first], kind='stable')]
+        return self._rows(rows[first[page * page_size:needed]], columns)
+
+    def _rows(self, rows, columns):
+        frame = self.frame if columns is None else self.frame[columns]
+        return frame.iloc[rows]
+
+def _search(values, value, side):
+    # the value has to have the same dtype as the array, otherwise numpy converts the whole array before searching
+    if np.issubdtype(values.dtype, np.integer):
+        # a bound outside the dtype would wrap around when cast, but it is past every value anyway
+        info = np.iinfo(values.dtype)
+        if value > info.max:
+            return len(values)
+        if value < info.min:
+            return 0
+        if value != int(value):
+            value = np.ceil(value) if side == 'left' else np.floor(value)
+    return int(np.searchsorted(values, np.asarray(value).astype(values.dtype), side=side))
+
+def _union_sorted(slices):
+    # the genre lists are already sorted, a stable sort of them glued together is a cheap merge
+    if len(slices) == 1:
+        return slices[0]
+    rows = np.sort(np.concatenate(slices), kind='stable')
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:] = rows[1:] != rows[:-1]
+    return rows[keep]
+
+def _id_dtype(row_count):
+    # row ids fit in 32 bits for anything under 2 billion rows, which halves the size of every index
+    return np.int32 if row_count < 2**31 else np.int64
+
+def _inverse(order):
+    inverse = np.empty(len(order), dtype=order.dtype)
+    inverse[order] = np.arange(len(order), dtype=order.dtype)
+    return inverse
@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from genre_index import genre_bits, genre_vocabulary, has_any_genre, has_all_genres, MASK_COLUMN
+from file_handling import source_fingerprint
+from exceptions import FileHandlingError
+from instrumentation import instrumented, stage
+
+# pyarrow is only needed for the partitions, without it every query filters the whole dataset like before
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# fcntl only exists on unix, elsewhere two processes may both write the same version and the second one throws its copy away
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# every partition keeps the position of its movies in the clean file, so a query that reads several partitions
+# puts the movies back in file order and drops the ones it read twice
+ROW_COLUMN = 'row'
+
+# with by_year every genre is split further into one partition per this many years
+YEAR_BUCKET = 10
+
+# the movies of a partition are sorted by year and written in row groups of this many rows, parquet keeps the lowest
+# and highest year of every group so a year range skips the groups outside it even inside one partition
+ROW_GROUP_ROWS = 64_000
+
+# partitions of one query read at the same time, pyarrow reads and decodes without holding the gil
+_cpus = os.cpu_count() or 1
+DEFAULT_SCAN_WORKERS = int(os.environ.get('MOVIES_SCAN_WORKERS', min(8, 2 * _cpus)))
+
+MANIFEST_NAME = 'manifest.json'
+
+# the clean file stored once per genre like dataset/1_movies_per_genre, a movie with three genres is in three of them
+# the manifest lists every partition with its genre, years and size, which is all the planner needs to skip the rest
+class PartitionStore:
+    def __init__(self, filename, directory, manifest):
+        self.filename = filename
+        self.directory = directory # the folder of this version, every partition path is relative to it
+        self.fingerprint = manifest['fingerprint']
+        self.by_year = manifest['by_year']
+        self.vocabulary = manifest['genre_vocabulary']
+        self.year_values = manifest['years'] # every year in the data, for the year picker
+        self.genre_categories = manifest['genre_categories'] # the categories of the genres column of the whole dataset
+        self.row_count = manifest['rows']
+        self.partitions = manifest['partitions'] # [{'genre', 'year_min', 'year_max', 'rows', 'path'}]
+
+    @classmethod
+    def write(cls, df, filename, fingerprint, by_year=False):
+        # writes every partition of the prepared frame into a temp folder that becomes the folder of this version
+        # in one rename, then points the manifest at it. a reader never sees half a store
+        parts_dir = parts_dir_for(filename)
+        directory = os.path.join(parts_dir, fingerprint)
+        tmp_dir = f"{directory}.{os.getpid()}.tmp"
+        vocabulary = genre_vocabulary(df)
+        masks = df[MASK_COLUMN].to_numpy()
+        years = df['year'].to_numpy()
+        positions = np.arange(len(df), dtype=np.int64)
+        partitions = []
+        try:
+            for genre in vocabulary:
+                rows = np.flatnonzero(masks & genre_bits(df, [genre]))
+                buckets = years[rows] // YEAR_BUCKET * YEAR_BUCKET if by_year else np.zeros(len(rows), dtype=np.int64)
+                for bucket in np.unique(buckets):
+                    part_rows = rows[buckets == bucket]
+                    part_rows = part_rows[np.argsort(years[part_rows], kind='stable')] # by year, then file order
+                    name = genre.replace(os.sep, '_')
+                    path = os.path.join(f"genre={name}", f"decade={bucket}.parquet" if by_year else 'part.parquet')
+                    os.makedirs(os.path.join(tmp_dir, os.path.dirname(path)), exist_ok=True)
+                    table = pa.Table.from_pandas(df.iloc[part_rows], preserve_index=False)
+                    table = table.append_column(ROW_COLUMN, pa.array(positions[part_rows]))
+                    pq.write_table(table, os.path.join(tmp_dir, path), row_group_size=ROW_GROUP_ROWS)
+                    part_years = years[part_rows]
+                    partitions.append({'genre': genre, 'year_min': int(part_years.min()), 'year_max': int(part_years.max()),
+                                       'rows': len(part_rows), 'path': path})
+            manifest = {
+                'fingerprint': fingerprint,
+                'by_year': by_year,
+                'genre_vocabulary': vocabulary,
+                'years': np.unique(years).tolist(),
+                'genre_categories': df['genres'].cat.categories.tolist() if isinstance(df['genres'].dtype, pd.CategoricalDtype) else None,
+                'rows': len(df),
+                'partitions': partitions,
+            }
+            with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+                json.dump(manifest, f, indent=1)
+        except Exception as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise FileHandlingError(f"Error writing the partitions of {filename}: {e}")
+
+        # publishing under a lock next to the partitions, another process may be publishing the same version
+        with open(f"{parts_dir}.lock", 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                existing = cls.open(filename, fingerprint)
+                if existing is not None and existing.by_year == by_year:
+                    # the same partitions were published in the meantime and may already be read, this copy goes instead
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return existing
+                try:
+                    if os.path.exists(directory): # the other layout, or a broken copy
+                        shutil.rmtree(directory)
+                    os.replace(tmp_dir, directory)
+                except Exception as e:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    raise FileHandlingError(f"Error writing the partitions of {filename}: {e}")
+
+                # pointing the top manifest at the new version, then removing the older versions
+                current = os.path.join(parts_dir, MANIFEST_NAME)
+                with open(current + '.tmp', 'w') as f:
+                    json.dump({'fingerprint': fingerprint}, f)
+                os.replace(current + '.tmp', current)
+                for name in os.listdir(parts_dir):
+                    if name not in (fingerprint, MANIFEST_NAME) and not name.endswith('.tmp'):
+                        shutil.rmtree(os.path.join(parts_dir, name), ignore_errors=True)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return cls(filename, directory, manifest)
+
+    @classmethod
+    def open(cls, filename, fingerprint):
+        # returns None when there are no partitions or they were written from another version of the clean file
+        directory = os.path.join(parts_dir_for(filename), fingerprint)
+        try:
+            with open(os.path.join(directory, MANIFEST_NAME)) as f:
+                return cls(filename, directory, json.load(f))
+        except (OSError, ValueError, KeyError): # missing or broken partitions are just written again
+            return None
+
+    def plan(self, genres=None, match='any', year_min=None, year_max=None):
+        # which partitions a query has to read, everything else is pruned from the genres and years alone
+        return QueryPlan(self, genres, match, year_min, year_max)
+
+    def query(self, genres=None, match='any', year_min=None, year_max=None, columns=None, workers=DEFAULT_SCAN_WORKERS):
+        # the movies with the genres (any or all of them) released between year_min and year_max, in file order and
+        # indexed by their position in the clean file, the same rows filtering the whole dataset would give
+        return self.plan(genres, match, year_min, year_max).scan(columns, workers)
+
+class QueryPlan:
+    def __init__(self, store, genres, match, year_min, year_max):
+        if match not in ('any', 'all'):
+            raise ValueError(f"match must be 'any' or 'all', not {match}")
+        self.store = store
+        self.genres = list(dict.fromkeys(genres or []))
+        self.match = match
+        self.year_min = year_min
+        self.year_max = year_max
+        # no genre means every movie, every partition would be read and most movies more than once
+        self.full_scan = not self.genres
+
+        scanned = [] if self.full_scan else self.genres
+        if match == 'all' and scanned:
+            # a movie with all the genres is in the partitions of every one of them, the smallest genre is enough
+            if any(genre not in store.vocabulary for genre in scanned):
+                scanned = []
+            else:
+                sizes = {genre: sum(part['rows'] for part in store.partitions if part['genre'] == genre) for genre in scanned}
+                scanned = [min(scanned, key=sizes.get)]
+        self.partitions = [part for part in store.partitions if part['genre'] in scanned and self._years_overlap(part)]
+        self.pruned = len(store.partitions) - len(self.partitions)
+
+    def _years_overlap(self, part):
+        return ((self.year_min is None or part['year_max'] >= self.year_min) and
+                (self.year_max is None or part['year_min'] <= self.year_max))
+
+    def explain(self):
+        if self.full_scan:
+            return "no genre filter, scanning the whole dataset"
+        return f"reading {len(self.partitions)} of {len(self.store.partitions)} partitions ({self.pruned} pruned): " + \
+               ', '.join(part['path'] for part in self.partitions)
+
+    @instrumented(name='partition_store.scan')
+    def scan(self, columns=None, workers=DEFAULT_SCAN_WORKERS):
+        if self.full_scan:
+            return self._scan_dataset(columns)
+        # the year range also skips row groups inside the partitions, the genres of a movie are checked afterwards
+        filters = [(column, op, value) for column, op, value in (('year', '>=', self.year_min), ('year', '<=', self.year_max))
+                   if value is not None] or None
+        read_columns = None if columns is None else list(dict.fromkeys([*columns, 'year', MASK_COLUMN, ROW_COLUMN]))
+
+        def read(part):
+            with stage('partition_store.read_partition', part['rows']):
+                return pq.read_table(os.path.join(self.store.directory, part['path']), columns=read_columns, filters=filters)
+
+        if len(self.partitions) > 1 and workers > 1:
+            with ThreadPoolExecutor(min(workers, len(self.partitions))) as pool:
+                tables = list(pool.map(read, self.partitions))
+        else:
+            tables = [read(part) for part in self.partitions]
+        if not tables:
+            return self._empty(columns)
+
+        df = pa.concat_tables(tables).to_pandas()
+        df.attrs['genre_vocabulary'] = self.store.vocabulary
+        if self.match == 'all':
+            bits = genre_bits(df, self.genres)
+            df = df[(df[MASK_COLUMN].to_numpy() & bits) == bits]
+        # a movie of two asked genres was read from both, the row position tells the copies apart
+        df = df.drop_duplicates(ROW_COLUMN).sort_values(ROW_COLUMN).set_index(ROW_COLUMN)
+        df.index.name = None
+        df = self._whole_dataset_categories(df)
+        return df if columns is None else df[columns]
+
+    def _whole_dataset_categories(self, df):
+        # a partition only knows the genre lists of its own movies, the result gets the ones of the whole dataset
+        # so it has the same types as filtering the whole dataset, empty or not
+        if 'genres' in df.columns and self.store.genre_categories is not None:
+            df['genres'] = df['genres'].astype(pd.CategoricalDtype(self.store.genre_categories))
+        return df
+
+    def _scan_dataset(self, columns):
+        from dataset import get_dataset
+        return filter_dataset(get_dataset(self.store.filename), None, self.match, self.year_min, self.year_max, columns)
+
+    def _empty(self, columns):
+        # nothing to read, the columns and types come from the schema of any partition
+        if not self.store.partitions:
+            return self._scan_dataset(columns).iloc[:0]
+        schema = pq.read_schema(os.path.join(self.store.directory, self.store.partitions[0]['path']))
+        df = schema.empty_table().to_pandas().drop(columns=ROW_COLUMN)
+        df.attrs['genre_vocabulary'] = self.store.vocabulary
+        df = self._whole_dataset_categories(df)
+        return df if columns is None else df[columns]
+
+def filter_dataset(df, genres=None, match='any', year_min=None, year_max=None, columns=None):
+    # the same query over every movie of the prepared dataset, for when there are no partitions to read
+    keep = np.ones(len(df), dtype=bool)
+    if genres:
+        keep &= (has_all_genres(df, genres) if match == 'all' else has_any_genre(df, genres)).to_numpy()
+    years = df['year'].to_numpy()
+    if year_min is not None:
+        keep &= years >= year_min
+    if year_max is not None:
+        keep &= years <= year_max
+    df = df[keep]
+    return df if columns is None else df[columns]
+
+def query_movies(filename="clean_movie_data.csv", genres=None, match='any', year_min=None, year_max=None, columns=None,
+                 workers=DEFAULT_SCAN_WORKERS):
+    # the movies of some genres and years, read from just their partitions when there are partitions
+    store = load_partitions(filename)
+    if store is not None:
+        return store.query(genres, match, year_min, year_max, columns, workers)
+    from dataset import get_dataset
+    return filter_dataset(get_dataset(filename), genres, match, year_min, year_max, columns)
+
+def parts_dir_for(filename): # the partitions live right next to the clean csv
+    return os.path.splitext(filename)[0] + '.parts'
+
+@instrumented
+def load_partitions(filename="clean_movie_data.csv", df=None, by_year=None):
+    # the partitions written for this version of filename, written from df (or the file) when missing or out of date
+    # by_year=None keeps whatever layout is there, True or False writes them again when the layout is different
+    # returns None without pyarrow, callers then filter the whole dataset
+    if pa is None:
+        return None
+    filename = os.path.abspath(filename)
+    fingerprint = source_fingerprint(filename)
+    store = PartitionStore.open(filename, fingerprint)
+    if store is not None and (by_year is None or store.by_year == by_year):
+        return store
+    if df is None:
+        from dataset import get_dataset
+        df = get_dataset(filename)
+    return PartitionStore.write(df, filename, fingerprint, bool(by_year))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="store the clean dataset once per genre so queries only read the genres they ask for")
+    parser.add_argument('filename', nargs='?', default='clean_movie_data.csv')
+    parser.add_argument('--by-year', action='store_true', help=f"also split every genre into {YEAR_BUCKET} year partitions")
+    args = parser.parse_args()
+
+    store = load_partitions(args.filename, by_year=args.by_year)
+    if store is None:
+        print("pyarrow is missing, no partitions were written")
+    else:
+        print(f"{len(store.partitions)} partitions of {store.row_count} movies in {store.directory}")
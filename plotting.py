@@ -1,26 +1,80 @@
-import pandas as pd
-import matplotlib.pyplot as plt
+import threading
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.colors import LogNorm
 from exceptions import PlottingError, FileHandlingError
 from file_handling import load_clean_data
+from dataset import movie_years
+from aggregate_cube import as_cube
+from instrumentation import instrumented
+
+# none of the plotting functions change the frame they are given, the app shares one frame between all of them
+# the charts that only need counts and sums also take the aggregate cube instead of the frame, then they never touch the rows
+# every chart draws on its own Figure instead of pyplot's current figure, so charts can be drawn at the same time
+
+# above this many movies the scatter plots draw a density grid instead of one marker per movie
+DENSITY_THRESHOLD = 50_000
+
+# cells along the x and y axis of the density grid, years and ratings get one cell per value instead
+DENSITY_BINS = (200, 100)
+
+# cleared figures kept for the next chart of the same size. a figure keeps the agg buffer it was last drawn into, so
+# the next chart draws into that instead of allocating another one of several MB, which is what made a long running
+# app's memory creep up and down with every figure it threw away and left to the garbage collector
+FIGURE_POOL_SIZE = 2
+
+_figure_pool = {} # figsize -> [Figure]
+_pool_lock = threading.Lock()
+
+def new_figure(figsize):
+    # an empty Figure of this size, one that was released earlier when there is one
+    with _pool_lock:
+        figures = _figure_pool.get(figsize)
+        if figures:
+            return figures.pop()
+    return Figure(figsize=figsize)
+
+def release_figure(fig):
+    # called once the figure is encoded, whoever released it must not touch it again
+    # clearing it drops every artist and the data they hold right away instead of whenever the garbage collector runs
+    fig.clear()
+    figsize = tuple(fig.get_size_inches().tolist()) # (14.0, 8.0) finds the figures asked for as (14, 8)
+    with _pool_lock:
+        figures = _figure_pool.setdefault(figsize, [])
+        if len(figures) < FIGURE_POOL_SIZE:
+            figures.append(fig)
+
+def bin_edges(values, bins, step=None, log=False):
+    # edges for the density grid, centred on every possible value when the values come in fixed steps
+    low, high = np.nanmin(values), np.nanmax(values)
+    if log:
+        return np.geomspace(max(low, 1), max(high, 1) + 1, bins + 1)
+    if step is not None:
+        return np.arange(low - step / 2, high + step, step)
+    return np.linspace(low, high if high > low else low + 1, bins + 1)
+
+def plot_density(ax, x, y, x_edges, y_edges):
+    # counting the points per cell with numpy and drawing the grid as one image, so drawing time
+    # does not depend on the number of movies. empty cells are left blank, the colours are log scaled
+    counts, _, _ = np.histogram2d(x, y, bins=[x_edges, y_edges])
+    counts = np.ma.masked_equal(counts.T, 0)
+    mesh = ax.pcolormesh(x_edges, y_edges, counts, cmap='Purples', norm=LogNorm(vmin=1, vmax=max(counts.max(), 1)), rasterized=True)
+    ax.figure.colorbar(mesh, ax=ax, label='Number of Movies')
+
+def use_density(df, aggregate):
+    # aggregate=None picks the density grid automatically for big datasets
+    return len(df) > DENSITY_THRESHOLD if aggregate is None else aggregate
 
 # line graph for movies by genre over time
-def plot_movies_by_genre_over_time(df):
+@instrumented
+def plot_movies_by_genre_over_time(data):
     try:
-        # making sure rel_date is datetime type because for some reason it does not like staying that way even after doing it in data cleaning
-        df['rel_date'] = pd.to_datetime(df['rel_date'], errors='coerce') 
-        
-        # extracting year from rel_date
-        df['year'] = df['rel_date'].dt.year
-
-        # splitting genres of movies which have multiple genres in their genres column into list and creates unique genre columns
-        df['genres'] = df['genres'].str.split(', ')
-        df_exploded = df.explode('genres')
-
-        # grouping exploded genres and their movies year-wise and getting their size
-        movies_by_genre_year = df_exploded.groupby(['year', 'genres']).size().reset_index(name='count')
+        # counting movies for every year and genre, read straight off the cube
+        movies_by_genre_year = as_cube(data).genre_year_counts()
 
         # creating a figure and axes for subplotting
-        fig, ax = plt.subplots(figsize=(14, 8))
+        fig = new_figure((14, 8))
+        ax = fig.subplots()
 
         # storing names of all unique genres in genres
         genres = movies_by_genre_year['genres'].unique()
@@ -30,34 +84,33 @@ def plot_movies_by_genre_over_time(df):
             # giving x axis y axis marker type then label for the lines plotted
             ax.plot(data['year'], data['count'], marker='o', label=genre, linewidth=1)
 
-        plt.title('Number of Movies by Genre Over Time')
-        plt.xlabel('Year')
-        plt.ylabel('Number of Movies') 
-        plt.legend(title='Genre', bbox_to_anchor=(1, 1)) # make sure legend is not overlapping
-        plt.tight_layout()
+        ax.set_title('Number of Movies by Genre Over Time')
+        ax.set_xlabel('Year')
+        ax.set_ylabel('Number of Movies') 
+        ax.legend(title='Genre', bbox_to_anchor=(1, 1)) # make sure legend is not overlapping
+        fig.tight_layout()
 
-        return plt
+        return fig
     except Exception as e:
         raise PlottingError(f"An error occurred while plotting movies by genre over time : {e}")
 
 # bar plot for genre ratings 
-def plot_genre_ratings_bar(df):
+@instrumented
+def plot_genre_ratings_bar(data):
     try:
-        df['genres'] = df['genres'].str.split(', ')
-        df_exploded = df.explode('genres')
-
-        # grouping data by their genres and calculating mean of each genre data ratings and putting in decending order
-        genre_avg_ratings = df_exploded.groupby('genres')['rating'].mean().sort_values(ascending=False)
-
-        plt.figure(figsize=(10, 6))
-        plt.bar(genre_avg_ratings.index, genre_avg_ratings, color='#CBC3E3', edgecolor='grey')
-        plt.title('Average Ratings by Genre')
-        plt.xlabel('Genre')
-        plt.ylabel('Average Rating')
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-
-        return plt
+        # calculating mean of each genre data ratings from the cube sums and putting in decending order
+        genre_avg_ratings = as_cube(data).genre_means('rating').sort_values(ascending=False)
+
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        ax.bar(genre_avg_ratings.index, genre_avg_ratings, color='#CBC3E3', edgecolor='grey')
+        ax.set_title('Average Ratings by Genre')
+        ax.set_xlabel('Genre')
+        ax.set_ylabel('Average Rating')
+        ax.tick_params(axis='x', labelrotation=45)
+        fig.tight_layout()
+
+        return fig
     
     except KeyError as e:
         raise PlottingError(f"KeyError : {e}. Ensure 'genres' and 'rating' columns exist.")
@@ -65,17 +118,28 @@ def plot_genre_ratings_bar(df):
         raise PlottingError(f"An error occurred during plotting : {e}")
 
 # scatter plot for ratings vs raters
-def plot_ratings_vs_raters(df):
+@instrumented
+def plot_ratings_vs_raters(df, aggregate=None, log_raters=False):
     try:
-        plt.figure(figsize=(10, 6))
-        plt.scatter(df['num_raters'], df['rating'], color='#9370DB', alpha=0.3, edgecolor='grey')
-        plt.title('Ratings vs Number of Raters')
-        plt.xlabel('Number of Raters')
-        plt.ylabel('Rating')
-        plt.ticklabel_format(style='plain', axis='x')
-        plt.tight_layout()
-
-        return plt
+        raters = df['num_raters'].to_numpy(dtype=float)
+        ratings = df['rating'].to_numpy(dtype=float)
+
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        if use_density(df, aggregate):
+            plot_density(ax, raters, ratings, bin_edges(raters, DENSITY_BINS[0], log=log_raters), bin_edges(ratings, DENSITY_BINS[1], step=0.1))
+        else:
+            ax.scatter(raters, ratings, color='#9370DB', alpha=0.3, edgecolor='grey')
+        ax.set_title('Ratings vs Number of Raters')
+        ax.set_xlabel('Number of Raters')
+        ax.set_ylabel('Rating')
+        if log_raters:
+            ax.set_xscale('log')
+        else:
+            ax.ticklabel_format(style='plain', axis='x')
+        fig.tight_layout()
+
+        return fig
 
     except KeyError as e:
         raise PlottingError(f"KeyError : {e}. Ensure 'num_raters' and 'rating' columns exist.")
@@ -83,19 +147,24 @@ def plot_ratings_vs_raters(df):
         raise PlottingError(f"An error occurred during plotting : {e}")
 
 # scatter plot for runtime vs year
-def plot_runtime_vs_year(df):
+@instrumented
+def plot_runtime_vs_year(df, aggregate=None):
     try:
-        df['rel_date'] = pd.to_datetime(df['rel_date'], errors='coerce')
-        df['year'] = df['rel_date'].dt.year
-
-        plt.figure(figsize=(10, 6))
-        plt.scatter(df['year'], df['run_length'], alpha=0.3, color='#9370DB', edgecolor='grey')
-        plt.title('Runtime of Movies Over the Years')
-        plt.xlabel('Year')
-        plt.ylabel('Runtime (minutes)')
-        plt.tight_layout()
-
-        return plt
+        years = movie_years(df).to_numpy(dtype=float)
+        runtimes = df['run_length'].to_numpy(dtype=float)
+
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        if use_density(df, aggregate):
+            plot_density(ax, years, runtimes, bin_edges(years, DENSITY_BINS[0], step=1), bin_edges(runtimes, DENSITY_BINS[1]))
+        else:
+            ax.scatter(years, runtimes, alpha=0.3, color='#9370DB', edgecolor='grey')
+        ax.set_title('Runtime of Movies Over the Years')
+        ax.set_xlabel('Year')
+        ax.set_ylabel('Runtime (minutes)')
+        fig.tight_layout()
+
+        return fig
 
     except KeyError as e:
         raise PlottingError(f"KeyError : {e}. Ensure 'year' and 'run_length' columns exist.")
@@ -103,16 +172,20 @@ def plot_runtime_vs_year(df):
         raise PlottingError(f"An error occurred during plotting : {e}")
 
 # movie ratings histogram
-def plot_ratings_distribution(df):
+@instrumented
+def plot_ratings_distribution(data):
     try:
-        plt.figure(figsize=(10, 6))
-        plt.hist(df['rating'].dropna(), bins=20, color='#CBC3E3', edgecolor='grey')
-        plt.title('Distribution of Movie Ratings')
-        plt.xlabel('Rating')
-        plt.ylabel('Frequency')
-        plt.tight_layout()
-
-        return plt
+        # the cube keeps one bin per rating value, weighting them by their counts gives the same histogram as the rows
+        ratings, counts = as_cube(data).histogram('rating')
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        ax.hist(ratings, weights=counts, bins=20, color='#CBC3E3', edgecolor='grey')
+        ax.set_title('Distribution of Movie Ratings')
+        ax.set_xlabel('Rating')
+        ax.set_ylabel('Frequency')
+        fig.tight_layout()
+
+        return fig
 
     except KeyError as e:
         raise PlottingError(f"KeyError : {e}. Ensure 'rating' column exists.")
@@ -120,16 +193,19 @@ def plot_ratings_distribution(df):
         raise PlottingError(f"An error occurred during plotting : {e}")
 
 # runtime histogram
-def plot_runtime_distribution(df):
+@instrumented
+def plot_runtime_distribution(data):
     try:
-        plt.figure(figsize=(10, 6))
-        plt.hist(df['run_length'].dropna(), bins=20, color='#CBC3E3', edgecolor='grey')
-        plt.title('Distribution of Movie Runtimes')
-        plt.xlabel('Runtime (minutes)')
-        plt.ylabel('Frequency')
-        plt.tight_layout()
+        runtimes, counts = as_cube(data).histogram('run_length')
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        ax.hist(runtimes, weights=counts, bins=20, color='#CBC3E3', edgecolor='grey')
+        ax.set_title('Distribution of Movie Runtimes')
+        ax.set_xlabel('Runtime (minutes)')
+        ax.set_ylabel('Frequency')
+        fig.tight_layout()
 
-        return plt
+        return fig
 
     except KeyError as e:
         raise PlottingError(f"KeyError : {e}. Ensure 'run_length' column exists.")
@@ -137,19 +213,19 @@ def plot_runtime_distribution(df):
         raise PlottingError(f"An error occurred during plotting : {e}")
 
 # bar plot for number of movies by decades
-def plot_movies_by_decade(df):
+@instrumented
+def plot_movies_by_decade(data):
     try:
-        plt.figure(figsize=(10, 6))
-        df['year'] = pd.to_datetime(df['rel_date'], errors='coerce').dt.year
-        df['decade'] = (df['year'] // 10) * 10
-        movies_by_decade = df['decade'].value_counts().sort_index()
-        plt.bar(movies_by_decade.index, movies_by_decade, color='#CBC3E3', edgecolor='grey')
-        plt.title('Number of Movies by Decade')
-        plt.xlabel('Decade')
-        plt.ylabel('Number of Movies')
-        plt.tight_layout()
-
-        return plt
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        movies_by_decade = as_cube(data).decade_counts()
+        ax.bar(movies_by_decade.index, movies_by_decade, color='#CBC3E3', edgecolor='grey')
+        ax.set_title('Number of Movies by Decade')
+        ax.set_xlabel('Decade')
+        ax.set_ylabel('Number of Movies')
+        fig.tight_layout()
+
+        return fig
 
     except KeyError as e:
         raise PlottingError(f"KeyError : {e}. Ensure 'rel_date' column exists and is properly formatted.")
@@ -157,22 +233,21 @@ def plot_movies_by_decade(df):
         raise PlottingError(f"An error occurred during plotting : {e}")
     
 # bar plot for number of raters in each genre
-def plot_raters_by_genre_bar(df):
+@instrumented
+def plot_raters_by_genre_bar(data):
     try:
-        df['genres'] = df['genres'].str.split(', ')
-        df_exploded = df.explode('genres')
-
-        genre_avg_raters = df_exploded.groupby('genres')['num_raters'].mean().sort_values(ascending=False)
-
-        plt.figure(figsize=(10, 6))
-        plt.bar(genre_avg_raters.index, genre_avg_raters, color='#CBC3E3', edgecolor='grey')
-        plt.title('Average Number of Raters by Genre')
-        plt.xlabel('Genre')
-        plt.ylabel('Average Number of Raters')
-        plt.xticks(rotation = 45)
-        plt.tight_layout()
-
-        return plt
+        genre_avg_raters = as_cube(data).genre_means('num_raters').sort_values(ascending=False)
+
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        ax.bar(genre_avg_raters.index, genre_avg_raters, color='#CBC3E3', edgecolor='grey')
+        ax.set_title('Average Number of Raters by Genre')
+        ax.set_xlabel('Genre')
+        ax.set_ylabel('Average Number of Raters')
+        ax.tick_params(axis='x', labelrotation=45)
+        fig.tight_layout()
+
+        return fig
     except Exception as e:
         raise PlottingError(f"An error occurred while plotting raters by genre : {e}")
 
@@ -0,0 +1,201 @@
+import os
+import numpy as np
+from dataset import movie_years
+from genre_index import ensure_genre_index, genre_bits, genre_vocabulary, MASK_COLUMN
+from file_handling import source_fingerprint
+from exceptions import FileHandlingError
+from instrumentation import instrumented
+
+# columns with a presorted order kept next to the clean file
+RANK_COLUMNS = ['rating', 'run_length', 'num_raters']
+
+# a filtered top or bottom k walks the presorted order in blocks of at least this many rows, doubling every time
+SCAN_BLOCK = 1024
+
+# when the matches are rare near the top or bottom (no popular horror from the 2000s, say) the walk gives up after
+# one in this many rows and filters every row in file order instead, reading rows in order beats jumping around
+SCAN_LIMIT_RATIO = 16
+
+# for every rank column the row positions of the clean file sorted from the lowest value to the highest, ties in file order,
+# and the values in that order. the bottom k is the first k positions and the top k sits at the end, so neither needs a sort
+# ties always go to the movie that comes first in the file, the same movie nlargest, nsmallest, idxmax and idxmin pick
+class RankIndex:
+    def __init__(self, orders, sorted_values, df):
+        df = ensure_genre_index(df)
+        self.orders = orders # column -> row positions, lowest value first
+        # column -> values in that order, for binary searches. kept in the dtype the loaded dataset has, an index
+        # built at cleaning time has float64 ratings and 7.1 is not the same number as the float32 7.1 of the dataset
+        self.sorted_values = {column: values.astype(df[column].to_numpy().dtype, copy=False) for column, values in sorted_values.items()}
+        self.row_count = len(df)
+        self.years = movie_years(df).to_numpy()
+        self.masks = df[MASK_COLUMN].to_numpy()
+        self.df = df
+
+    @classmethod
+    def from_frame(cls, df):
+        # one stable sort per column, every lookup after this is a binary search or a walk over the first few positions
+        id_dtype = np.int32 if len(df) < 2**31 else np.int64
+        orders = {}
+        sorted_values = {}
+        for column in RANK_COLUMNS:
+            values = df[column].to_numpy()
+            orders[column] = np.argsort(values, kind='stable').astype(id_dtype)
+            sorted_values[column] = values[orders[column]]
+        return cls(orders, sorted_values, df)
+
+    def top(self, column, k, genres=None, match='any', year_min=None, year_max=None):
+        # positions of the k movies with the highest values, highest first
+        order, values = self.orders[column], self.sorted_values[column]
+        keep = self._filter(genres, match, year_min, year_max)
+        k = min(k, self.row_count)
+        if k <= 0:
+            return order[:0]
+
+        # walking back from the highest value until the rows walked hold k matches
+        end = self.row_count
+        block = k if keep is None else max(SCAN_BLOCK, 4 * k)
+        found = 0
+        while end > 0 and found < k:
+            if self.row_count - end > self.row_count // SCAN_LIMIT_RATIO:
+                return self._select(column, k, keep, highest=True)
+            start = max(0, end - block)
+            found += len(order[start:end]) if keep is None else int(keep(order[start:end]).sum())
+            end = start
+            block *= 2
+
+        # movies tied with the lowest one walked may sit further back and come first in the file, so they are taken too
+        if end < self.row_count:
+            end = int(np.searchsorted(values, values[end], side='left'))
+        rows, row_values = order[end:], values[end:]
+        if keep is not None:
+            matched = keep(rows)
+            rows, row_values = rows[matched], row_values[matched]
+        # only the walked rows get sorted, highest value first and then by position like nlargest
+        first = np.lexsort((rows, -row_values.astype(float)))[:k]
+        return rows[first]
+
+    def bottom(self, column, k, genres=None, match='any', year_min=None, year_max=None):
+        # positions of the k movies with the lowest values, lowest first
+        order = self.orders[column]
+        keep = self._filter(genres, match, year_min, year_max)
+        k = max(0, min(k, self.row_count))
+        if keep is None:
+            return order[:k]
+
+        # ties are already in file order here, so the first k matches in the walk are the answer
+        found = []
+        found_count = 0
+        start = 0
+        block = max(SCAN_BLOCK, 4 * k)
+        while found_count < k and start < self.row_count:
+            if start > self.row_count // SCAN_LIMIT_RATIO:
+                return self._select(column, k, keep, highest=False)
+            rows = order[start:start + block]
+            rows = rows[keep(rows)]
+            found.append(rows)
+            found_count += len(rows)
+            start += block
+            block *= 2
+        return np.concatenate(found)[:k] if found else order[:0]
+
+    def _select(self, column, k, keep, highest):
+        # every row checked in file order, then a partial selection of the k best matches instead of a full sort
+        rows = np.flatnonzero(keep(None))
+        values = self.df[column].to_numpy()[rows].astype(float)
+        if highest:
+            values = -values
+        if k < len(rows):
+            # everything tied with the k-th best value stays in so the tie goes to the first movie in the file
+            threshold = np.partition(values, k - 1)[k - 1]
+            candidates = values <= threshold
+            rows, values = rows[candidates], values[candidates]
+        return rows[np.lexsort((rows, values))[:k]]
+
+    def rank(self, column, positions):
+        # 1 for the highest value, movies with the same value share the best rank like rank(method='min', ascending=False)
+        values = self.df[column].to_numpy()[positions]
+        return self.row_count - np.searchsorted(self.sorted_values[column], values, side='right') + 1
+
+    def percentile(self, column, positions):
+        # share of movies with the same or a lower value, in percent, like rank(method='max', pct=True) * 100
+        values = self.df[column].to_numpy()[positions]
+        return np.searchsorted(self.sorted_values[column], values, side='right') / self.row_count * 100
+
+    def movie_ranks(self, position):
+        # {column: (rank, percentile)} for the movie at this position of the clean file
+        return {column: (int(self.rank(column, position)), float(self.percentile(column, position))) for column in RANK_COLUMNS}
+
+    def _filter(self, genres, match, year_min, year_max):
+        # a function telling which of the given positions (all of them for None) pass the genre and year filters,
+        # None when there are no filters
+        if match not in ('any', 'all'):
+            raise ValueError(f"match must be 'any' or 'all', not {match}")
+        genres = list(genres or [])
+        if not genres and year_min is None and year_max is None:
+            return None
+        bits = genre_bits(self.df, genres)
+        known = all(genre in genre_vocabulary(self.df) for genre in genres)
+
+        def keep(rows):
+            row_masks = self.masks if rows is None else self.masks[rows]
+            row_years = self.years if rows is None else self.years[rows]
+            passed = np.ones(len(row_masks), dtype=bool)
+            if genres:
+                if match == 'all':
+                    passed &= ((row_masks & bits) == bits) & known
+                else:
+                    passed &= (row_masks & bits) != 0
+            if year_min is not None:
+                passed &= row_years >= year_min
+            if year_max is not None:
+                passed &= row_years <= year_max
+            return passed
+        return keep
+
+    def save(self, path, fingerprint):
+        # writing to a temp file first so a reader never sees half an index
+        try:
+            tmp_path = path + '.tmp.npz'
+            arrays = {}
+            for column in RANK_COLUMNS:
+                arrays[f'order_{column}'] = self.orders[column]
+                arrays[f'values_{column}'] = self.sorted_values[column]
+            np.savez(tmp_path, fingerprint=np.array(fingerprint), **arrays)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            raise FileHandlingError(f"Error saving rank index to {path}: {e}")
+
+    @classmethod
+    def load(cls, path, fingerprint, df):
+        # returns None when there is no index or it was built from another version of the clean file
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if str(data['fingerprint']) != fingerprint or len(data[f'order_{RANK_COLUMNS[0]}']) != len(df):
+                    return None
+                orders = {column: data[f'order_{column}'] for column in RANK_COLUMNS}
+                sorted_values = {column: data[f'values_{column}'] for column in RANK_COLUMNS}
+            return cls(orders, sorted_values, df)
+        except Exception: # a broken index is just rebuilt
+            return None
+
+def ranks_path_for(filename): # the rank index lives right next to the clean csv
+    return os.path.splitext(filename)[0] + '.ranks.npz'
+
+def save_ranks(ranks, filename):
+    ranks.save(ranks_path_for(filename), source_fingerprint(filename))
+
+@instrumented
+def load_ranks(filename="clean_movie_data.csv", df=None):
+    # the rank index saved when filename was cleaned, rebuilt from df (or the file) when it is missing or out of date
+    # positions are row positions of the clean file, so df has to be the clean file in its own order
+    if df is None:
+        from dataset import load_dataset
+        df = load_dataset(filename)
+    fingerprint = source_fingerprint(filename)
+    ranks = RankIndex.load(ranks_path_for(filename), fingerprint, df)
+    if ranks is None:
+        ranks = RankIndex.from_frame(df)
+        ranks.save(ranks_path_for(filename), fingerprint)
+    return ranks
@@ -0,0 +1,303 @@
+import io
+import multiprocessing
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg') # we only ever draw into image bytes, never to a window
+from dataset import get_dataset, dataset_version
+from aggregate_cube import load_cube, as_cube
+from exceptions import PlottingError
+from plotting import release_figure
+from partition_store import query_movies
+from instrumentation import instrumented
+
+# how much memory the encoded images may use before the least recently used ones are thrown away
+DEFAULT_BUDGET_MB = int(os.environ.get('MOVIES_RENDER_CACHE_MB', 64))
+
+# same settings st.pyplot uses so the cached images look the same as before
+SAVEFIG_OPTIONS = {'dpi': 200, 'bbox_inches': 'tight'}
+
+# worker processes that draw the figures of a page at the same time, 0 draws them one by one in the calling process
+# the analysis page has 8 charts, and with a single cpu the workers would only add overhead
+_cpus = os.cpu_count() or 1
+DEFAULT_RENDER_WORKERS = int(os.environ.get('MOVIES_RENDER_WORKERS', min(8, _cpus) if _cpus > 1 else 0))
+
+# how long a page waits for a figure from the workers before drawing it itself, see FigureRenderer.image
+DEFAULT_RENDER_TIMEOUT = float(os.environ.get('MOVIES_RENDER_TIMEOUT', 30))
+
+# matplotlib is not thread safe even with one Figure per chart, so a process draws one figure at a time
+# and drawing several at once takes the worker processes of a FigureRenderer
+_draw_lock = threading.Lock()
+
+def _new_draw_lock():
+    # a forked worker starts with a free lock, whatever the app's other threads were doing at the time
+    global _draw_lock
+    _draw_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_new_draw_lock)
+
+class RenderCache:
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.images = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, count=True):
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                self.misses += count
+                return None
+            self.images.move_to_end(key) # most recently used goes to the back
+            self.hits += count
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.images:
+                self.used_bytes -= len(self.images.pop(key))
+            if len(image) > self.budget_bytes: # never fits, not worth keeping
+                return
+            self.images[key] = image
+            self.used_bytes += len(image)
+            # evicting the least recently used images until we are back under the budget
+            while self.used_bytes > self.budget_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.used_bytes -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.used_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.images), 'bytes': self.used_bytes, 'budget_bytes': self.budget_bytes, 'hits': self.hits, 'misses': self.misses}
+
+# one cache for the whole process, shared by every streamlit session
+render_cache = RenderCache(DEFAULT_BUDGET_MB * 1024 * 1024)
+
+@instrumented
+def encode_figure(fig, fmt='png'):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt, **SAVEFIG_OPTIONS)
+    return buffer.getvalue()
+
+def render_key(plot_function, version, fmt, params):
+    return (version, plot_function.__module__, plot_function.__name__, fmt, tuple(sorted(params.items())))
+
+def draw_figure(plot_function, data, fmt='png', params=None):
+    # the plotting functions hand back their own Figure, nothing is left behind in pyplot
+    # only the encoded image outlives this call, the figure goes back to the plotting module's pool
+    try:
+        fig = plot_function(data, **(params or {}))
+        try:
+            return encode_figure(fig, fmt)
+        finally:
+            release_figure(fig)
+    except PlottingError:
+        raise
+    except Exception as e:
+        raise PlottingError(f"An error occurred while rendering {plot_function.__name__} : {e}")
+
+def render_figure(plot_function, df, version, fmt='png', cache=render_cache, **params):
+    # returns the encoded image for plot_function(df, **params), drawing it only on a cache miss
+    # version has to change whenever df does, it is normally the dataset fingerprint
+    key = render_key(plot_function, version, fmt, params)
+    image = cache.get(key)
+    if image is not None:
+        return image
+
+    with _draw_lock:
+        # another session may have drawn it while we were waiting
+        image = cache.get(key, count=False)
+        if image is not None:
+            return image
+        image = draw_figure(plot_function, df, fmt, params)
+
+    cache.put(key, image)
+    return image
+
+# the data of every clean file a worker has drawn from, loaded once per version
+_worker_cubes = {}
+
+def filters_key(filters):
+    # the genres and years a figure is drawn for, hashable and in a fixed order so they can go in a cache key
+    if not filters:
+        return ()
+    return tuple(sorted((name, tuple(value) if isinstance(value, (list, tuple)) else value) for name, value in filters.items()))
+
+def source_data(filename, version, source, filters=None):
+    # the frame or the aggregate cube of filename, in whatever process is drawing
+    # with filters (the arguments of partition_store.query_movies) only those movies, read from their partitions
+    if dataset_version(filename) != version:
+        raise PlottingError(f"{filename} changed while its figures were being drawn")
+    if filters:
+        df = query_movies(filename, **filters)
+        if df.empty:
+            raise PlottingError("No movies match these genres and years.")
+        return df if source == 'frame' else as_cube(df)
+    df = get_dataset(filename)
+    if source == 'frame':
+        return df
+    if _worker_cubes.get(filename, (None,))[0] != version:
+        _worker_cubes[filename] = (version, load_cube(filename, df))
+    return _worker_cubes[filename][1]
+
+def draw_from_file(filename, version, plot_function, source, fmt, params, filters=None):
+    # runs in a worker process, only the names travel to it and the encoded image travels back
+    try:
+        data = source_data(filename, version, source, filters)
+    except PlottingError:
+        raise
+    except Exception as e:
+        raise PlottingError(f"An error occurred while loading {filename} to draw {plot_function.__name__} : {e}")
+    with _draw_lock:
+        return draw_figure(plot_function, data, fmt, params)
+
+def start_worker(filename):
+    # making sure the worker has the dataset as soon as it starts, so the first figures do not wait for it
+    # a forked worker already has the one the app loaded through get_dataset
+    try:
+        get_dataset(filename)
+    except Exception:
+        pass # the figures that need it report the error
+
+# draws the independent charts of a page in a pool of worker processes, so with a cpu per chart they are drawn side
+# by side instead of one after another ("benchmarks.py --bench render" shows how close a page gets to its slowest
+# chart on a given machine). the data is never sent to the workers, each one reads the clean
+# file through dataset.get_dataset (inherited from the app when forked, else mapped from the shared dataset) and only draws from it
+class FigureRenderer:
+    def __init__(self, filename="clean_movie_data.csv", workers=DEFAULT_RENDER_WORKERS, cache=render_cache):
+        self.filename = os.path.abspath(filename)
+        self.workers = workers
+        self.cache = cache
+        self.pool = None
+        self.drawing = {} # key -> future of a figure being drawn, sessions asking for the same figure share it
+        self.requests = weakref.WeakKeyDictionary() # future -> what it draws, to draw it here if the workers do not
+        self.lock = threading.Lock()
+
+    def start(self):
+        # starting the workers ahead of the first page, they load the dataset while the page renders its text
+        # forked where we can: streamlit runs the app as __main__, so spawned workers would run the whole page again
+        # on start, while forked ones begin with the modules and the dataset the app already has in memory
+        # known risk: by the time a page starts them streamlit's server threads are running and pandas and pyarrow
+        # have started theirs, and a lock one of those threads held at the fork stays locked for good in the worker.
+        # the workers only draw with matplotlib, but a worker stuck that way would never answer, so the page waits
+        # through image(), which gives up on the workers after a timeout and draws in the app instead
+        with self.lock:
+            if self.pool is None and self.workers > 0:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=start_worker, initargs=(self.filename,))
+                for _ in range(self.workers):
+                    self.pool.submit(int) # a worker is only started once there is work for it
+        return self
+
+    def submit(self, plot_function, version, source='frame', fmt='png', filters=None, **params):
+        # returns a future of the encoded image for plot_function on the frame or the cube of the clean file
+        # the images go into the same cache render_figure uses, a cached one comes back as a finished future
+        # filters narrow the movies down to some genres and years, they are part of the version the image is cached under
+        cache_version = (version, filters_key(filters)) if filters else version
+        key = render_key(plot_function, cache_version, fmt, params)
+        image = self.cache.get(key)
+        if image is not None:
+            return _finished(image)
+        request = (plot_function, version, source, fmt, filters, params)
+        if self.workers <= 0:
+            try:
+                return _finished(self._draw_here(*request))
+            except PlottingError as e:
+                return _finished(error=e)
+
+        with self.lock:
+            future = self.drawing.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self.drawing[key] = future
+            self.requests[future] = request
+        pool = self.start().pool
+        try:
+            work = pool.submit(draw_from_file, self.filename, version, plot_function, source, fmt, params, filters)
+        except Exception as e: # a pool that broke earlier or was shut down
+            self._failed(key, future, e, pool)
+            return future
+        work.add_done_callback(lambda work: self._done(key, work, future, pool))
+        return future
+
+    def image(self, future, timeout=DEFAULT_RENDER_TIMEOUT):
+        # the image of a future from submit, drawn here in the calling process when the workers do not deliver it
+        # within timeout seconds. the workers are then given up on and every later figure is drawn here too
+        if self.workers <= 0 and not future.done() and future in self.requests:
+            # sent to workers that were given up on, it would only come back after another timeout or never
+            return self._draw_here(*self.requests[future])
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            self._stop_workers(f"no figure came back from the workers within {timeout:g}s")
+        except PlottingError:
+            if self.workers > 0 or future not in self.requests:
+                raise # the figure itself failed, drawing it here would fail the same way
+        return self._draw_here(*self.requests[future])
+
+    def _draw_here(self, plot_function, version, source, fmt, filters, params):
+        cache_version = (version, filters_key(filters)) if filters else version
+        data = source_data(self.filename, version, source, filters)
+        return render_figure(plot_function, data, cache_version, fmt, self.cache, **params)
+
+    def _stop_workers(self, reason):
+        with self.lock:
+            if self.workers <= 0:
+                return
+            print(f"Drawing the figures in this process from now on, {reason}")
+            self.workers = 0
+            if self.pool is not None:
+                # not waiting for a worker that may never answer, the figures it still had are drawn here
+                # and the stuck workers are killed, or the app would wait for them when it exits
+                processes = list((getattr(self.pool, '_processes', None) or {}).values())
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                for process in processes:
+                    process.terminate()
+                self.pool = None
+
+    def _done(self, key, work, future, pool):
+        try:
+            image = work.result()
+        except Exception as e:
+            self._failed(key, future, e, pool)
+            return
+        self.cache.put(key, image)
+        with self.lock:
+            self.drawing.pop(key, None)
+        future.set_result(image)
+
+    def _failed(self, key, future, error, pool):
+        with self.lock:
+            self.drawing.pop(key, None)
+            if not isinstance(error, PlottingError) and self.pool is pool:
+                # a worker died, the pool is no use anymore and the next figure starts a new one
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+        future.set_exception(error if isinstance(error, PlottingError) else PlottingError(f"A figure worker failed : {error}"))
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+                self.pool = None
+
+def _finished(image=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(image)
+    return future
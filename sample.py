@@ -1,22 +1,77 @@
 import streamlit as st
 import pandas as pd
-from PIL import Image
 import base64
-import matplotlib.pyplot as plt
-from plotting import plot_movies_by_genre_over_time, plot_genre_ratings_bar, plot_ratings_vs_raters, plot_runtime_vs_year, plot_ratings_distribution, plot_runtime_distribution, plot_movies_by_decade, plot_raters_by_genre_bar
-from file_handling import load_clean_data
+import threading
+import instrumentation
+from dataset import get_dataset, dataset_version, CLEAN_COLUMNS
 from exceptions import FileHandlingError, PlottingError
 
-try:
-    df = load_clean_data('clean_movie_data.csv')
-    df['rel_date'] = pd.to_datetime(df['rel_date'], errors='coerce')
-    df['year'] = df['rel_date'].dt.year
-except FileNotFoundError:
-    raise FileHandlingError("Clean data file not found.")
-except pd.errors.EmptyDataError:
-    raise FileHandlingError("Loaded data file is empty.")
-except Exception as e:
-    raise FileHandlingError(f"An error occurred while loading the data : {e}")
+# streamlit runs this whole file again on every click, so only what every page needs is imported up here
+# matplotlib and the charts are imported by the analysis page and the search indexes by the search page
+
+# everything timed from here on belongs to this rerun, the performance panel at the bottom shows it
+run_mark = instrumentation.mark()
+
+# loaded and derived once for every rerun and every session, the version argument makes a new clean file load again
+# the frame is shared so nothing below is allowed to modify it, in-process figure drawing gets the same one from get_dataset
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_shared_dataset(filename, version):
+    return get_dataset(filename)
+
+def dataset():
+    # every movie, only loaded once a page needs all of them. the search page reads just the partitions it shows
+    try:
+        return load_shared_dataset('clean_movie_data.csv', version)
+    except FileNotFoundError:
+        raise FileHandlingError("Clean data file not found.")
+    except pd.errors.EmptyDataError:
+        raise FileHandlingError("Loaded data file is empty.")
+    except Exception as e:
+        raise FileHandlingError(f"An error occurred while loading the data : {e}")
+
+version = dataset_version('clean_movie_data.csv')
+
+# the per year and genre counts and sums saved by data_cleaning.py, the count and average charts only read these
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_aggregate_cube(version):
+    from aggregate_cube import load_cube
+    return load_cube('clean_movie_data.csv', dataset())
+
+# the same summary numbers summarize.py writes to movie_summary.txt, worked out once per dataset version
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_summary(version):
+    from summary_stats import SummaryStats
+    return SummaryStats.from_frame(dataset(), load_aggregate_cube(version), load_rank_index(version)).result()
+
+# the presorted orders of rating, run_length and num_raters saved by data_cleaning.py, for the top and bottom movies
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_rank_index(version):
+    from rank_index import load_ranks
+    return load_ranks('clean_movie_data.csv', dataset())
+
+# the clean file stored per genre, written once per dataset version. a search only reads the genre it asks for
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_partition_store(version):
+    from partition_store import load_partitions
+    return load_partitions('clean_movie_data.csv')
+
+# without pyarrow there are no partitions, the search indexes over every movie answer the same queries
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_movie_index(version):
+    from movie_query import MovieIndex
+    return MovieIndex(dataset())
+
+def find_movies(columns, genres, year_min=None, year_max=None):
+    store = load_partition_store(version)
+    if store is None:
+        return load_movie_index(version).query(genres=genres, year_min=year_min, year_max=year_max, page_size=None, columns=columns)[1]
+    return store.query(genres, year_min=year_min, year_max=year_max, columns=columns)
+
+# one pool of figure drawing processes for the whole app, started the first time the analysis page is shown
+@st.cache_resource(show_spinner=False)
+def figure_renderer():
+    from render_cache import FigureRenderer
+    return FigureRenderer('clean_movie_data.csv').start()
 
 def get_base64(bin_file):
     try:
@@ -26,10 +81,11 @@ def get_base64(bin_file):
     except Exception as e:
         raise FileHandlingError(f"An error occurred while encoding the image: {e}")
 
-def set_background(png_file):
-    try:
-        bin_str = get_base64(png_file)
-        page_bg_img = '''
+# the background image is encoded and put into the stylesheet once per process, every rerun just sends the string again
+@st.cache_resource(show_spinner=False)
+def background_style(png_file):
+    bin_str = get_base64(png_file)
+    return '''
         <style>
         .stApp {
             background-image: url("data:image/png;base64,%s");
@@ -49,13 +105,27 @@ def set_background(png_file):
             text-shadow: 1px 1px 2px rgba(0, 0, 0, 0.5);
         }
         </style>''' % bin_str
-        st.markdown(page_bg_img, unsafe_allow_html=True)
+
+def set_background(png_file):
+    try:
+        st.markdown(background_style(png_file), unsafe_allow_html=True)
     except Exception as e:
         raise PlottingError(f"An error occurred while setting the background: {e}")
 
 set_background('movie-back.png')
 
 def basic_analysis():
+    from plotting import plot_movies_by_genre_over_time, plot_genre_ratings_bar, plot_ratings_vs_raters, plot_runtime_vs_year, plot_ratings_distribution, plot_runtime_distribution, plot_movies_by_decade, plot_raters_by_genre_bar
+    from summary_stats import summary_lines
+
+    # asking for every chart up front, the workers draw them while the text and tables below are sent
+    renderer = figure_renderer()
+    figures = {plot_function: renderer.submit(plot_function, version, source='cube') for plot_function in (
+        plot_runtime_distribution, plot_ratings_distribution, plot_genre_ratings_bar, plot_raters_by_genre_bar,
+        plot_movies_by_decade, plot_movies_by_genre_over_time)}
+    figures[plot_ratings_vs_raters] = renderer.submit(plot_ratings_vs_raters, version, log_raters=st.session_state.get('log_raters', False))
+    figures[plot_runtime_vs_year] = renderer.submit(plot_runtime_vs_year, version)
+
     st.title('Movies Dataset Analysis')
 
     st.header('An EDA')
@@ -65,22 +135,25 @@ def basic_analysis():
     )
     st.markdown('<hr>', unsafe_allow_html=True)
 
+    st.subheader('Dataset Summary:')
+    try:
+        st.text(''.join(summary_lines(load_summary(version))[2:])) # skipping the title lines, the page has its own
+    except Exception as e:
+        raise FileHandlingError(f"An error occurred while summarizing the dataset : {e}")
+
+    st.markdown('<hr>', unsafe_allow_html=True)
+
     st.subheader('Top 10 Highest Rated Movies:')
     try:
-        df = pd.read_csv('clean_movie_data.csv')
-        top_10 = df.sort_values('rating', axis=0, ascending=False).head(10)
-        st.dataframe(top_10, hide_index=True)
-    except FileNotFoundError:
-        raise FileHandlingError("Clean data file not found.")
-    except pd.errors.EmptyDataError:
-        raise FileHandlingError("Loaded data file is empty.")
+        top_10 = dataset().iloc[load_rank_index(version).top('rating', 10)]
+        st.dataframe(top_10[CLEAN_COLUMNS], hide_index=True)
     except Exception as e:
         raise FileHandlingError(f"An error occurred while fetching the top 10 highest rated movies : {e}")
 
     st.subheader('Top 10 Lowest Rated Movies:')
     try:
-        last_10 = df.sort_values('rating', axis=0, ascending=True).head(10)
-        st.dataframe(last_10, hide_index=True)
+        last_10 = dataset().iloc[load_rank_index(version).bottom('rating', 10)]
+        st.dataframe(last_10[CLEAN_COLUMNS], hide_index=True)
     except Exception as e:
         raise FileHandlingError(f"An error occurred while fetching the top 10 lowest rated movies : {e}")
 
@@ -93,8 +166,7 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        g1 = plot_runtime_distribution(df)
-        st.pyplot(g1)
+        st.image(renderer.image(figures[plot_runtime_distribution]))
         st.write('fig.1 : Runtime Histogram')
     except PlottingError as e:
         st.write(f"An error occurred while plotting runtime distribution : {e}")
@@ -102,8 +174,7 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        g2 = plot_ratings_distribution(df)
-        st.pyplot(g2)
+        st.image(renderer.image(figures[plot_ratings_distribution]))
         st.write('fig.2 : Ratings Histogram')
     except PlottingError as e:
         st.write(f"An error occurred while plotting ratings distribution : {e}")
@@ -111,8 +182,7 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        g3 = plot_genre_ratings_bar(df)
-        st.pyplot(g3)
+        st.image(renderer.image(figures[plot_genre_ratings_bar]))
         st.write('fig.3 : Genre by Ratings Bar Graph')
     except PlottingError as e:
         st.write(f"An error occurred while plotting genre ratings bar graph : {e}")
@@ -120,9 +190,7 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        df = load_clean_data('clean_movie_data.csv')
-        g8 = plot_raters_by_genre_bar(df)
-        st.pyplot(g8)
+        st.image(renderer.image(figures[plot_raters_by_genre_bar]))
         st.write('fig.4 : Average Number of Raters by Genre Bar Graph')
     except PlottingError as e:
         st.write(f"An error occurred while plotting raters by genre : {e}")
@@ -130,8 +198,8 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        g4 = plot_ratings_vs_raters(df)
-        st.pyplot(g4)
+        st.checkbox('Log scale for number of raters', key='log_raters') # read through session_state when the charts are asked for
+        st.image(renderer.image(figures[plot_ratings_vs_raters]))
         st.write('fig.4 : Ratings by Number of Raters Scatter Plot')
     except PlottingError as e:
         st.write(f"An error occurred while plotting ratings vs number of raters : {e}")
@@ -139,8 +207,7 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        g5 = plot_runtime_vs_year(df)
-        st.pyplot(g5)
+        st.image(renderer.image(figures[plot_runtime_vs_year]))
         st.write('fig.5 : Runtime by Year Scatter Plot')
     except PlottingError as e:
         st.write(f"An error occurred while plotting runtime vs year : {e}")
@@ -148,8 +215,7 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        g6 = plot_movies_by_decade(df)
-        st.pyplot(g6)
+        st.image(renderer.image(figures[plot_movies_by_decade]))
         st.write('fig.6 : Movies by Decade Bar Graph')
     except PlottingError as e:
         st.write(f"An error occurred while plotting movies by decade : {e}")
@@ -157,9 +223,7 @@ def basic_analysis():
     st.markdown('<hr>', unsafe_allow_html=True)
 
     try:
-        df = load_clean_data('clean_movie_data.csv')
-        g7 = plot_movies_by_genre_over_time(df)
-        st.pyplot(g7)
+        st.image(renderer.image(figures[plot_movies_by_genre_over_time]))
         st.write('fig.7 : Number of Movies Growth by Genre Over Time Line Plot')
     except PlottingError as e:
         st.write(f"An error occurred while plotting movies by genre over time : {e}")
@@ -171,36 +235,49 @@ def search():
     selected_genre = st.selectbox('Select Genre:', {'Action', 'War', 'Sport', 'Thriller', 'Drama', 'Biography', 'Comedy', 'Animation', 'Adventure', 'Romance', 'Mystery', 'Crime', 'Music', 'Horror', 'Western', 'Sci-Fi', 'History'})
 
     try:
-        filtered_df = df[df['genres'].apply(lambda genres: selected_genre in genres)]
+        filtered_df = find_movies(['name', 'genres'], [selected_genre])
         if filtered_df.empty:
             st.write(f"No movies found for genre '{selected_genre}'.")
         else:
             st.write(f"Movies in genre '{selected_genre}':")
-            st.dataframe(filtered_df[['name', 'genres']], hide_index=True)
+            st.dataframe(filtered_df, hide_index=True)
     except Exception as e:
         raise PlottingError(f"An error occurred while searching for movies by genre : {e}")
 
-    unique_years = sorted(df['year'].unique())
-    selected_year = st.selectbox('Select Year', unique_years)
+    store = load_partition_store(version)
+    selected_year = st.selectbox('Select Year', load_movie_index(version).year_values if store is None else store.year_values)
 
     try:
-        filtered_df = df[
-            (df['genres'].apply(lambda genres: selected_genre in genres)) &
-            (df['year'] == selected_year)
-        ]
+        filtered_df = find_movies(['name', 'genres', 'year'], [selected_genre], selected_year, selected_year)
 
         if filtered_df.empty:
             st.write(f"No movies found for genre '{selected_genre}' in the year {selected_year}.")
         else:
             st.write(f"Movies in genre '{selected_genre}' from {selected_year}:")
-            st.dataframe(filtered_df[['name', 'genres', 'year']], hide_index=True)
+            st.dataframe(filtered_df, hide_index=True)
     except Exception as e:
         raise PlottingError(f"An error occurred while searching for movies by genre and year : {e}")
 
 st.sidebar.title('Make Your Choice')
-ch = st.sidebar.selectbox('Select page : ', {'Movie Dataset Analysis', 'Search For Movies'})
+# a list so the analysis page is always the one shown first, the key lets a page be picked before the first run
+ch = st.sidebar.selectbox('Select page : ', ['Movie Dataset Analysis', 'Search For Movies'], key='page')
+
+def performance_panel(since):
+    # the stages of this rerun of this session, timings only exist when the app was started with MOVIES_PROFILE=1
+    stage_records = instrumentation.records(since=since, thread=threading.get_ident())
+    st.sidebar.subheader('Performance')
+    peak_rss = instrumentation.peak_rss_mb() # None where there is no resource module, like on windows
+    st.sidebar.write(f"This run: {sum(record['seconds'] for record in stage_records if record['depth'] == 0):.2f}s"
+                     + (f", peak memory of the app: {peak_rss:.0f} MB" if peak_rss is not None else ""))
+    columns = ['name', 'calls', 'seconds', 'rows', 'heap_peak_mb']
+    st.sidebar.dataframe(pd.DataFrame(instrumentation.summary(stage_records), columns=columns), hide_index=True)
 
 if ch == 'Movie Dataset Analysis':
-    basic_analysis()
+    with instrumentation.stage('sample.page.analysis'):
+        basic_analysis()
 elif ch == 'Search For Movies':
-    search()
+    with instrumentation.stage('sample.page.search'):
+        search()
+
+if instrumentation.enabled():
+    performance_panel(run_mark)
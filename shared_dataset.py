@@ -0,0 +1,146 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from genre_index import MASK_COLUMN
+from instrumentation import instrumented
+
+# pyarrow is only needed for the shared dataset, without it every process loads its own copy like before
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+    ipc = None
+
+# fcntl only exists on unix, elsewhere two processes may both publish the same version, which is just wasted work
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# the prepared dataset of every version of the clean file is published once as an uncompressed arrow file that
+# every process maps into memory. the pages of the file are kept once by the os, so all the streamlit servers and the
+# figure and report workers of a host read the same memory instead of each one holding a private copy
+# MOVIES_SHARED_DATASET=0 turns it off, MOVIES_SHARED_DIR=/dev/shm keeps the files in shared memory instead of on disk
+SHARED_ENV = 'MOVIES_SHARED_DATASET'
+SHARED_DIR_ENV = 'MOVIES_SHARED_DIR'
+SHARED_DATASET = os.environ.get(SHARED_ENV, '1') != '0'
+
+VOCABULARY_KEY = b'genre_vocabulary'
+
+def shared_available():
+    return SHARED_DATASET and pa is not None
+
+def shared_stem_for(filename):
+    # next to the clean csv by default, in MOVIES_SHARED_DIR with a hash of the csv path so two clean files never collide
+    shared_dir = os.environ.get(SHARED_DIR_ENV)
+    stem = os.path.splitext(os.path.abspath(filename))[0]
+    if not shared_dir:
+        return stem
+    path_hash = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=4).hexdigest()
+    return os.path.join(shared_dir, f"{os.path.basename(stem)}-{path_hash}")
+
+def shared_path_for(filename, version):
+    # one file per version, a new clean file gets a new name so processes still mapping the old one are left alone
+    return f"{shared_stem_for(filename)}.{version}.arrow"
+
+@instrumented
+def publish_dataset(df, filename, version):
+    # writing the prepared frame to a temp file first so a process never maps half a dataset, then removing the
+    # files of older versions. a process that still maps one keeps reading it until it moves on to the new version
+    path = shared_path_for(filename, version)
+    table = pa.Table.from_pandas(df, preserve_index=False).combine_chunks()
+    metadata = {**(table.schema.metadata or {}), VOCABULARY_KEY: json.dumps(df.attrs.get('genre_vocabulary', [])).encode()}
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    for old_path in glob.glob(f"{glob.escape(shared_stem_for(filename))}.*.arrow"):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError: # windows does not remove a file another process has mapped, the next publish tries again
+                pass
+    return path
+
+@instrumented
+def attach_dataset(filename, version):
+    # the published frame of this version mapped into memory, None when it has not been published yet
+    # the columns point straight into the mapped file and are read only, nothing is copied but the genre names
+    path = shared_path_for(filename, version)
+    if not os.path.exists(path):
+        return None
+    try:
+        table = ipc.open_file(pa.memory_map(path)).read_all()
+    except (OSError, pa.ArrowInvalid): # removed by a newer publish in the meantime or broken, loaded again
+        return None
+    columns = {name: _column_array(table.column(name)) for name in table.column_names}
+    df = pd.DataFrame(columns, copy=False)
+    df.attrs['genre_vocabulary'] = json.loads((table.schema.metadata or {}).get(VOCABULARY_KEY, b'[]'))
+    return df
+
+def _column_array(column):
+    if column.num_chunks != 1 or column.null_count:
+        return column.to_pandas() # never written by publish_dataset, but a copy still beats failing
+    array = column.chunk(0)
+    if pa.types.is_dictionary(array.type):
+        # the genres, codes in the mapped file and the few distinct strings in this process
+        dtype = pd.CategoricalDtype(pd.Index(array.dictionary.to_pylist()))
+        return pd.Categorical.from_codes(array.indices.to_numpy(zero_copy_only=True), dtype=dtype, validate=False)
+    if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        # the titles, an arrow backed string column reads the mapped offsets and characters directly
+        return pd.array(array, dtype=pd.StringDtype('pyarrow', na_value=np.nan))
+    return array.to_numpy(zero_copy_only=True)
+
+def load_shared(filename, version, load):
+    # attaching to the published version of filename, loading it with load() and publishing it when nobody has yet
+    # a lock next to the files makes the other processes wait for the one publishing instead of all loading it too
+    df = attach_dataset(filename, version)
+    if df is not None:
+        return df
+    os.makedirs(os.path.dirname(shared_stem_for(filename)), exist_ok=True)
+    with open(f"{shared_stem_for(filename)}.lock", 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            df = attach_dataset(filename, version)
+            if df is None:
+                df = load()
+                try:
+                    publish_dataset(df, filename, version)
+                except Exception as e: # no room or no permission, this process just keeps its own copy
+                    print(f"Could not publish the shared dataset of {filename}: {e}")
+                    return df
+                # this process reads the published copy too, so its own copy can go
+                shared = attach_dataset(filename, version)
+                df = df if shared is None else shared
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    return df
+
+def shared_frame(df):
+    # True when the numeric columns of df point into a published file instead of this process's own memory
+    values = df[MASK_COLUMN].to_numpy() if MASK_COLUMN in df.columns else df.iloc[:, -1].to_numpy()
+    # with copy on write pandas hands out read only views of every frame, the array that owns the memory tells them apart
+    while isinstance(values.base, np.ndarray):
+        values = values.base
+    return not values.flags.writeable
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="publish the clean dataset once for every process of this host to map")
+    parser.add_argument('filename', nargs='?', default='clean_movie_data.csv')
+    args = parser.parse_args()
+
+    from dataset import load_dataset, dataset_version
+    df = load_dataset(args.filename)
+    if shared_frame(df):
+        print(f"Shared {len(df)} movies in {shared_path_for(args.filename, dataset_version(args.filename))}")
+    else:
+        print("The shared dataset is turned off or pyarrow is missing, nothing was published")
@@ -1,60 +1,267 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
+from dataset import get_dataset, dataset_version, movie_years, CLEAN_COLUMNS
+from genre_index import genre_bits, genre_vocabulary, MASK_COLUMN
+from summary_stats import SummaryStats, summary_lines
+from aggregate_cube import load_cube
+from rank_index import load_ranks
+from partition_store import query_movies
+from summary_sketch import stream_summary, sketch_lines, DEFAULT_CHUNK_ROWS
+from instrumentation import instrumented, stage
 
-def create_summary_txt(df, file_path):
-    total_movies = len(df)
-    df['rel_date'] = pd.to_datetime(df['rel_date'], errors='coerce') 
-    df['year'] = df['rel_date'].dt.year
-    time_span = f"{df['year'].min()} - {df['year'].max()}"
-    
-    highest_rated_movie = df.loc[df['rating'].idxmax()]['name']
-    lowest_rated_movie = df.loc[df['rating'].idxmin()]['name']
-    longest_runtime_movie = df.loc[df['run_length'].idxmax()]['name']
-    shortest_runtime_movie = df.loc[df['run_length'].idxmin()]['name']
-    most_rated_movie = df.loc[df['num_raters'].idxmax()]['name']
-    least_rated_movie = df.loc[df['num_raters'].idxmin()]['name']
+# what a batch run can split the clean file by, a movie with several genres is in the report of each of them
+DIMENSIONS = ['genre', 'decade', 'year']
 
-    df['genres'] = df['genres'].str.strip().str.split(';')
-    df_exploded = df.explode('genres')
-    most_common_genre = df_exploded['genres'].value_counts().idxmax()
-    least_common_genre = df_exploded['genres'].value_counts().idxmin()
+REPORT_FORMATS = ['txt', 'json']
 
-    year_most_movies = df['year'].value_counts().idxmax()
-    year_fewest_movies = df['year'].value_counts().idxmin()
+# bumped whenever the reports change shape, so the ones an older version wrote are all written again
+REPORT_VERSION = 1
 
-    avg_rating = df['rating'].mean()
-    avg_runtime = df['run_length'].mean()
+# kept in the output directory, it remembers which movies every report was written from
+MANIFEST_NAME = 'manifest.json'
 
-    top_5_common_genres = df_exploded['genres'].value_counts().head(5).index.tolist()
-    top_5_longest_movies = df.nlargest(5, 'run_length')['name'].tolist()
-    top_5_highest_rated_movies = df.nlargest(5, 'rating')['name'].tolist()
+# worker processes that write the reports of a batch run, 0 writes them one by one in the calling process
+_cpus = os.cpu_count() or 1
+DEFAULT_REPORT_WORKERS = int(os.environ.get('MOVIES_REPORT_WORKERS', min(8, _cpus) if _cpus > 1 else 0))
 
-    with open(file_path, 'w') as file:
-        file.write(f"Summary of Movie Dataset\n\n")
-        file.write(f"{'-'*30}\n\n")
-        file.write(f"Total Number of Movies: {total_movies}\n")
-        file.write(f"Time Span Covered: {time_span}\n\n")
+def write_summary_txt(result, file_path):
+    # writing to a temp file first so a reader never sees half a summary
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.writelines(summary_lines(result))
+    os.replace(tmp_path, file_path)
 
-        file.write(f"Highest Rated Movie: {highest_rated_movie} - {df.loc[df['rating'].idxmax()]['rating']:.1f}\n")
-        file.write(f"Lowest Rated Movie: {lowest_rated_movie} - {df.loc[df['rating'].idxmin()]['rating']:.1f}\n\n")
+def write_summary_json(result, file_path):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(result, file, indent=1, default=json_value)
+    os.replace(tmp_path, file_path)
 
-        file.write(f"Longest Runtime Movie: {longest_runtime_movie} - {df.loc[df['run_length'].idxmax()]['run_length']} minutes\n")
-        file.write(f"Shortest Runtime Movie: {shortest_runtime_movie} - {df.loc[df['run_length'].idxmin()]['run_length']} minutes\n\n")
+def json_value(value):
+    # numpy numbers from the dataset, a float32 rating goes through its own str so 7.1 stays 7.1
+    if isinstance(value, np.floating):
+        return float(str(value))
+    if isinstance(value, np.integer):
+        return int(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
 
-        file.write(f"Most Rated Movie: {most_rated_movie} - {df.loc[df['num_raters'].idxmax()]['num_raters']}\n")
-        file.write(f"Least Rated Movie: {least_rated_movie} - {df.loc[df['num_raters'].idxmin()]['num_raters']}\n\n")
+SUMMARY_WRITERS = {'txt': write_summary_txt, 'json': write_summary_json}
 
-        file.write(f"Most Common Genre: {most_common_genre}\n")  # Include the most common genre
-        file.write(f"Least Common Genre: {least_common_genre}\n\n")
+@instrumented(name='summarize.create_summary_txt')
+def create_summary_txt(df, file_path, cube=None, ranks=None):
+    # every metric is worked out once by the stats engine, this only writes them out
+    result = SummaryStats.from_frame(df, cube, ranks).result()
+    write_summary_txt(result, file_path)
+    return result
 
-        file.write(f"Year with Most Movies Released: {year_most_movies} - {df['year'].value_counts().max()}\n")
-        file.write(f"Year with Fewest Movies Released: {year_fewest_movies} - {df['year'].value_counts().min()}\n\n")
+@instrumented(name='summarize.create_streaming_summary')
+def create_streaming_summary(filename, file_path, chunksize=DEFAULT_CHUNK_ROWS):
+    # the same summary from one pass over the csv in chunks, for files too big to load. the sketch estimates
+    # (distinct titles, rating and runtime quantiles) are not in the text, they come back in the result
+    result = stream_summary(filename, chunksize).result()
+    write_summary_txt(result, file_path)
+    return result
 
-        file.write(f"Average Movie Rating: {avg_rating:.2f}\n")
-        file.write(f"Average Movie Runtime: {avg_runtime:.2f} minutes\n\n")
+def partition_rows(df, dimension):
+    # {key: row positions in file order} for every non empty partition, straight from the genre bitmasks and years
+    if dimension == 'genre':
+        masks = df[MASK_COLUMN].to_numpy()
+        partitions = {genre: np.flatnonzero(masks & genre_bits(df, [genre])) for genre in genre_vocabulary(df)}
+        return {genre: rows for genre, rows in partitions.items() if len(rows)}
+    if dimension not in ('decade', 'year'):
+        raise ValueError(f"dimension must be one of {DIMENSIONS}, not {dimension}")
+    keys = movie_years(df).to_numpy().astype(np.int64)
+    if dimension == 'decade':
+        keys = keys // 10 * 10
+    order = np.argsort(keys, kind='stable') # stable so every partition stays in file order and ties go the same way
+    values, starts = np.unique(keys[order], return_index=True)
+    return dict(zip(values.tolist(), np.split(order, starts[1:])))
 
-        file.write(f"Top 5 Most Common Genres: {', '.join(top_5_common_genres)}\n")
-        file.write(f"Top 5 Longest Movies: {', '.join(top_5_longest_movies)}\n")
-        file.write(f"Top 5 Highest Rated Movies: {', '.join(top_5_highest_rated_movies)}\n")
+def report_name(dimension, key):
+    name = f"{key}s" if dimension == 'decade' else str(key)
+    return name.replace(os.sep, '_')
 
-df = pd.read_csv('clean_movie_data.csv')
-create_summary_txt(df, 'movie_summary.txt')
+def report_paths(output_dir, dimension, key, formats):
+    return report_paths_for_name(output_dir, dimension, report_name(dimension, key), formats)
+
+def report_paths_for_name(output_dir, dimension, name, formats):
+    # the manifest keeps the report names, which already have the decade suffix
+    return {fmt: os.path.join(output_dir, dimension, f"{name}.{fmt}") for fmt in formats}
+
+# the partitions of the current version of every clean file this process wrote reports for
+# worked out once in the calling process, forked workers start with them
+_partitions = {}
+
+def cached_partitions(filename, version, dimension):
+    if dataset_version(filename) != version:
+        raise RuntimeError(f"{filename} changed while its reports were being written")
+    key = (filename, dimension)
+    if _partitions.get(key, (None,))[0] != version:
+        _partitions[key] = (version, partition_rows(get_dataset(filename), dimension))
+    return _partitions[key][1]
+
+def write_partition_report(filename, version, dimension, key, paths):
+    # one report, in whatever process is writing it. only the names travel to a worker, never the rows
+    rows = cached_partitions(filename, version, dimension)[key]
+    result = SummaryStats.from_frame(get_dataset(filename).iloc[rows]).result()
+    for fmt, path in paths.items():
+        SUMMARY_WRITERS[fmt](result, path)
+    return dimension, key
+
+def row_hashes(df):
+    # one 64 bit hash per movie over the columns of the clean file, a partition's input is the hashes of its rows
+    return pd.util.hash_pandas_object(df[CLEAN_COLUMNS], index=False).to_numpy()
+
+def partition_digest(hashes, rows):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(REPORT_VERSION).encode())
+    digest.update(hashes[rows].tobytes())
+    return digest.hexdigest()
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError): # no manifest yet or a broken one, every report is written again
+        return {}
+    return manifest if manifest.get('version') == REPORT_VERSION else {}
+
+def save_manifest(manifest, output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def _all_written(entry, output_dir, dimension, formats):
+    return all(os.path.exists(path) for name in entry['reports'] for path in report_paths_for_name(output_dir, dimension, name, formats).values())
+
+@instrumented(name='summarize.generate_reports')
+def generate_reports(filename="clean_movie_data.csv", dimensions=DIMENSIONS, output_dir='reports', formats=('txt',),
+                     workers=DEFAULT_REPORT_WORKERS, force=False):
+    # one summary per genre, decade and year of the clean file, in output_dir/<dimension>/<key>.<format>
+    # the file is loaded once and split with the genre and year indexes, and a report is only written again
+    # when the movies in its partition changed, so a run right after another one does not even load the file
+    filename = os.path.abspath(filename)
+    formats = [fmt for fmt in REPORT_FORMATS if fmt in formats]
+    version = dataset_version(filename)
+    manifest = {} if force else load_manifest(output_dir)
+    entries = manifest.get('dimensions', {})
+    counts = {'written': 0, 'skipped': 0, 'removed': 0}
+
+    # a dimension already written from this very version of the file is done, as long as its reports are all there
+    todo = []
+    for dimension in dimensions:
+        entry = entries.get(dimension)
+        if entry is not None and entry['dataset'] == version and _all_written(entry, output_dir, dimension, formats):
+            counts['skipped'] += len(entry['reports'])
+        else:
+            todo.append(dimension)
+    if not todo:
+        return counts
+
+    df = get_dataset(filename)
+    with stage('summarize.generate_reports.fingerprint', len(df)):
+        hashes = row_hashes(df)
+    tasks = []
+    new_entries = {}
+    for dimension in todo:
+        with stage('summarize.generate_reports.partition', len(df)):
+            partitions = cached_partitions(filename, version, dimension)
+        old_reports = entries.get(dimension, {}).get('reports', {})
+        reports = {}
+        for key, rows in partitions.items():
+            name = report_name(dimension, key)
+            paths = report_paths(output_dir, dimension, key, formats)
+            reports[name] = partition_digest(hashes, rows)
+            if old_reports.get(name) == reports[name] and all(os.path.exists(path) for path in paths.values()):
+                counts['skipped'] += 1
+            else:
+                tasks.append((len(rows), dimension, key, paths))
+        # a genre or year that has no movies anymore takes its old reports with it
+        for name in set(old_reports) - set(reports):
+            for path in report_paths_for_name(output_dir, dimension, name, REPORT_FORMATS).values():
+                if os.path.exists(path):
+                    os.remove(path)
+                    counts['removed'] += 1
+        new_entries[dimension] = {'dataset': version, 'reports': reports}
+        os.makedirs(os.path.join(output_dir, dimension), exist_ok=True)
+
+    # the biggest partitions first, so no worker is left with a huge genre at the end
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    done = set()
+    try:
+        if workers > 0 and len(tasks) > 1:
+            # forked like the figure workers, they start with the dataset and its partitions already in memory
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+            with ProcessPoolExecutor(min(workers, len(tasks)), mp_context=context) as pool:
+                futures = [pool.submit(write_partition_report, filename, version, dimension, key, paths) for _, dimension, key, paths in tasks]
+                for future in as_completed(futures):
+                    done.add(future.result())
+        else:
+            for _, dimension, key, paths in tasks:
+                done.add(write_partition_report(filename, version, dimension, key, paths))
+    finally:
+        # whatever got written is remembered even when a report failed, the next run only redoes the rest
+        for dimension, entry in new_entries.items():
+            missing = [report_name(dimension, key) for _, task_dimension, key, _ in tasks
+                       if task_dimension == dimension and (dimension, key) not in done]
+            for name in missing:
+                entry['reports'][name] = None
+            if missing:
+                entry['dataset'] = None
+            entries[dimension] = entry
+        save_manifest({'version': REPORT_VERSION, 'dimensions': entries}, output_dir)
+    counts['written'] = len(done)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="write movie_summary.txt, or one summary per genre, decade or year")
+    parser.add_argument('--input', default='clean_movie_data.csv')
+    parser.add_argument('--output', default='movie_summary.txt', help="where the summary of the whole file goes")
+    parser.add_argument('--by', nargs='+', choices=DIMENSIONS, default=None,
+                        help="write one summary per partition of these dimensions into --output-dir instead")
+    parser.add_argument('--output-dir', default='reports')
+    parser.add_argument('--genres', nargs='+', default=None, help="summarize only the movies of these genres, read from their partitions alone")
+    parser.add_argument('--match', choices=['any', 'all'], default='any', help="with --genres, movies with any or all of them")
+    parser.add_argument('--year-min', type=int, default=None, help="summarize only the movies released in or after this year")
+    parser.add_argument('--year-max', type=int, default=None, help="summarize only the movies released in or before this year")
+    parser.add_argument('--streaming', action='store_true', help="read the file in chunks with constant memory, for files too big to load")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNK_ROWS, help="rows read at a time with --streaming")
+    parser.add_argument('--json', action='store_true', help="also write every summary as json next to the text")
+    parser.add_argument('--workers', type=int, default=DEFAULT_REPORT_WORKERS, help="processes writing the reports of --by")
+    parser.add_argument('--force', action='store_true', help="with --by, write every report again even when its movies did not change")
+    args = parser.parse_args()
+
+    if args.by:
+        formats = ['txt', 'json'] if args.json else ['txt']
+        counts = generate_reports(args.input, args.by, args.output_dir, formats, args.workers, args.force)
+        print(f"{counts['written']} reports written, {counts['skipped']} unchanged, {counts['removed']} removed in {args.output_dir}")
+        return
+
+    filtered = args.genres or args.year_min is not None or args.year_max is not None
+    if args.streaming:
+        if filtered:
+            parser.error("--streaming summarizes the whole file, it does not take --genres or years")
+        result = create_streaming_summary(args.input, args.output, args.chunksize)
+        print(''.join(sketch_lines(result)), end='')
+    elif filtered:
+        # the query planner reads only the partitions of these genres and years, the summary is worked out on just them
+        df = query_movies(args.input, args.genres, args.match, args.year_min, args.year_max)
+        if df.empty:
+            raise SystemExit("No movies match these genres and years.")
+        result = create_summary_txt(df, args.output)
+    else:
+        df = get_dataset(args.input) # mapped from the shared copy when another process already published it
+        result = create_summary_txt(df, args.output, load_cube(args.input, df), load_ranks(args.input, df))
+    if args.json:
+        write_summary_json(result, os.path.splitext(args.output)[0] + '.json')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from dataset import CLEAN_COLUMNS
+from file_handling import load_clean_chunks
+from summary_stats import SummaryStats, summary_lines
+from exceptions import FileHandlingError
+from instrumentation import instrumented
+
+# the summary of a clean file too big to load, worked out in one pass over it in chunks. the memory it takes depends on
+# the chunk size and the sketch settings below, never on the number of movies
+#  - the counts, sums, extremes, genre and year counts and top 5 lists are exact: SummaryStats of every chunk merged
+#    into the running one. the genres and years are small dictionaries (a few dozen genres, about a hundred years)
+#    and the top 5 lists never hold more than 5 movies, with ties going the same way as on the whole frame.
+#    movie_summary.txt comes out the same as summarize.py writes it from the whole file
+#  - the number of distinct titles is a HyperLogLog estimate
+#  - the rating and runtime quantiles are t-digest estimates
+# both sketches can be merged too, so chunks read by different processes add up to the same answer
+
+# 2 ** 14 one byte registers, 16 KB. the estimate has a relative standard error of 1.04 / sqrt(2 ** 14) = 0.81%,
+# so it is within 1.6% of the true count 95% of the time. below 2.5 * 2 ** 14 titles it switches to linear counting,
+# which is close to exact that far below the register count
+HLL_PRECISION = 14
+
+# the t-digest keeps at most about as many centroids as its compression, a few KB.
+# a centroid at quantile q covers at most 2 * pi * sqrt(q * (1 - q)) / compression of the movies, and a quantile is off by
+# at most that in rank: 1.6% of the movies at the median and 0.3% at p1 and p99 with the default of 200. with values
+# that are all different it is usually under half of that. a value common enough to fill a centroid on its own (a
+# rating, the ratings have one decimal) comes back exactly, between two whole minute runtimes it can take the whole span
+TDIGEST_COMPRESSION = 200
+
+QUANTILE_COLUMNS = ['rating', 'run_length']
+QUANTILES = [0.01, 0.25, 0.5, 0.75, 0.99]
+
+# rows read at a time, the memory of a chunk is a few hundred bytes per row while it is summarized
+DEFAULT_CHUNK_ROWS = int(os.environ.get('MOVIES_SUMMARY_CHUNK_ROWS', 100_000))
+
+def _bit_length(values):
+    # the number of bits of every uint64, in six vectorized steps instead of a python loop over the values
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = values >= (np.uint64(1) << np.uint64(shift))
+        lengths[big] += shift
+        values[big] >>= np.uint64(shift)
+    return lengths + (values > 0)
+
+class HyperLogLog:
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, values):
+        # a series of titles or anything else pandas can hash, missing values are not counted
+        hashes = pd.util.hash_pandas_object(values.dropna(), index=False).to_numpy()
+        self.add_hashes(hashes)
+
+    def add_hashes(self, hashes):
+        # the first precision bits pick a register, which keeps the longest run of leading zeros seen in the rest
+        p = self.precision
+        registers = (hashes >> np.uint64(64 - p)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - p)) - 1)
+        ranks = (64 - p) - _bit_length(rest) + 1
+        np.maximum.at(self.registers, registers, ranks.astype(np.uint8))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLogs of precision {self.precision} and {other.precision}")
+        merged = HyperLogLog(self.precision)
+        merged.registers = np.maximum(self.registers, other.registers)
+        return merged
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        empty = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and empty: # few values, most registers are still empty and counting them is more precise
+            estimate = m * np.log(m / empty)
+        return int(round(estimate)) # 64 bit hashes, no correction needed for large counts
+
+    def relative_error(self):
+        return 1.04 / np.sqrt(len(self.registers))
+
+class TDigest:
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        # centroids sorted by mean, with their weights and the smallest and largest value that went into each
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.mins = np.empty(0)
+        self.maxs = np.empty(0)
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        # equal values are one weighted point from the start, a chunk of ratings or runtimes has a few hundred at most
+        means, weights = np.unique(values, return_counts=True)
+        self._compress(means, weights.astype(float), means, means)
+
+    def merge(self, other):
+        merged = TDigest(self.compression)
+        merged.means, merged.weights, merged.mins, merged.maxs = self.means, self.weights, self.mins, self.maxs
+        merged._compress(other.means, other.weights, other.mins, other.maxs)
+        return merged
+
+    def _compress(self, means, weights, mins, maxs):
+        # the points that fit in the same whole step of the k1 scale, k(q) = compression / (2 pi) * asin(2q - 1), become
+        # one centroid and a point that crosses into the next step stays on its own. the scale is steep at both ends,
+        # so the centroids there stay small and the tails precise
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        mins = np.concatenate([self.mins, mins])
+        maxs = np.concatenate([self.maxs, maxs])
+        order = np.argsort(means, kind='stable')
+        means, weights, mins, maxs = means[order], weights[order], mins[order], maxs[order]
+        q_end = np.cumsum(weights) / weights.sum()
+        q_start = q_end - weights / weights.sum()
+        step = np.floor(self._k(q_start))
+        crossing = self._k(np.minimum(q_end, 1.0)) > step + 1
+        starts = np.flatnonzero(np.r_[True, (step[1:] != step[:-1]) | crossing[1:] | crossing[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+        self.mins = np.minimum.reduceat(mins, starts)
+        self.maxs = np.maximum.reduceat(maxs, starts)
+
+    def _k(self, q):
+        return self.compression / (2 * np.pi) * np.arcsin(np.clip(2 * q - 1, -1, 1))
+
+    def quantile(self, q):
+        if not len(self.weights):
+            return None
+        total = self.weights.sum()
+        cumulative = np.cumsum(self.weights)
+        i = min(int(np.searchsorted(cumulative, q * total, side='right')), len(cumulative) - 1)
+        if self.mins[i] == self.maxs[i]:
+            # every movie of this centroid has the same value, like a common rating, which is then exactly the answer
+            return float(self.mins[i])
+        # otherwise interpolating between the centers of the centroids, and from the extremes to the first and last one
+        ranks = np.r_[0.0, cumulative - self.weights / 2, total]
+        values = np.r_[self.mins.min(), self.means, self.maxs.max()]
+        return float(np.interp(q * total, ranks, values))
+
+    def rank_error(self, q):
+        # the most a quantile can be off, as a share of the movies
+        return 2 * np.pi * np.sqrt(q * (1 - q)) / self.compression
+
+# the summary of a file read chunk by chunk. add() takes the chunks in file order, which decides ties like on the whole file
+class StreamingSummary:
+    def __init__(self, precision=HLL_PRECISION, compression=TDIGEST_COMPRESSION):
+        self.stats = SummaryStats()
+        self.titles = HyperLogLog(precision)
+        self.digests = {column: TDigest(compression) for column in QUANTILE_COLUMNS}
+
+    def add(self, chunk):
+        self.stats = self.stats.merge(SummaryStats.from_frame(chunk))
+        self.titles.add(chunk['name'])
+        for column, digest in self.digests.items():
+            digest.add(chunk[column].to_numpy(dtype=float))
+
+    def merge(self, other):
+        # self is treated as coming before other in the file
+        merged = StreamingSummary(self.titles.precision)
+        merged.stats = self.stats.merge(other.stats)
+        merged.titles = self.titles.merge(other.titles)
+        merged.digests = {column: digest.merge(other.digests[column]) for column, digest in self.digests.items()}
+        return merged
+
+    def result(self):
+        # the same values as SummaryStats.result, plus the sketch estimates and how far off they can be
+        result = self.stats.result()
+        result['distinct_titles'] = self.titles.estimate()
+        for column, digest in self.digests.items():
+            result[f'{column}_quantiles'] = {quantile_name(q): digest.quantile(q) for q in QUANTILES}
+        result['error_bounds'] = {
+            'distinct_titles_relative_std_error': self.titles.relative_error(),
+            'quantile_rank_error': {quantile_name(q): self.digests[QUANTILE_COLUMNS[0]].rank_error(q) for q in QUANTILES},
+        }
+        return result
+
+def quantile_name(q):
+    return f"p{q * 100:g}"
+
+def sketch_lines(result):
+    # the estimates that are not in movie_summary.txt, printed after writing it
+    lines = [f"Distinct Titles: about {result['distinct_titles']} "
+             f"(within {2 * result['error_bounds']['distinct_titles_relative_std_error']:.1%} 95% of the time)\n"]
+    for column, label in (('rating', 'Rating Quantiles'), ('run_length', 'Runtime Quantiles (minutes)')):
+        quantiles = ', '.join(f"{name} {value:.1f}" for name, value in result[f'{column}_quantiles'].items())
+        lines.append(f"{label}: {quantiles}\n")
+    worst = max(result['error_bounds']['quantile_rank_error'].values())
+    lines.append(f"Quantiles are off by at most {worst:.1%} of the movies in rank\n")
+    return lines
+
+@instrumented(name='summary_sketch.stream_summary')
+def stream_summary(filename="clean_movie_data.csv", chunksize=DEFAULT_CHUNK_ROWS):
+    # one pass over the clean csv, only ever holding one chunk of it
+    summary = StreamingSummary()
+    for chunk in load_clean_chunks(filename, chunksize, CLEAN_COLUMNS):
+        summary.add(chunk)
+    if summary.stats.total_movies == 0:
+        raise FileHandlingError(f"Error loading data from {filename}: The .csv file is empty.")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="summarize a clean file in one pass with constant memory and print the sketch estimates")
+    parser.add_argument('filename', nargs='?', default='clean_movie_data.csv')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    result = stream_summary(args.filename, args.chunksize).result()
+    print(''.join(summary_lines(result) + ['\n'] + sketch_lines(result)), end='')
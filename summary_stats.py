@@ -0,0 +1,173 @@
+import pandas as pd
+from aggregate_cube import as_cube
+
+# columns we keep the highest and lowest movie for
+EXTREME_COLUMNS = ['rating', 'run_length', 'num_raters']
+
+# columns we keep the top 5 movies for
+TOP_COLUMNS = ['run_length', 'rating']
+TOP_N = 5
+
+# every number the summary needs, worked out in one go over a frame
+# two of these can be merged, so the stats can be built per chunk or per file and combined at the end
+class SummaryStats:
+    def __init__(self):
+        self.total_movies = 0
+        self.rating_sum = 0.0
+        self.run_length_sum = 0.0
+        self.min_year = None
+        self.max_year = None
+        self.year_counts = {} # kept in the order years first show up, that decides ties like value_counts does
+        self.genre_counts = {}
+        self.highest = {} # column -> (value, name)
+        self.lowest = {}
+        self.top = {column: [] for column in TOP_COLUMNS} # column -> [(value, name)] biggest first
+
+    @classmethod
+    def from_frame(cls, df, cube=None, ranks=None):
+        # the counts and sums come from the aggregate cube, only the extremes and top lists need the rows
+        # with the rank index of df those are read off its presorted orders instead of scanning every column
+        stats = cls()
+        if df.empty:
+            return stats
+        cube = as_cube(df) if cube is None else cube
+
+        stats.total_movies = cube.total_movies()
+        stats.rating_sum = cube.total('rating')
+        stats.run_length_sum = cube.total('run_length')
+
+        year_counts = cube.year_counts()
+        stats.min_year = year_counts.index.min()
+        stats.max_year = year_counts.index.max()
+        stats.year_counts = year_counts.to_dict()
+
+        stats.genre_counts = cube.genre_counts().to_dict()
+
+        names = df['name'].to_numpy()
+        for column in EXTREME_COLUMNS:
+            values = df[column].to_numpy()
+            if ranks is None:
+                high = values.argmax() # first one wins a tie, same as idxmax
+                low = values.argmin()
+            else:
+                high = ranks.top(column, 1)[0] # the rank index breaks ties the same way
+                low = ranks.bottom(column, 1)[0]
+            stats.highest[column] = (values[high], names[high])
+            stats.lowest[column] = (values[low], names[low])
+
+        for column in TOP_COLUMNS:
+            if ranks is None:
+                top = df.nlargest(TOP_N, column)
+            else:
+                top = df.iloc[ranks.top(column, TOP_N)]
+            stats.top[column] = list(zip(top[column].to_numpy(), top['name'].to_numpy()))
+
+        return stats
+
+    def merge(self, other):
+        # self is treated as coming before other, which matters for ties
+        merged = SummaryStats()
+        merged.total_movies = self.total_movies + other.total_movies
+        merged.rating_sum = self.rating_sum + other.rating_sum
+        merged.run_length_sum = self.run_length_sum + other.run_length_sum
+        merged.min_year = _pick(min, self.min_year, other.min_year)
+        merged.max_year = _pick(max, self.max_year, other.max_year)
+        merged.year_counts = _add_counts(self.year_counts, other.year_counts)
+        merged.genre_counts = _add_counts(self.genre_counts, other.genre_counts)
+
+        for column in EXTREME_COLUMNS:
+            merged.highest[column] = _pick_extreme(self.highest.get(column), other.highest.get(column), lambda a, b: b > a)
+            merged.lowest[column] = _pick_extreme(self.lowest.get(column), other.lowest.get(column), lambda a, b: b < a)
+
+        for column in TOP_COLUMNS:
+            # sorted is stable so on a tie the movie from self stays in front, like nlargest does
+            merged.top[column] = sorted(self.top[column] + other.top[column], key=lambda item: item[0], reverse=True)[:TOP_N]
+
+        return merged
+
+    def result(self):
+        # the finished summary values, in the shape create_summary_txt and the app show them
+        if self.total_movies == 0:
+            raise ValueError("Cannot summarize an empty dataset.")
+
+        years = pd.Series(self.year_counts)
+        years_sorted = years.sort_values(ascending=False, kind='stable')
+        genres = pd.Series(self.genre_counts, dtype='int64')
+        genres = genres.sort_index().sort_values(ascending=False, kind='stable')
+
+        return {
+            'total_movies': self.total_movies,
+            'time_span': f"{self.min_year} - {self.max_year}",
+            'highest_rated': self.highest['rating'],
+            'lowest_rated': self.lowest['rating'],
+            'longest_runtime': self.highest['run_length'],
+            'shortest_runtime': self.lowest['run_length'],
+            'most_rated': self.highest['num_raters'],
+            'least_rated': self.lowest['num_raters'],
+            'most_common_genre': genres.idxmax() if not genres.empty else None,
+            'least_common_genre': genres.idxmin() if not genres.empty else None,
+            'year_most_movies': (years_sorted.idxmax(), years_sorted.max()),
+            'year_fewest_movies': (years_sorted.idxmin(), years_sorted.min()),
+            'avg_rating': self.rating_sum / self.total_movies,
+            'avg_runtime': self.run_length_sum / self.total_movies,
+            'top_5_common_genres': genres.head(TOP_N).index.tolist(),
+            'top_5_longest_movies': [name for _, name in self.top['run_length']],
+            'top_5_highest_rated_movies': [name for _, name in self.top['rating']],
+        }
+
+def merge_stats(stats_list):
+    merged = SummaryStats()
+    for stats in stats_list:
+        merged = merged.merge(stats)
+    return merged
+
+def summary_lines(result):
+    # the text of movie_summary.txt, also shown on the streamlit page
+    return [
+        "Summary of Movie Dataset\n\n",
+        f"{'-'*30}\n\n",
+        f"Total Number of Movies: {result['total_movies']}\n",
+        f"Time Span Covered: {result['time_span']}\n\n",
+
+        f"Highest Rated Movie: {result['highest_rated'][1]} - {result['highest_rated'][0]:.1f}\n",
+        f"Lowest Rated Movie: {result['lowest_rated'][1]} - {result['lowest_rated'][0]:.1f}\n\n",
+
+        f"Longest Runtime Movie: {result['longest_runtime'][1]} - {result['longest_runtime'][0]} minutes\n",
+        f"Shortest Runtime Movie: {result['shortest_runtime'][1]} - {result['shortest_runtime'][0]} minutes\n\n",
+
+        f"Most Rated Movie: {result['most_rated'][1]} - {result['most_rated'][0]}\n",
+        f"Least Rated Movie: {result['least_rated'][1]} - {result['least_rated'][0]}\n\n",
+
+        f"Most Common Genre: {result['most_common_genre']}\n",
+        f"Least Common Genre: {result['least_common_genre']}\n\n",
+
+        f"Year with Most Movies Released: {result['year_most_movies'][0]} - {result['year_most_movies'][1]}\n",
+        f"Year with Fewest Movies Released: {result['year_fewest_movies'][0]} - {result['year_fewest_movies'][1]}\n\n",
+
+        f"Average Movie Rating: {result['avg_rating']:.2f}\n",
+        f"Average Movie Runtime: {result['avg_runtime']:.2f} minutes\n\n",
+
+        f"Top 5 Most Common Genres: {', '.join(result['top_5_common_genres'])}\n",
+        f"Top 5 Longest Movies: {', '.join(result['top_5_longest_movies'])}\n",
+        f"Top 5 Highest Rated Movies: {', '.join(result['top_5_highest_rated_movies'])}\n",
+    ]
+
+def _pick(func, a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return func(a, b)
+
+def _pick_extreme(current, candidate, better):
+    if current is None:
+        return candidate
+    if candidate is None:
+        return current
+    return candidate if better(current[0], candidate[0]) else current
+
+def _add_counts(a, b):
+    counts = dict(a)
+    for key, count in b.items():
+        counts[key] = counts.get(key, 0) + count
+    return counts
@@ -0,0 +1,114 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+from aggregate_cube import AggregateCube, cube_path_for, load_cube, save_cube
+from dataset import load_dataset
+from file_handling import source_fingerprint
+from genre_index import split_genres
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLEAN_FILE = os.path.join(REPO_DIR, 'clean_movie_data.csv')
+
+@pytest.fixture(scope='module')
+def movies():
+    return load_dataset(CLEAN_FILE, shared=False)
+
+def by_genre(df):
+    # one row per movie and genre, the way the cube counts a movie with several genres
+    genres = df['genres'].astype(object).map(split_genres)
+    return df.assign(genre=genres).explode('genre').dropna(subset=['genre'])
+
+def cube_table(cube, array):
+    # a (year, genre) -> value series of one of the cube arrays, without the all movies slot and the empty cells
+    table = pd.DataFrame(array[:, :cube.all_slot], index=pd.Index(cube.years, name='year'), columns=pd.Index(cube.genres, name='genre'))
+    counts = pd.DataFrame(cube.counts[:, :cube.all_slot], index=table.index, columns=table.columns).stack()
+    return table.stack()[counts > 0]
+
+def assert_same_cube(left, right):
+    np.testing.assert_array_equal(left.years, right.years)
+    assert list(left.genres) == list(right.genres)
+    assert list(left.year_order) == list(right.year_order)
+    np.testing.assert_array_equal(left.counts, right.counts)
+    for name in ('rating_sums', 'raters_sums', 'runtime_sums'):
+        np.testing.assert_allclose(getattr(left, name), getattr(right, name))
+    for name in ('rating_hist', 'runtime_hist'):
+        for a, b in zip(getattr(left, name), getattr(right, name)):
+            np.testing.assert_array_equal(a, b)
+
+def test_counts_and_sums_match_groupby(movies):
+    cube = AggregateCube.from_frame(movies)
+    # summing in float64 like the cube does, float32 ratings would add up to something slightly different
+    groups = by_genre(movies).astype({'rating': float, 'num_raters': float, 'run_length': float}).groupby(['year', 'genre'])
+    np.testing.assert_array_equal(cube_table(cube, cube.counts).sort_index(), groups.size().sort_index())
+    for column, array in (('rating', cube.rating_sums), ('num_raters', cube.raters_sums), ('run_length', cube.runtime_sums)):
+        np.testing.assert_allclose(cube_table(cube, array).sort_index(), groups[column].sum().sort_index(), rtol=1e-9)
+
+    # the all movies slot counts every movie once
+    totals = movies.groupby('year').agg(count=('name', 'size'), rating=('rating', 'sum'))
+    np.testing.assert_array_equal(cube.counts[:, cube.all_slot], totals['count'].reindex(cube.years))
+    np.testing.assert_allclose(cube.rating_sums[:, cube.all_slot], totals['rating'].reindex(cube.years), rtol=1e-6)
+    assert cube.total_movies() == len(movies)
+    assert cube.total('num_raters') == pytest.approx(movies['num_raters'].astype(float).sum())
+
+def test_summaries_match_pandas(movies):
+    cube = AggregateCube.from_frame(movies)
+    exploded = by_genre(movies)
+    counts = exploded['genre'].value_counts()
+    assert cube.genre_counts().to_dict() == counts.to_dict()
+    assert list(cube.genre_counts()) == sorted(counts, reverse=True)
+    pd.testing.assert_series_equal(cube.genre_means('rating').sort_index(), exploded.groupby('genre')['rating'].mean().astype(float).sort_index(),
+                                   check_names=False, check_index_type=False, rtol=1e-6)
+
+    # years in the order they first show up, like value_counts(sort=False)
+    pd.testing.assert_series_equal(cube.year_counts(), movies['year'].value_counts(sort=False), check_names=False, check_index_type=False)
+    decades = (movies['year'] // 10 * 10).value_counts().sort_index()
+    np.testing.assert_array_equal(cube.decade_counts().index, decades.index)
+    np.testing.assert_array_equal(cube.decade_counts(), decades)
+
+@pytest.mark.parametrize('column', ['rating', 'run_length'])
+def test_histograms_match_value_counts(movies, column):
+    values, counts = AggregateCube.from_frame(movies).histogram(column)
+    expected = movies[column].astype(float).round(1).value_counts().sort_index()
+    np.testing.assert_allclose(values, expected.index)
+    np.testing.assert_array_equal(counts, expected)
+
+@pytest.mark.parametrize('split', [1, 400, 1148])
+def test_merging_two_halves_gives_the_whole(movies, split):
+    first, second = movies.iloc[:split], movies.iloc[split:]
+    merged = AggregateCube.from_frame(first).merge(AggregateCube.from_frame(second))
+    assert_same_cube(merged, AggregateCube.from_frame(movies))
+
+def test_merging_with_an_empty_cube(movies):
+    cube = AggregateCube.from_frame(movies)
+    assert_same_cube(AggregateCube.empty().merge(cube), cube)
+    assert_same_cube(cube.merge(AggregateCube.from_frame(movies.iloc[:0])), cube)
+
+def test_save_and_load_round_trip(movies, tmp_path):
+    cube = AggregateCube.from_frame(movies)
+    path = str(tmp_path / 'movies.cube.npz')
+    cube.save(path, 'version 1')
+    assert_same_cube(AggregateCube.load(path, 'version 1'), cube)
+    assert not os.path.exists(path + '.tmp.npz')
+
+    # built from another version of the clean file, or not there at all
+    assert AggregateCube.load(path, 'version 2') is None
+    assert AggregateCube.load(str(tmp_path / 'missing.cube.npz'), 'version 1') is None
+    with open(path, 'wb') as f:
+        f.write(b'not a cube')
+    assert AggregateCube.load(path, 'version 1') is None
+
+def test_load_cube_rebuilds_after_the_file_changes(movies, tmp_path):
+    filename = str(tmp_path / 'clean.csv')
+    shutil.copy(CLEAN_FILE, filename)
+    save_cube(AggregateCube.from_frame(movies), filename)
+    assert load_cube(filename).total_movies() == len(movies)
+
+    # dropping the last movies changes the fingerprint, the saved cube is out of date and gets rebuilt
+    with open(filename) as f:
+        lines = f.readlines()
+    with open(filename, 'w') as f:
+        f.writelines(lines[:-10])
+    assert AggregateCube.load(cube_path_for(filename), source_fingerprint(filename)) is None
+    assert load_cube(filename).total_movies() == len(movies) - 10
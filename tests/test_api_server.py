@@ -0,0 +1,227 @@
+import asyncio
+import http.client
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import api_server
+from api_server import AnalyticsServer, CHARTS
+from dataset import dataset_version, get_dataset
+from partition_store import filter_dataset
+from plotting import new_figure
+
+pytest.importorskip('pyarrow')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APP_PID = os.getpid()
+
+def plot_count_hanging_in_workers(df):
+    # a chart worker that never answers, as far as the server can tell
+    if os.getpid() != APP_PID:
+        time.sleep(60)
+    fig = new_figure((4, 3))
+    fig.add_subplot().bar(['movies'], [len(df)])
+    return fig
+
+class RunningServer:
+    # an AnalyticsServer on a free port, with its loop on a thread so the tests can talk to it like any client
+    def __init__(self, filename, workers):
+        self.app = AnalyticsServer(filename, workers=workers, threads=4, cache_mb=16)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(self.app.start('127.0.0.1', 0), self.loop).result(60)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def get(self, path, method='GET'):
+        # (status, headers, body) of one request on a new connection
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request(method, path)
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    def get_json(self, path):
+        status, headers, body = self.get(path)
+        return status, headers, json.loads(body)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.app.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+
+def copy_clean_file(directory):
+    filename = str(directory / 'clean.csv')
+    shutil.copy(os.path.join(REPO_DIR, 'clean_movie_data.csv'), filename)
+    return filename
+
+@pytest.fixture(scope='module')
+def served(tmp_path_factory):
+    running = RunningServer(copy_clean_file(tmp_path_factory.mktemp('api')), workers=1)
+    yield running
+    running.close()
+
+def test_health(served):
+    status, headers, health = served.get_json('/health')
+    assert status == 200
+    assert health['status'] == 'ok'
+    assert health['dataset_version'] == headers['X-Dataset-Version'] == dataset_version(served.app.filename)
+    assert health['charts'] == sorted(CHARTS)
+    assert served.get_json('/charts')[2] == sorted(CHARTS)
+
+def test_summary_matches_the_committed_summary(served):
+    status, headers, body = served.get('/summary?format=txt')
+    assert status == 200 and headers['Content-Type'].startswith('text/plain')
+    with open(os.path.join(REPO_DIR, 'movie_summary.txt'), 'rb') as f:
+        assert body == f.read()
+
+    status, _, summary = served.get_json('/summary')
+    assert status == 200
+    assert summary['total_movies'] == len(get_dataset(served.app.filename))
+
+    # the filters narrow the summary down, in any order of the genres
+    _, _, horror = served.get_json('/summary?genres=Horror,Mystery&year_min=1990')
+    expected = filter_dataset(get_dataset(served.app.filename), ['Horror', 'Mystery'], 'any', 1990, None)
+    assert horror['total_movies'] == len(expected)
+    assert served.get_json('/summary?genres=Mystery&genres=Horror&year_min=1990')[2] == horror
+
+@pytest.mark.parametrize('query, genres, match, year_min, year_max', [
+    ('', None, 'any', None, None),
+    ('genres=Comedy&limit=7&offset=3', ['Comedy'], 'any', None, None),
+    ('genres=Action,Adventure&match=all&year_min=2000&year_max=2010', ['Action', 'Adventure'], 'all', 2000, 2010),
+    ('year=1994&limit=1000', None, 'any', 1994, 1994),
+])
+def test_search_matches_filtering_the_dataset(served, query, genres, match, year_min, year_max):
+    status, _, page = served.get_json(f'/search?{query}')
+    assert status == 200
+    expected = filter_dataset(get_dataset(served.app.filename), genres, match, year_min, year_max)
+    offset, limit = page['offset'], page['limit']
+    assert page['total'] == len(expected)
+    assert [movie['name'] for movie in page['movies']] == expected['name'].iloc[offset:offset + limit].tolist()
+    assert all(movie['year'] == year for movie, year in zip(page['movies'], expected['year'].iloc[offset:offset + limit]))
+
+def test_charts_are_pngs_and_cached(served):
+    for name in ('genre_ratings_bar', 'ratings_vs_raters'):
+        path = f'/charts/{name}.png?genres=Drama&year_min=1980'
+        status, headers, image = served.get(path)
+        assert status == 200 and headers['Content-Type'] == 'image/png'
+        assert image.startswith(b'\x89PNG')
+        assert headers['X-Cache'] == 'miss'
+
+        computed = served.app.counts['computed']
+        status, headers, again = served.get(path)
+        assert headers['X-Cache'] == 'hit' and again == image
+        assert served.app.counts['computed'] == computed
+    # an option is part of what is cached
+    assert served.get('/charts/ratings_vs_raters.png?genres=Drama&year_min=1980&log_raters=false')[1]['X-Cache'] == 'miss'
+
+def test_identical_requests_in_flight_are_worked_out_once(served):
+    path = '/charts/runtime_vs_year.png?genres=Western'
+    computed = served.app.counts['computed']
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda _: served.get(path), range(8)))
+    assert all(status == 200 for status, _, _ in responses)
+    assert served.app.counts['computed'] == computed + 1
+    assert [headers['X-Cache'] for _, headers, _ in responses].count('miss') == 1
+    assert {headers['X-Cache'] for _, headers, _ in responses} <= {'miss', 'coalesced', 'hit'}
+    assert len({body for _, _, body in responses}) == 1
+
+def test_waiting_requests_share_the_answer():
+    # the same with the timing under control: every request arrives while the first is still being worked out
+    app = AnalyticsServer(os.path.join(REPO_DIR, 'clean_movie_data.csv'), workers=0, threads=1, cache_mb=1)
+    calls = []
+
+    async def requests():
+        release = asyncio.Event()
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return b'answer'
+        waiting = [asyncio.ensure_future(app.cached('key', compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        answers = await asyncio.gather(*waiting)
+        answers.append(await app.cached('key', compute))
+        return answers
+
+    try:
+        answers = asyncio.run(requests())
+    finally:
+        app.close()
+    assert calls == [1]
+    assert answers == [(b'answer', 'miss')] + [(b'answer', 'coalesced')] * 4 + [(b'answer', 'hit')]
+    assert app.counts['computed'] == 1 and app.counts['coalesced'] == 4 and app.counts['hits'] == 1
+    assert app.inflight == {}
+
+@pytest.mark.parametrize('path', [
+    '/search?match=some',
+    '/search?year_min=nineties',
+    '/search?limit=-1',
+    '/search?limit=1000000',
+    '/search?offset=-5',
+    '/summary?format=xml',
+    '/charts/ratings_vs_raters.png?aggregate=maybe',
+])
+def test_bad_requests(served, path):
+    status, _, body = served.get_json(path)
+    assert status == 400
+    assert 'error' in body
+
+@pytest.mark.parametrize('path', [
+    '/nothing',
+    '/charts/pie_chart.png',
+    '/summary?genres=Nope',
+    '/charts/genre_ratings_bar.png?year=1800',
+])
+def test_not_found(served, path):
+    status, _, body = served.get_json(path)
+    assert status == 404
+    assert 'error' in body
+
+def test_only_get_and_head(served):
+    assert served.get('/health', method='POST')[0] == 405
+    status, headers, body = served.get('/charts', method='HEAD')
+    assert status == 200 and body == b'' and int(headers['Content-Length']) > 0
+
+def test_keep_alive(served):
+    connection = http.client.HTTPConnection('127.0.0.1', served.port, timeout=60)
+    try:
+        for _ in range(3):
+            connection.request('GET', '/health')
+            response = connection.getresponse()
+            assert response.status == 200 and response.getheader('Connection') == 'keep-alive'
+            response.read()
+    finally:
+        connection.close()
+
+def test_hanging_workers_fall_back_to_drawing_in_the_server(tmp_path, monkeypatch):
+    monkeypatch.setitem(CHARTS, 'hanging', (plot_count_hanging_in_workers, 'frame', ()))
+    monkeypatch.setattr(api_server, 'DEFAULT_RENDER_TIMEOUT', 1)
+    running = RunningServer(copy_clean_file(tmp_path), workers=1)
+    try:
+        started = time.perf_counter()
+        status, _, image = running.get('/charts/hanging.png')
+        assert status == 200 and image.startswith(b'\x89PNG')
+        # the workers were given up on, the next charts are drawn in the server process right away
+        status, _, image = running.get('/charts/hanging.png?genres=Drama')
+        assert status == 200 and image.startswith(b'\x89PNG')
+        assert time.perf_counter() - started < 10
+        assert running.get_json('/health')[2]['render_workers'] == 0
+    finally:
+        running.close()
+
+def test_without_workers_the_server_draws(tmp_path):
+    running = RunningServer(copy_clean_file(tmp_path), workers=0)
+    try:
+        status, headers, image = running.get('/charts/movies_by_decade.png')
+        assert status == 200 and image.startswith(b'\x89PNG') and headers['X-Cache'] == 'miss'
+        assert running.get('/charts/movies_by_decade.png')[1]['X-Cache'] == 'hit'
+    finally:
+        running.close()
@@ -0,0 +1,41 @@
+import hashlib
+import pytest
+import combine
+from combine import RAW_COLUMNS, combine as combine_files, process_genre_file
+
+HEADER = ','.join(RAW_COLUMNS)
+
+@pytest.mark.parametrize('data', [
+    f"{HEADER}\r\na,1,,,,,,,,\r\nb,2,,,,,,,,\r\n".encode(),
+    f"{HEADER}\na,1,,,,,,,,\nb,2,,,,,,,,".encode(),
+    f"{HEADER}\r\na,1,,,,,,,,\r\nb,2,,,,,,,,".encode(),
+    f"﻿{HEADER}\na,1,,,,,,,,\nb,2,,,,,,,,\n".encode(),
+])
+def test_rows_are_copied_with_lf_line_ends(tmp_path, monkeypatch, data):
+    monkeypatch.setattr(combine, 'COPY_BLOCK', 7) # small blocks, so some end between the CR and the LF
+    path = tmp_path / 'Action.csv'
+    path.write_bytes(data)
+    (tmp_path / 'parts').mkdir()
+    _, entry = process_genre_file(str(path), str(tmp_path / 'parts'))
+    assert (tmp_path / 'parts' / entry['part']).read_bytes() == b"a,1,,,,,,,,\nb,2,,,,,,,,\n"
+    assert entry['mode'] == 'passthrough'
+    assert entry['rows'] == 2
+    assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+
+def test_other_column_order_is_lined_up(tmp_path):
+    data = b"year,name\r\n2008,a\r\n"
+    path = tmp_path / 'Drama.csv'
+    path.write_bytes(data)
+    (tmp_path / 'parts').mkdir()
+    _, entry = process_genre_file(str(path), str(tmp_path / 'parts'))
+    assert (tmp_path / 'parts' / entry['part']).read_bytes() == b"a,2008,,,,,,,,\n"
+    assert (entry['mode'], entry['rows'], entry['sha256']) == ('reindexed', 1, hashlib.sha256(data).hexdigest())
+
+def test_combined_file_has_one_kind_of_line_end(tmp_path):
+    input_dir = tmp_path / 'genres'
+    input_dir.mkdir()
+    (input_dir / 'Action.csv').write_bytes(f"{HEADER}\r\na,1,,,,,,,,\r\n".encode())
+    (input_dir / 'Drama.csv').write_bytes(f"{HEADER}\nb,2,,,,,,,,".encode())
+    output = tmp_path / 'combined.csv'
+    combine_files(str(input_dir), str(output), workers=1)
+    assert output.read_bytes() == f"{HEADER}\na,1,,,,,,,,\nb,2,,,,,,,,\n".encode()
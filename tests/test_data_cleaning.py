@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_cleaning import parse_run_length, parse_release_date, clean_frame, chunk_rows_for_budget, clean_data_incremental
+from exceptions import DataCleaningError, FileHandlingError
+
+def raw_row(**values):
+    row = {
+        'name': 'The Dark Knight', 'year': '2008', 'movie_rated': 'PG-13', 'run_length': '2h 32min',
+        'genres': 'Action; Crime; Drama;', 'release_date': '18 July 2008 (USA)', 'rating': 9.0,
+        'num_raters': 2224522, 'num_reviews': 6836, 'review_url': 'https://www.imdb.com/title/tt0468569/reviews',
+    }
+    row.update(values)
+    return row
+
+def test_parse_run_length():
+    parsed = parse_run_length(pd.Series(['2h 32min', '2h', '45min', 'soon', None], dtype=object))
+    assert parsed.dtype == 'Int64'
+    assert parsed.tolist()[:3] == [152, 120, 45]
+    assert parsed.isna().tolist() == [False, False, False, True, True]
+
+def test_parse_all_missing_values():
+    series = pd.Series([np.nan, None], index=[7, 9], dtype=object)
+
+    run_length = parse_run_length(series)
+    assert run_length.dtype == 'Int64'
+    assert run_length.isna().all()
+    assert run_length.index.tolist() == [7, 9]
+
+    release_date = parse_release_date(series)
+    assert pd.api.types.is_datetime64_dtype(release_date)
+    assert release_date.isna().all()
+    assert release_date.index.tolist() == [7, 9]
+
+def test_clean_frame_single_row_without_runtime_or_date():
+    for missing in ('run_length', 'release_date'):
+        clean = clean_frame(pd.DataFrame([raw_row(**{missing: np.nan})]))
+        assert clean.empty
+
+def write_raw_csv(path, rows):
+    pd.DataFrame([raw_row(review_url=f'https://www.imdb.com/title/tt{i:07d}/reviews', name=f'movie {i}') for i in range(rows)]).to_csv(path, index=False)
+
+def test_chunks_shrink_as_the_file_grows(tmp_path):
+    small, big = tmp_path / 'small.csv', tmp_path / 'big.csv'
+    write_raw_csv(small, 100)
+    write_raw_csv(big, 20_000)
+    assert chunk_rows_for_budget(str(big), 4) < chunk_rows_for_budget(str(small), 4)
+    assert chunk_rows_for_budget(str(big), 4, 'most_raters') < chunk_rows_for_budget(str(big), 4)
+
+def test_budget_too_small_for_the_keys(tmp_path):
+    path = tmp_path / 'raw.csv'
+    write_raw_csv(path, 20_000)
+    with pytest.raises(DataCleaningError):
+        chunk_rows_for_budget(str(path), 1, 'most_raters')
+
+def append_raw_rows(path, rows):
+    pd.DataFrame(rows).to_csv(path, mode='a', header=False, index=False)
+
+def incremental_setup(tmp_path):
+    genre_dir = tmp_path / 'genres'
+    genre_dir.mkdir()
+    pd.DataFrame([raw_row(name=f'movie {i}', review_url=f'https://www.imdb.com/title/tt{i:07d}/reviews') for i in range(3)]).to_csv(genre_dir / 'action.csv', index=False)
+    output = str(tmp_path / 'clean.csv')
+    assert clean_data_incremental(str(genre_dir), output) == 3
+    return genre_dir, output
+
+def test_incremental_delta_of_seen_movies(tmp_path):
+    genre_dir, output = incremental_setup(tmp_path)
+    append_raw_rows(genre_dir / 'action.csv', [raw_row(name=f'movie {i}', review_url=f'https://www.imdb.com/title/tt{i:07d}/reviews') for i in (0, 2)])
+    assert clean_data_incremental(str(genre_dir), output) == 0
+    append_raw_rows(genre_dir / 'action.csv', [raw_row(name='movie 5', review_url='https://www.imdb.com/title/tt0000005/reviews')])
+    assert clean_data_incremental(str(genre_dir), output) == 1
+    assert pd.read_csv(output)['name'].tolist() == ['movie 0', 'movie 1', 'movie 2', 'movie 5']
+
+def test_incremental_single_row_without_runtime_or_date(tmp_path):
+    genre_dir, output = incremental_setup(tmp_path)
+    append_raw_rows(genre_dir / 'action.csv', [raw_row(name='movie 7', run_length=None, release_date=None,
+                                                       review_url='https://www.imdb.com/title/tt0000007/reviews')])
+    assert clean_data_incremental(str(genre_dir), output) == 0
+    assert len(pd.read_csv(output)) == 3
+
+def test_incremental_genre_file_missing_a_column(tmp_path):
+    genre_dir, output = incremental_setup(tmp_path)
+    pd.DataFrame([raw_row(name='movie 9', review_url='https://www.imdb.com/title/tt0000009/reviews')]).drop(columns='rating').to_csv(genre_dir / 'drama.csv', index=False)
+    with pytest.raises(FileHandlingError, match='rating'):
+        clean_data_incremental(str(genre_dir), output)
+    assert len(pd.read_csv(output)) == 3
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from dedup import RowHashSet, dedup_movies, dedup_state_bytes
+
+def test_filter_new_drops_seen_and_repeated_keys():
+    seen = RowHashSet()
+    assert seen.filter_new([1, 2, 3, 3]).tolist() == [True, True, True, False]
+    assert seen.filter_new([3, 4]).tolist() == [False, True]
+    assert len(seen) == 4
+
+def test_filter_new_after_an_all_duplicate_chunk():
+    seen = RowHashSet()
+    seen.filter_new([1, 2, 3])
+    assert not seen.filter_new([1, 2]).any()
+    assert seen.filter_new([5]).tolist() == [True]
+    assert seen.contains(np.array([1, 5, 6], dtype=np.uint64)).tolist() == [True, True, False]
+
+def test_merged_runs_keep_every_key_once():
+    seen = RowHashSet(max_runs=2)
+    for start in range(0, 50, 10):
+        seen.filter_new(np.arange(start, start + 15, dtype=np.uint64))
+    assert len(seen.runs) <= 2
+    assert len(seen) == 55
+    assert seen.contains(np.arange(60, dtype=np.uint64)).tolist() == [True] * 55 + [False] * 5
+
+def test_add_skips_keys_already_in_the_set():
+    seen = RowHashSet()
+    seen.add([1, 2])
+    seen.add([2, 2, 3])
+    seen.add([])
+    assert len(seen) == 3
+
+def test_save_and_load(tmp_path):
+    seen = RowHashSet()
+    seen.filter_new([5, 1])
+    seen.filter_new([9])
+    path = str(tmp_path / 'keys.npy')
+    seen.save(path)
+    loaded = RowHashSet.load(path)
+    assert loaded.runs[0].tolist() == [1, 5, 9]
+    assert RowHashSet.load(str(tmp_path / 'missing.npy')).runs == []
+
+@pytest.mark.parametrize('policy', ['first', 'most_raters'])
+def test_state_grows_with_the_movies(policy):
+    assert dedup_state_bytes(policy, 2000) == 2 * dedup_state_bytes(policy, 1000)
+
+def test_policies_pick_by_file_order_or_raters():
+    df = pd.DataFrame({'num_raters': [10, 30, 20]})
+    keys = np.array([7, 7, 7], dtype=np.uint64)
+    assert dedup_movies(df, keys, 'first').tolist() == [True, False, False]
+    assert dedup_movies(df, keys, 'last').tolist() == [False, False, True]
+    assert dedup_movies(df, keys, 'most_raters').tolist() == [False, True, False]
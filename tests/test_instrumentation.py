@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import pytest
+import instrumentation
+
+ENABLED = "import instrumentation; print(instrumentation.enabled(), instrumentation._trace_memory)"
+
+def profile_flags(monkeypatch, **env):
+    for name in ('MOVIES_PROFILE', 'MOVIES_PROFILE_MEMORY', 'MOVIES_PROFILE_TRACE'):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    # read at import, so in a fresh interpreter
+    return subprocess.run([sys.executable, '-c', ENABLED], capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(instrumentation.__file__)).stdout.split()
+
+@pytest.mark.parametrize('value', ['0', 'false', 'No', 'off', ''])
+def test_profile_off_values(monkeypatch, value):
+    assert profile_flags(monkeypatch, MOVIES_PROFILE=value, MOVIES_PROFILE_MEMORY=value) == ['False', 'False']
+
+@pytest.mark.parametrize('value', ['1', 'true', 'yes'])
+def test_profile_on_values(monkeypatch, value):
+    assert profile_flags(monkeypatch, MOVIES_PROFILE=value) == ['True', 'False']
+    assert profile_flags(monkeypatch, MOVIES_PROFILE=value, MOVIES_PROFILE_MEMORY='0') == ['True', 'False']
+    assert profile_flags(monkeypatch, MOVIES_PROFILE=value, MOVIES_PROFILE_MEMORY=value) == ['True', 'True']
+
+def test_stages_without_rss_readings(monkeypatch):
+    # like on windows, where there is no resource module
+    monkeypatch.setattr(instrumentation, 'resource', None)
+    assert instrumentation.peak_rss_mb() is None and instrumentation.current_rss_mb() is None
+    monkeypatch.setattr(instrumentation, '_enabled', True)
+    since = instrumentation.mark()
+    with instrumentation.stage('test.stage', 10):
+        pass
+    totals = instrumentation.summary(instrumentation.records(since=since))
+    assert [(row['name'], row['calls'], row['rss_peak_mb']) for row in totals] == [('test.stage', 1, None)]
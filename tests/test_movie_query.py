@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from dataset import load_dataset
+from genre_index import split_genres
+from movie_query import MovieIndex
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def movies():
+    df = load_dataset(os.path.join(REPO_DIR, 'clean_movie_data.csv'), shared=False)
+    return df, MovieIndex(df)
+
+def filter_movies(df, genres=None, match='any', year_min=None, year_max=None, rating_min=None, rating_max=None,
+                  raters_min=None, raters_max=None):
+    # the same filters written the plain pandas way
+    keep = pd.Series(True, index=df.index)
+    if genres:
+        movie_genres = df['genres'].astype(object).map(lambda value: set(split_genres(value)))
+        test = all if match == 'all' else any
+        keep &= movie_genres.map(lambda found: test(genre in found for genre in genres))
+    for column, low, high in [('year', year_min, year_max), ('rating', rating_min, rating_max),
+                              ('num_raters', raters_min, raters_max)]:
+        if low is not None:
+            keep &= df[column] >= low
+        if high is not None:
+            keep &= df[column] <= high
+    return df[keep]
+
+def sort_movies(df, sort_by, ascending):
+    # the index keeps ties in year order and then file order, and a descending sort is that order reversed
+    df = df.assign(position=np.arange(len(df)))
+    keys = ['position'] if sort_by is None else [sort_by, 'year', 'position']
+    df = df.sort_values(keys, kind='stable')
+    return df if ascending else df.iloc[::-1]
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'genres': ['Drama']},
+    {'genres': ['Action', 'Comedy']},
+    {'genres': ['Action', 'Comedy'], 'match': 'all'},
+    {'genres': ['Drama', 'Nope'], 'match': 'all'},
+    {'genres': ['Nope']},
+    {'year_min': 1990, 'year_max': 2005},
+    {'year_min': 2005, 'year_max': 1990},
+    {'genres': ['Comedy'], 'year_min': 2000},
+    {'rating_min': 7.3, 'rating_max': 8.1},
+    {'rating_min': 8.5, 'genres': ['Drama'], 'match': 'all'},
+    {'raters_min': 100_000, 'raters_max': 300_000},
+    {'raters_min': 1_000_000, 'year_max': 2010, 'rating_min': 8},
+    {'year_min': 1999.5, 'year_max': 2001.5},
+    # bounds past the int16 years and int32 raters are past every movie, not wrapped around
+    {'year_max': 40000},
+    {'year_min': -40000, 'raters_max': 3_000_000_000},
+    {'year_min': 40000},
+    {'raters_min': 3_000_000_000},
+])
+def test_query_matches_filtering_the_frame(movies, filters):
+    df, index = movies
+    expected = filter_movies(df, **filters)
+    total, page = index.query(**filters, page_size=None)
+    assert total == len(expected)
+    assert sorted(page['name']) == sorted(expected['name'])
+
+@pytest.mark.parametrize('sort_by', [None, 'rating', 'num_raters', 'run_length', 'year'])
+@pytest.mark.parametrize('ascending', [True, False])
+@pytest.mark.parametrize('filters', [
+    {},
+    {'genres': ['Drama']}, # enough matches for a small page to be read by walking the sort order
+    {'genres': ['Horror', 'Mystery'], 'match': 'all', 'year_min': 1980},
+    {'rating_min': 7.5, 'raters_max': 500_000},
+])
+def test_query_sorts_and_pages_like_the_frame(movies, sort_by, ascending, filters):
+    df, index = movies
+    expected = sort_movies(filter_movies(df, **filters), sort_by, ascending)
+    for page, page_size in [(0, 5), (3, 5), (1, 40), (0, 2000), (500, 5)]:
+        total, rows = index.query(**filters, sort_by=sort_by, ascending=ascending, page=page, page_size=page_size)
+        assert total == len(expected)
+        assert list(rows['name']) == list(expected['name'].iloc[page * page_size:(page + 1) * page_size])
+
+def test_query_only_returns_the_requested_columns(movies):
+    _, index = movies
+    total, rows = index.query(genres=['Comedy'], sort_by='rating', page_size=10, columns=['name', 'rating'])
+    assert list(rows.columns) == ['name', 'rating']
+    assert len(rows) == 10 and total > 10
+
+@pytest.mark.parametrize('arguments', [{'match': 'some'}, {'sort_by': 'name'}])
+def test_query_rejects_bad_arguments(movies, arguments):
+    _, index = movies
+    with pytest.raises(ValueError):
+        index.query(**arguments)
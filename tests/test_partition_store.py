@@ -0,0 +1,54 @@
+import multiprocessing
+import os
+import pandas as pd
+import pytest
+from dataset import get_dataset
+from file_handling import source_fingerprint
+from partition_store import PartitionStore, filter_dataset, load_partitions, parts_dir_for
+
+pytest.importorskip('pyarrow')
+
+GENRES = ['Action, Drama', 'Comedy', 'Drama, Romance', 'Horror', 'Action, Comedy']
+
+@pytest.fixture
+def clean_file(tmp_path):
+    path = tmp_path / 'clean.csv'
+    pd.DataFrame({
+        'name': [f'movie {i}' for i in range(40)],
+        'rel_date': [f'{1950 + i * 2}-05-01' for i in range(40)],
+        'genres': [GENRES[i % len(GENRES)] for i in range(40)],
+        'rating': [5 + i % 5 for i in range(40)],
+        'run_length': [90 + i for i in range(40)],
+        'num_raters': [100 * i for i in range(40)],
+    }).to_csv(path, index=False)
+    return os.path.abspath(path)
+
+@pytest.mark.parametrize('by_year', [False, True])
+@pytest.mark.parametrize('genres, match, year_min, year_max', [
+    (['Drama'], 'any', None, None),
+    (['Action', 'Comedy'], 'all', None, None),
+    (['Horror'], 'any', 1960, 1990),
+    (['Horror'], 'any', 2100, None), # nothing in the partition, read but empty
+    (['Nope'], 'all', None, None), # every partition pruned
+])
+def test_query_matches_filtering_the_dataset(clean_file, by_year, genres, match, year_min, year_max):
+    store = load_partitions(clean_file, by_year=by_year)
+    expected = filter_dataset(get_dataset(clean_file), genres, match, year_min, year_max)
+    pd.testing.assert_frame_equal(store.query(genres, match, year_min, year_max), expected, check_index_type=False)
+
+def write_store(filename):
+    fingerprint = source_fingerprint(filename)
+    df = get_dataset(filename)
+    for _ in range(5):
+        store = PartitionStore.write(df, filename, fingerprint)
+        store.query(['Drama'])
+
+def test_concurrent_writes_keep_one_copy(clean_file):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=write_store, args=(clean_file,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert sorted(os.listdir(parts_dir_for(clean_file))) == [source_fingerprint(clean_file), 'manifest.json']
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from dataset import load_dataset
+from file_handling import source_fingerprint
+from genre_index import add_genre_index, split_genres
+from rank_index import RankIndex, RANK_COLUMNS, load_ranks, ranks_path_for, save_ranks
+from summary_stats import SummaryStats
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLEAN_FILE = os.path.join(REPO_DIR, 'clean_movie_data.csv')
+
+GENRES = ['Drama', 'Comedy', 'Action, Drama', 'Comedy, Romance', 'Drama, Romance']
+
+@pytest.fixture(scope='module')
+def movies():
+    # lots of ties: ratings with one decimal in a narrow band, a few dozen runtimes, rounded rater counts.
+    # horror only ever gets low ratings so a top horror list has to give up walking and select instead
+    rng = np.random.default_rng(0)
+    count = 6000
+    genres = np.array(GENRES, dtype=object)[rng.integers(0, len(GENRES), count)]
+    ratings = np.round(rng.normal(7, 0.6, count), 1).clip(1, 10)
+    horror = rng.random(count) < 0.02
+    genres[horror] = 'Horror'
+    ratings[horror] = np.round(rng.uniform(2, 4, horror.sum()), 1)
+    df = pd.DataFrame({
+        'name': [f'movie {i}' for i in range(count)],
+        'year': rng.integers(1950, 2021, count).astype('int16'),
+        'genres': genres,
+        'rating': ratings.astype('float32'),
+        'run_length': rng.integers(80, 120, count).astype('uint16'),
+        'num_raters': (rng.integers(1, 50, count) * 1000).astype('int32'),
+    })
+    return add_genre_index(df)
+
+def filtered(df, genres=None, match='any', year_min=None, year_max=None):
+    keep = pd.Series(True, index=df.index)
+    if genres:
+        test = all if match == 'all' else any
+        keep &= df['genres'].map(lambda value: test(genre in split_genres(value) for genre in genres))
+    if year_min is not None:
+        keep &= df['year'] >= year_min
+    if year_max is not None:
+        keep &= df['year'] <= year_max
+    return df[keep]
+
+FILTERS = [
+    {},
+    {'genres': ['Romance']},
+    {'genres': ['Action', 'Drama'], 'match': 'all'},
+    {'genres': ['Comedy'], 'year_min': 1990, 'year_max': 1995},
+    {'genres': ['Horror']}, # rare at the top, the walk gives up and selects over every row
+    {'year_min': 2020},
+    {'genres': ['Nope'], 'match': 'all'},
+]
+
+@pytest.mark.parametrize('column', RANK_COLUMNS)
+@pytest.mark.parametrize('filters', FILTERS)
+@pytest.mark.parametrize('k', [1, 5, 100, 10_000])
+def test_top_and_bottom_match_nlargest_and_nsmallest(movies, column, filters, k):
+    ranks = RankIndex.from_frame(movies)
+    expected = filtered(movies, **filters)
+    # the index of the fixture is the row position, and keep='first' gives a tie to the movie first in the file
+    np.testing.assert_array_equal(ranks.top(column, k, **filters), expected.nlargest(k, column, keep='first').index)
+    np.testing.assert_array_equal(ranks.bottom(column, k, **filters), expected.nsmallest(k, column, keep='first').index)
+
+def test_zero_movies_asked_for(movies):
+    ranks = RankIndex.from_frame(movies)
+    assert len(ranks.top('rating', 0)) == 0
+    assert len(ranks.bottom('rating', 0, genres=['Drama'])) == 0
+
+@pytest.mark.parametrize('column', RANK_COLUMNS)
+def test_rank_and_percentile_match_pandas(movies, column):
+    ranks = RankIndex.from_frame(movies)
+    positions = np.arange(len(movies))
+    np.testing.assert_array_equal(ranks.rank(column, positions), movies[column].rank(method='min', ascending=False).astype(int))
+    np.testing.assert_allclose(ranks.percentile(column, positions), movies[column].rank(method='max', pct=True) * 100)
+
+    best = ranks.top(column, 1)[0]
+    rank, percentile = ranks.movie_ranks(best)[column]
+    assert rank == 1 and percentile == 100.0
+
+def test_bad_match_is_refused(movies):
+    with pytest.raises(ValueError):
+        RankIndex.from_frame(movies).top('rating', 5, genres=['Drama'], match='some')
+
+def test_summary_with_the_rank_index_is_the_same(movies):
+    # summary_stats takes the extremes and top lists off the rank index, ties have to go the same way as argmax and nlargest
+    plain = SummaryStats.from_frame(movies).result()
+    assert SummaryStats.from_frame(movies, ranks=RankIndex.from_frame(movies)).result() == plain
+
+def test_saved_index_loads_back_for_the_same_file(tmp_path):
+    filename = str(tmp_path / 'clean.csv')
+    with open(CLEAN_FILE) as source, open(filename, 'w') as target:
+        target.write(source.read())
+    df = load_dataset(filename, shared=False)
+    save_ranks(RankIndex.from_frame(df), filename)
+
+    ranks = load_ranks(filename, df)
+    for column in RANK_COLUMNS:
+        # the values are compared in the dtype of the loaded dataset, the float32 ratings included
+        assert ranks.sorted_values[column].dtype == df[column].to_numpy().dtype
+        np.testing.assert_array_equal(ranks.top(column, 20), df.nlargest(20, column, keep='first').index)
+
+    fingerprint = source_fingerprint(filename)
+    assert RankIndex.load(ranks_path_for(filename), fingerprint, df) is not None
+    assert RankIndex.load(ranks_path_for(filename), 'another version', df) is None
+    assert RankIndex.load(ranks_path_for(filename), fingerprint, df.iloc[:10]) is None # positions of another frame
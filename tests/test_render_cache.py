@@ -0,0 +1,64 @@
+import os
+import time
+import pandas as pd
+import pytest
+from dataset import dataset_version
+from exceptions import PlottingError
+from plotting import new_figure
+from render_cache import FigureRenderer, RenderCache, draw_figure
+
+APP_PID = os.getpid()
+
+def plot_count(df, color='blue'):
+    fig = new_figure((4, 3))
+    fig.add_subplot().bar(['movies'], [len(df)], color=color)
+    return fig
+
+def plot_count_hanging_in_workers(df, color='blue'):
+    # a worker stuck on a lock it inherited from the app, as far as the page can tell
+    if os.getpid() != APP_PID:
+        time.sleep(60)
+    return plot_count(df, color)
+
+def plot_nothing(df):
+    raise PlottingError("Nothing to plot.")
+
+@pytest.fixture
+def clean_file(tmp_path):
+    path = tmp_path / 'clean.csv'
+    pd.DataFrame({
+        'name': ['a', 'b', 'c'], 'rel_date': ['1999-05-01', '2001-06-01', '2010-07-01'], 'genres': ['Drama', 'Comedy', 'Drama'],
+        'rating': [7.0, 6.5, 8.0], 'run_length': [100, 90, 120], 'num_raters': [10, 20, 30],
+    }).to_csv(path, index=False)
+    return str(path)
+
+def test_draw_figure_without_params():
+    image = draw_figure(plot_count, [1, 2])
+    assert image.startswith(b'\x89PNG')
+    assert draw_figure(plot_count, [1, 2], params={'color': 'red'}) != image
+
+def test_workers_draw_the_figures(clean_file):
+    version = dataset_version(clean_file)
+    renderer = FigureRenderer(clean_file, workers=2, cache=RenderCache(1024 * 1024))
+    try:
+        futures = [renderer.submit(plot_count, version, color=color) for color in ('red', 'green')]
+        assert all(renderer.image(future).startswith(b'\x89PNG') for future in futures)
+        assert renderer.workers == 2
+        with pytest.raises(PlottingError):
+            renderer.image(renderer.submit(plot_nothing, version))
+    finally:
+        renderer.shutdown()
+
+def test_hanging_workers_fall_back_to_drawing_here(clean_file):
+    version = dataset_version(clean_file)
+    renderer = FigureRenderer(clean_file, workers=4, cache=RenderCache(1024 * 1024))
+    try:
+        # every figure goes to a worker that never answers, only the first one should wait for the timeout
+        futures = [renderer.submit(plot_count_hanging_in_workers, version, color=color)
+                   for color in ('red', 'green', 'blue', 'black', 'gray', 'orange')]
+        started = time.perf_counter()
+        assert all(renderer.image(future, timeout=2).startswith(b'\x89PNG') for future in futures)
+        assert time.perf_counter() - started < 5
+        assert renderer.workers == 0 and renderer.pool is None
+    finally:
+        renderer.shutdown()
@@ -0,0 +1,137 @@
+import os
+import shutil
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import shared_dataset
+from dataset import dataset_version, load_dataset
+from shared_dataset import attach_dataset, load_shared, shared_frame, shared_path_for, shared_stem_for
+
+pytest.importorskip('pyarrow')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NUMERIC_COLUMNS = ['rating', 'run_length', 'num_raters', 'year', 'genre_mask']
+
+@pytest.fixture
+def clean_file(tmp_path):
+    path = tmp_path / 'clean.csv'
+    shutil.copy(os.path.join(REPO_DIR, 'clean_movie_data.csv'), path)
+    return str(path)
+
+def mapped_files():
+    # (start, end, path) of every file mapped into this process
+    with open('/proc/self/maps') as f:
+        for line in f:
+            parts = line.split(maxsplit=5)
+            if len(parts) == 6:
+                start, end = (int(address, 16) for address in parts[0].split('-'))
+                yield start, end, parts[5].strip()
+
+def mapping_of(array):
+    # the file the memory of array belongs to, None for memory of this process
+    address = array.__array_interface__['data'][0]
+    for start, end, path in mapped_files():
+        if start <= address < end:
+            return path
+    return None
+
+def owner(array):
+    # pandas hands out read only views of every frame, the array that owns the memory is the one that matters
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+def counting(load):
+    calls = []
+    def counted():
+        calls.append(1)
+        return load()
+    return counted, calls
+
+def test_published_once_and_mapped_by_every_load(clean_file):
+    version = dataset_version(clean_file)
+    load, calls = counting(lambda: load_dataset(clean_file, shared=False))
+    first = load_shared(clean_file, version, load)
+    second = load_shared(clean_file, version, load)
+    assert len(calls) == 1 # the second load attached to the published file
+
+    path = shared_path_for(clean_file, version)
+    assert os.path.exists(path)
+    pd.testing.assert_frame_equal(first, load_dataset(clean_file, shared=False), check_dtype=False)
+    assert first.attrs['genre_vocabulary'] == load_dataset(clean_file, shared=False).attrs['genre_vocabulary']
+
+    if not os.path.exists('/proc/self/maps'):
+        pytest.skip('needs /proc to see what is mapped')
+    # zero copy: the columns of both loads point into the published file, not into memory of this process
+    for df in (first, second):
+        for column in NUMERIC_COLUMNS:
+            assert mapping_of(df[column].to_numpy()) == os.path.realpath(path), column
+        assert mapping_of(df['genres'].array.codes) == os.path.realpath(path)
+
+def test_another_process_attaches_without_loading(clean_file):
+    load_dataset(clean_file, shared=True)
+    code = (
+        "import sys, dataset, shared_dataset\n"
+        "df = shared_dataset.load_shared(sys.argv[1], dataset.dataset_version(sys.argv[1]), lambda: sys.exit('loaded again'))\n"
+        "print(len(df), shared_dataset.shared_frame(df))\n"
+    )
+    out = subprocess.run([sys.executable, '-c', code, clean_file], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    assert out.stdout.split() == [str(len(load_dataset(clean_file, shared=False))), 'True']
+
+def test_numeric_columns_are_read_only(clean_file):
+    df = load_dataset(clean_file, shared=True)
+    assert shared_frame(df)
+    for column in NUMERIC_COLUMNS:
+        values = owner(df[column].to_numpy())
+        assert not values.flags.writeable, column
+        with pytest.raises(ValueError):
+            values[:1] = 0
+
+    # the frame refuses a change instead of writing it into the file every other process reads
+    rating = float(df['rating'].iloc[0])
+    with pytest.raises(ValueError):
+        df.loc[0, 'rating'] = rating + 1
+    assert attach_dataset(clean_file, dataset_version(clean_file))['rating'].iloc[0] == rating
+
+    # a private copy owns writeable memory
+    private = load_dataset(clean_file, shared=False)
+    assert not shared_frame(private)
+    assert all(owner(private[column].to_numpy()).flags.writeable for column in NUMERIC_COLUMNS)
+
+def test_republished_when_the_file_changes(clean_file):
+    old_version = dataset_version(clean_file)
+    old = load_dataset(clean_file, shared=True)
+
+    with open(clean_file) as f:
+        lines = f.readlines()
+    with open(clean_file, 'w') as f:
+        f.writelines(lines[:-5])
+    new_version = dataset_version(clean_file)
+    assert new_version != old_version
+
+    new = load_dataset(clean_file, shared=True)
+    assert shared_frame(new)
+    assert len(new) == len(old) - 5
+    assert os.path.exists(shared_path_for(clean_file, new_version))
+    assert not os.path.exists(shared_path_for(clean_file, old_version)) # the old version is cleaned up
+    assert attach_dataset(clean_file, old_version) is None
+    # the frame mapped before keeps working, unix keeps a removed file until it is unmapped
+    assert old['rating'].sum() > 0
+
+def test_own_copy_when_publishing_fails(clean_file, monkeypatch, capsys):
+    def fail(df, filename, version):
+        raise OSError('No space left on device')
+    monkeypatch.setattr(shared_dataset, 'publish_dataset', fail)
+    df = load_dataset(clean_file, shared=True)
+    assert not shared_frame(df)
+    assert len(df) == len(load_dataset(clean_file, shared=False))
+    assert 'Could not publish' in capsys.readouterr().out
+
+def test_shared_dir_keeps_clean_files_apart(tmp_path, monkeypatch):
+    monkeypatch.setenv('MOVIES_SHARED_DIR', str(tmp_path / 'shm'))
+    first, second = shared_stem_for(str(tmp_path / 'a' / 'clean.csv')), shared_stem_for(str(tmp_path / 'b' / 'clean.csv'))
+    assert os.path.dirname(first) == str(tmp_path / 'shm')
+    assert first != second
@@ -0,0 +1,48 @@
+import os
+import pandas as pd
+import pytest
+import summarize
+from summarize import generate_reports, create_streaming_summary
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def write_clean_csv(path, years):
+    pd.DataFrame({
+        'name': [f'movie {i}' for i in range(len(years))],
+        'rel_date': [f'{year}-05-01' for year in years],
+        'genres': ['Action, Drama'] * len(years),
+        'rating': [7.5] * len(years),
+        'run_length': [120] * len(years),
+        'num_raters': [1000] * len(years),
+    }).to_csv(path, index=False)
+
+@pytest.fixture
+def clean_file(tmp_path):
+    path = tmp_path / 'clean.csv'
+    write_clean_csv(path, [1994, 1995, 2003])
+    return str(path)
+
+def test_unchanged_decades_are_not_loaded_again(clean_file, tmp_path, monkeypatch):
+    output_dir = str(tmp_path / 'reports')
+    assert generate_reports(clean_file, ['decade'], output_dir, workers=0)['written'] == 2
+    assert sorted(os.listdir(os.path.join(output_dir, 'decade'))) == ['1990s.txt', '2000s.txt']
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the dataset was loaded again")
+    monkeypatch.setattr(summarize, 'get_dataset', fail)
+    assert generate_reports(clean_file, ['decade'], output_dir, workers=0) == {'written': 0, 'skipped': 2, 'removed': 0}
+
+def test_removed_decade_takes_its_reports_with_it(clean_file, tmp_path):
+    output_dir = str(tmp_path / 'reports')
+    generate_reports(clean_file, ['decade'], output_dir, formats=('txt', 'json'), workers=0)
+    write_clean_csv(clean_file, [1994, 1995])
+    counts = generate_reports(clean_file, ['decade'], output_dir, formats=('txt', 'json'), workers=0)
+    assert counts['removed'] == 2
+    assert sorted(os.listdir(os.path.join(output_dir, 'decade'))) == ['1990s.json', '1990s.txt']
+
+def test_committed_summary_matches_the_committed_clean_file(tmp_path):
+    # movie_summary.txt is checked in next to the clean file it is made from, regenerate both when either changes
+    output = tmp_path / 'movie_summary.txt'
+    create_streaming_summary(os.path.join(REPO_DIR, 'clean_movie_data.csv'), str(output))
+    with open(os.path.join(REPO_DIR, 'movie_summary.txt')) as f:
+        assert output.read_text() == f.read()
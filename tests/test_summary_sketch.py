@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from dataset import load_dataset
+from summary_sketch import HyperLogLog, TDigest, StreamingSummary, stream_summary
+from summary_stats import SummaryStats, summary_lines
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLEAN_FILE = os.path.join(REPO_DIR, 'clean_movie_data.csv')
+
+def titles(start, stop):
+    return pd.Series([f'title {i}' for i in range(start, stop)])
+
+def rank_span(values, x):
+    # the share of values below x and up to x, a quantile estimate is right for every q in between
+    return np.mean(values < x), np.mean(values <= x)
+
+def assert_quantile_within_bound(digest, values, q):
+    low, high = rank_span(values, digest.quantile(q))
+    error = digest.rank_error(q)
+    assert low - error <= q <= high + error, (q, low, high, error)
+
+@pytest.mark.parametrize('count', [1000, 200_000]) # linear counting and the full estimate
+def test_hyperloglog_is_within_the_stated_bound(count):
+    sketch = HyperLogLog()
+    sketch.add(titles(0, count))
+    sketch.add(titles(0, count // 2)) # seen again, not counted again
+    assert abs(sketch.estimate() - count) <= 2 * sketch.relative_error() * count
+
+def test_hyperloglog_skips_missing_values():
+    sketch = HyperLogLog()
+    sketch.add(pd.Series(['a', None, 'b', 'a', np.nan]))
+    assert sketch.estimate() == 2
+
+def test_hyperloglog_of_different_precision_does_not_merge():
+    with pytest.raises(ValueError):
+        HyperLogLog(14).merge(HyperLogLog(12))
+
+@pytest.mark.parametrize('values', [
+    np.random.default_rng(0).lognormal(size=100_000), # all different
+    np.round(np.random.default_rng(1).normal(7, 0.8, size=20_000), 1), # ratings, lots of equal values
+    np.random.default_rng(2).integers(60, 200, size=20_000).astype(float), # whole minute runtimes
+], ids=['continuous', 'ratings', 'runtimes'])
+def test_tdigest_quantiles_are_within_the_stated_rank_bound(values):
+    digest = TDigest()
+    for chunk in np.array_split(values, 7):
+        digest.add(chunk)
+    assert digest.count == len(values)
+    for q in (0.01, 0.5, 0.99):
+        assert_quantile_within_bound(digest, values, q)
+
+def test_tdigest_stays_small():
+    digest = TDigest()
+    for chunk in np.array_split(np.random.default_rng(3).random(200_000), 20):
+        digest.add(chunk)
+    assert len(digest.means) <= digest.compression
+
+def test_merging_is_associative():
+    values = np.random.default_rng(4).lognormal(size=60_000)
+    parts = np.array_split(np.arange(len(values)), 3)
+    sketches, digests = [], []
+    for part in parts:
+        sketch, digest = HyperLogLog(), TDigest()
+        sketch.add(titles(part[0], part[-1] + 1))
+        digest.add(values[part])
+        sketches.append(sketch)
+        digests.append(digest)
+
+    a, b, c = sketches
+    # the registers are a max of the registers, so any grouping gives the same sketch
+    np.testing.assert_array_equal(a.merge(b).merge(c).registers, a.merge(b.merge(c)).registers)
+    np.testing.assert_array_equal(a.merge(b).merge(c).registers, c.merge(a).merge(b).registers)
+
+    # the centroids of a t-digest depend on the order they were compressed in, the answers stay within the bound either way
+    a, b, c = digests
+    for digest in (a.merge(b).merge(c), a.merge(b.merge(c))):
+        assert digest.count == len(values)
+        for q in (0.01, 0.5, 0.99):
+            assert_quantile_within_bound(digest, values, q)
+
+def test_streaming_summaries_merge_in_any_grouping():
+    df = load_dataset(CLEAN_FILE, shared=False)
+    summaries = []
+    for part in np.array_split(np.arange(len(df)), 3):
+        summary = StreamingSummary()
+        summary.add(df.iloc[part])
+        summaries.append(summary)
+    a, b, c = summaries
+    left, right = a.merge(b).merge(c).result(), a.merge(b.merge(c)).result()
+    assert summary_lines(left) == summary_lines(right)
+    assert left['distinct_titles'] == right['distinct_titles']
+
+@pytest.mark.parametrize('chunksize', [100, 1000, 100_000])
+def test_streaming_summary_matches_summary_stats(chunksize):
+    df = load_dataset(CLEAN_FILE, shared=False)
+    result = stream_summary(CLEAN_FILE, chunksize).result()
+    assert summary_lines(result) == summary_lines(SummaryStats.from_frame(df).result())
+
+    titles_count = df['name'].nunique()
+    assert abs(result['distinct_titles'] - titles_count) <= 2 * result['error_bounds']['distinct_titles_relative_std_error'] * titles_count
+    for column in ('rating', 'run_length'):
+        values = df[column].to_numpy(dtype=float)
+        for q, name in ((0.01, 'p1'), (0.5, 'p50'), (0.99, 'p99')):
+            low, high = rank_span(values, result[f'{column}_quantiles'][name])
+            error = result['error_bounds']['quantile_rank_error'][name]
+            assert low - error <= q <= high + error, (column, q, low, high, error)
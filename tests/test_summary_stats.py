@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from dataset import load_dataset
+from genre_index import add_genre_index
+from summary_stats import SummaryStats, merge_stats, summary_lines
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def movies():
+    return load_dataset(os.path.join(REPO_DIR, 'clean_movie_data.csv'), shared=False)
+
+@pytest.fixture(scope='module')
+def tied_movies():
+    # every value tied many times over, so the first movie in the file has to win across the chunk boundaries too
+    count = 300
+    return add_genre_index(pd.DataFrame({
+        'name': [f'movie {i}' for i in range(count)],
+        'year': np.array([2000 + i % 7 for i in range(count)], dtype='int16'),
+        'genres': [['Drama', 'Comedy', 'Action, Drama'][i % 3] for i in range(count)],
+        'rating': np.array([5 + i % 4 for i in range(count)], dtype='float32'),
+        'run_length': np.array([90 + i % 5 for i in range(count)], dtype='uint16'),
+        'num_raters': np.array([1000 * (i % 6) for i in range(count)], dtype='int32'),
+    }))
+
+def assert_same_result(merged, whole):
+    merged, whole = dict(merged), dict(whole)
+    # the sums are added up in another order, so the averages can differ in the last bits
+    for key in ('avg_rating', 'avg_runtime'):
+        assert merged.pop(key) == pytest.approx(whole.pop(key))
+    assert merged == whole
+
+@pytest.mark.parametrize('chunks', [1, 2, 3, 10, 100])
+def test_merged_chunks_match_the_whole_frame(movies, chunks):
+    parts = np.array_split(np.arange(len(movies)), chunks)
+    merged = merge_stats(SummaryStats.from_frame(movies.iloc[part]) for part in parts).result()
+    whole = SummaryStats.from_frame(movies).result()
+    assert_same_result(merged, whole)
+    assert summary_lines(merged) == summary_lines(whole)
+
+@pytest.mark.parametrize('chunks', [2, 7, 60])
+def test_merged_chunks_break_ties_like_the_whole_frame(tied_movies, chunks):
+    parts = np.array_split(np.arange(len(tied_movies)), chunks)
+    merged = merge_stats(SummaryStats.from_frame(tied_movies.iloc[part]) for part in parts).result()
+    assert_same_result(merged, SummaryStats.from_frame(tied_movies).result())
+    assert merged['highest_rated'][1] == 'movie 3'
+    assert merged['top_5_highest_rated_movies'] == ['movie 3', 'movie 7', 'movie 11', 'movie 15', 'movie 19']
+
+def test_empty_chunks_change_nothing(movies):
+    whole = SummaryStats.from_frame(movies)
+    empty = SummaryStats.from_frame(movies.iloc[:0])
+    assert_same_result(empty.merge(whole).merge(empty).result(), whole.result())
+    with pytest.raises(ValueError):
+        empty.result()